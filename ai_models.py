@@ -1,52 +1,138 @@
-import openai
-import anthropic
 import requests
 import json
 import os
+import threading
 import time
+from contextlib import contextmanager
 from dotenv import load_dotenv
+from ai_types import AiType
+from sse import iter_sse_events
+from llm_cache import llm_cache, make_cache_key
+from provider_clients import (ClientPool, split_keys, pair_keys, make_openai_client, make_anthropic_client,
+                              make_requests_session, CONNECT_TIMEOUT, TIMEOUT)
+from rate_limiter import (limited, estimate_tokens, call_with_retry, is_transient_error, backoff_delay,
+                          cancellable, cancellable_sleep, raise_if_cancelled, RequestCancelled)
+from hedging import HEDGING_ENABLED, provider_health, choose_providers, hedged_call, hedged_stream
+from metrics import record_llm_call, record_llm_usage, llm_ttft, llm_retries, llm_in_flight, stage_duration, stage
+import tracing
 
 load_dotenv()
 
-class AiType:
-    GPT = 'gpt'
-    ANTHROPIC = 'anthropic'
-    CLOVARX = 'clovar'
-
 class Gpt:
+    model = "gpt-4o"
+    max_tokens = 4096
+    temperature = 0.2
+
     def __init__(self):
-        pass
-
-    def __set_api_key(self) -> openai.OpenAI:
-        api_key = [os.environ.get('OpenaiAPI')]
-        random_integer = 0  # random.randint(0, len(api_key) - 1)
-        return openai.OpenAI(api_key=api_key[random_integer])
-
-    def request(self, messages):
-        client = self.__set_api_key()
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            max_tokens=4096,
-            temperature=0.2,
-        )
+        self.clients = ClientPool(split_keys(os.environ.get('OpenaiAPI')), make_openai_client)
+
+    def is_configured(self):
+        return self.clients.key(0) is not None
+
+    @staticmethod
+    def _format_params(json_mode):
+        # JSON mode 에서는 모델이 항상 파싱 가능한 JSON 객체만 돌려준다
+        return {'response_format': {'type': 'json_object'}} if json_mode else {}
+
+    def request(self, messages, json_mode=False):
+        key_id, client = self.clients.next()
+        with limited(AiType.GPT, key_id, estimate_tokens(messages, self.max_tokens)) as limiter:
+            raw = client.chat.completions.with_raw_response.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=self.max_tokens,
+                temperature=self.temperature,
+                **self._format_params(json_mode),
+            )
+            limiter.update_from_headers(raw.headers)
+        response = raw.parse()
+        if response.usage:
+            record_llm_usage(AiType.GPT, self.model, response.usage.prompt_tokens, response.usage.completion_tokens)
         return response.choices[0].message.content
 
+    def stream(self, messages, json_mode=False):
+        key_id, client = self.clients.next()
+        with limited(AiType.GPT, key_id, estimate_tokens(messages, self.max_tokens)) as limiter:
+            raw = client.chat.completions.with_raw_response.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=self.max_tokens,
+                temperature=self.temperature,
+                stream=True,
+                # 마지막 chunk 로 usage 를 받는다 (choices 가 비어 있음)
+                stream_options={'include_usage': True},
+                **self._format_params(json_mode),
+            )
+            limiter.update_from_headers(raw.headers)
+        for chunk in raw.parse():
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            if chunk.usage:
+                record_llm_usage(AiType.GPT, self.model, chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+
 class Anthropic3:
+    model = "claude-3-opus-20240229"
+    max_tokens = 4096
+    temperature = 0.2
+
     def __init__(self):
-        self.client = anthropic.Client(api_key=os.environ.get('Anthropic3API'))
+        self.clients = ClientPool(split_keys(os.environ.get('Anthropic3API')), make_anthropic_client)
+
+    def is_configured(self):
+        return self.clients.key(0) is not None
+
+    # JSON mode 가 없어서 assistant 응답을 '{' 로 시작하게 채워두고(prefill) 이어서 쓰게 한다
+    JSON_PREFILL = '{'
 
-    def request(self, msg=None):
+    @classmethod
+    def _messages(cls, msg, json_mode):
+        return msg + [{"role": "assistant", "content": cls.JSON_PREFILL}] if json_mode else msg
+
+    def request(self, msg=None, json_mode=False):
         common_params = {
-            "model": "claude-3-opus-20240229",
-            "max_tokens": 4096,
-            "temperature": 0.2,
-            "messages": msg
+            "model": self.model,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "messages": self._messages(msg, json_mode)
         }
-        response = self.client.messages.create(**common_params)
-        return response.content[0].text
+        key_id, client = self.clients.next()
+        with limited(AiType.ANTHROPIC, key_id, estimate_tokens(msg, self.max_tokens)) as limiter:
+            raw = client.messages.with_raw_response.create(**common_params)
+            limiter.update_from_headers(raw.headers)
+        response = raw.parse()
+        record_llm_usage(AiType.ANTHROPIC, self.model, response.usage.input_tokens, response.usage.output_tokens)
+        return (self.JSON_PREFILL if json_mode else '') + response.content[0].text
+
+    def stream(self, msg=None, json_mode=False):
+        common_params = {
+            "model": self.model,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "messages": self._messages(msg, json_mode)
+        }
+        key_id, client = self.clients.next()
+        with limited(AiType.ANTHROPIC, key_id, estimate_tokens(msg, self.max_tokens)) as limiter:
+            raw = client.messages.with_raw_response.create(stream=True, **common_params)
+            limiter.update_from_headers(raw.headers)
+        with raw.parse() as stream:
+            if json_mode:
+                yield self.JSON_PREFILL
+            input_tokens = None
+            for event in stream:
+                if event.type == 'content_block_delta' and event.delta.type == 'text_delta':
+                    yield event.delta.text
+                elif event.type == 'message_start':
+                    input_tokens = event.message.usage.input_tokens
+                elif event.type == 'message_delta':
+                    record_llm_usage(AiType.ANTHROPIC, self.model, input_tokens, event.usage.output_tokens)
+
+class ClovarXError(Exception):
+    pass
 
 class ClovarX:
+    model = 'HCX-003'
+    max_tokens = 762
+    temperature = 0.16
     host = os.environ.get('CloverHost')
     api_key = os.environ.get('CloverAPI')
     api_key_primary_val = os.environ.get('CloverAPIPrimary')
@@ -54,58 +140,291 @@ class ClovarX:
 
     def __init__(self):
         self._host = self.host
-        self._api_key = self.api_key
-        self._api_key_primary_val = self.api_key_primary_val
         self._request_id = self.request_id
+        # CloverAPI 와 CloverAPIPrimary 는 같은 순서로 쉼표 구분해서 여러 쌍을 설정할 수 있다
+        keys = pair_keys(self.api_key, self.api_key_primary_val, ('CloverAPI', 'CloverAPIPrimary'))
+        self.clients = ClientPool(keys, make_requests_session)
 
-    def execute(self, completion_request):
-        headers = {
-            'X-NCP-CLOVASTUDIO-API-KEY': self._api_key,
-            'X-NCP-APIGW-API-KEY': self._api_key_primary_val,
+    def is_configured(self):
+        return bool(self._host) and self.clients.key(0)[0] is not None
+
+    def _headers(self, key):
+        api_key, api_key_primary_val = key
+        return {
+            'X-NCP-CLOVASTUDIO-API-KEY': api_key,
+            'X-NCP-APIGW-API-KEY': api_key_primary_val,
             'X-NCP-CLOVASTUDIO-REQUEST-ID': self._request_id,
             'Content-Type': 'application/json; charset=utf-8',
             'Accept': 'text/event-stream'
         }
-        with requests.post(self._host + '/testapp/v1/chat-completions/HCX-003',
-                           headers=headers, json=completion_request, stream=True) as r:
-            lines = list(r.iter_lines())
-            answer = json.loads(lines[-6].decode("utf-8")[5:])
-            return answer["message"]["content"]
-
-    def request(self, messages, topP=0.47, topK=0, maxTokens=762, temperature=0.16, repeatPenalty=0.16, stopBefore=[], includeAiFilters=False, seed=0):
-        request_data = {
+
+    def _events(self, completion_request):
+        key_id, session = self.clients.next()
+        headers = self._headers(self.clients.key(key_id))
+        tokens = estimate_tokens(completion_request['messages'], completion_request['maxTokens'])
+        with limited(AiType.CLOVARX, key_id, tokens) as limiter:
+            r = session.post(self._host + f'/testapp/v1/chat-completions/{self.model}',
+                             headers=headers, json=completion_request, stream=True,
+                             timeout=(CONNECT_TIMEOUT, TIMEOUT))
+            try:
+                r.raise_for_status()
+            except requests.HTTPError:
+                r.close()
+                raise
+            limiter.update_from_headers(r.headers)
+        with r:
+            for event in iter_sse_events(r.iter_lines()):
+                yield event
+                if event.event == 'result':
+                    # 최종 결과를 받으면 남은 trailer 를 기다리지 않고 연결을 닫는다
+                    return
+
+    def _result_content(self, event):
+        result = json.loads(event.data)
+        record_llm_usage(AiType.CLOVARX, self.model, result.get('inputLength'), result.get('outputLength'))
+        return result["message"]["content"]
+
+    def execute(self, completion_request):
+        chunks = []
+        for event in self._events(completion_request):
+            if event.event == 'token':
+                chunks.append(json.loads(event.data)["message"]["content"])
+            elif event.event == 'result':
+                return self._result_content(event)
+            elif event.event == 'error':
+                raise ClovarXError(event.data)
+        # result 이벤트 없이 스트림이 끝나면 받은 토큰만 이어서 반환
+        return ''.join(chunks)
+
+    def execute_stream(self, completion_request):
+        for event in self._events(completion_request):
+            if event.event == 'token':
+                yield json.loads(event.data)["message"]["content"]
+            elif event.event == 'result':
+                self._result_content(event)
+                return
+            elif event.event == 'error':
+                raise ClovarXError(event.data)
+
+    def _request_data(self, messages, topP=0.47, topK=0, maxTokens=None, temperature=None, repeatPenalty=0.16, stopBefore=[], includeAiFilters=False, seed=0):
+        return {
             'messages': messages,
             'topP': topP,
             'topK': topK,
-            'maxTokens': maxTokens,
-            'temperature': temperature,
+            'maxTokens': self.max_tokens if maxTokens is None else maxTokens,
+            'temperature': self.temperature if temperature is None else temperature,
             'repeatPenalty': repeatPenalty,
             'stopBefore': stopBefore,
             'includeAiFilters': includeAiFilters,
             'seed': seed
         }
-        return self.execute(request_data)
+
+    # JSON mode 가 없으므로 json_mode 는 무시하고 structured_output 의 로컬 복구에 맡긴다
+    def request(self, messages, json_mode=False, **kwargs):
+        return self.execute(self._request_data(messages, **kwargs))
+
+    def stream(self, messages, json_mode=False, **kwargs):
+        return self.execute_stream(self._request_data(messages, **kwargs))
 
 gpt = Gpt()
 anthropic3 = Anthropic3()
 clovar_x = ClovarX()
 
-def gpt_request(prompt, ai_type=AiType.GPT):
+providers = {
+    AiType.GPT: gpt,
+    AiType.ANTHROPIC: anthropic3,
+    AiType.CLOVARX: clovar_x,
+}
+
+# 프로세스 전체에서 provider 별로 동시에 진행하는 호출 수. LLM_CONCURRENCY_GPT=16 처럼 바꿀 수 있다.
+# 실제로 호출하는 provider 를 고른 곳(gpt_request / gpt_request_stream)에서 세므로 failover, hedge 요청과
+# route 에서 직접 부른 요청도 모두 제한된다.
+DEFAULT_CONCURRENCY = {
+    AiType.GPT: 8,
+    AiType.ANTHROPIC: 4,
+    AiType.CLOVARX: 4,
+}
+# 자리를 기다리는 동안 hedge 취소를 확인하는 간격(초)
+SLOT_POLL_INTERVAL = 0.1
+
+def load_concurrency_from_env():
+    concurrency = dict(DEFAULT_CONCURRENCY)
+    for ai_type in concurrency:
+        value = os.environ.get(f'LLM_CONCURRENCY_{ai_type.upper()}')
+        if value:
+            concurrency[ai_type] = int(value)
+    return concurrency
+
+_semaphores = {ai_type: threading.BoundedSemaphore(limit) for ai_type, limit in load_concurrency_from_env().items()}
+
+@contextmanager
+def provider_slot(ai_type):
+    """provider 의 동시 호출 자리 하나를 잡는다. 기다리는 동안 cancellable() 의 cancel 이 설정되면 RequestCancelled."""
+    semaphore = _semaphores[ai_type]
+    while not semaphore.acquire(timeout=SLOT_POLL_INTERVAL):
+        raise_if_cancelled()
+    llm_in_flight.inc(ai_type)
+    try:
+        yield
+    finally:
+        llm_in_flight.dec(ai_type)
+        semaphore.release()
+
+def _cache_key(ai_type, messages, json_mode=False):
+    provider = providers[ai_type]
+    return make_cache_key(ai_type, provider.model, messages, provider.temperature, provider.max_tokens,
+                          'json' if json_mode else None)
+
+def gpt_request(prompt, ai_type=AiType.GPT, use_cache=True, json_mode=False):
+    messages = [{"role": "user", "content": prompt}]
+    key = _cache_key(ai_type, messages, json_mode) if use_cache else None
+    if key:
+        cached = llm_cache.get(key)
+        if cached is not None:
+            tracing.add_event('cache_hit', provider=ai_type)
+            return cached
+
+    model = providers[ai_type].model
+    with provider_slot(ai_type):
+        started = time.monotonic()
+        try:
+            with tracing.span('llm.request', provider=ai_type, model=model, prompt_chars=len(prompt)):
+                response = providers[ai_type].request(messages, json_mode=json_mode)
+        except Exception:
+            provider_health.record(ai_type, time.monotonic() - started, False)
+            record_llm_call(ai_type, model, time.monotonic() - started, False)
+            raise
+        provider_health.record(ai_type, time.monotonic() - started, True)
+        record_llm_call(ai_type, model, time.monotonic() - started, True)
+    if key and response:
+        llm_cache.put(key, response)
+    return response
+
+def gpt_request_stream(prompt, ai_type=AiType.GPT, use_cache=True, json_mode=False):
     messages = [{"role": "user", "content": prompt}]
-    if ai_type == AiType.GPT:
-        return gpt.request(messages)
-    elif ai_type == AiType.ANTHROPIC:
-        return anthropic3.request(messages)
-    elif ai_type == AiType.CLOVARX:
-        return clovar_x.request(messages)
-
-# Helper function to handle rate limit errors and retry
-def gpt_request_with_retry(prompt, ai_type=AiType.GPT, max_retries=5):
+    key = _cache_key(ai_type, messages, json_mode) if use_cache else None
+    if key:
+        cached = llm_cache.get(key)
+        if cached is not None:
+            # 캐시된 응답은 한 번에 전달
+            tracing.add_event('cache_hit', provider=ai_type)
+            yield cached
+            return
+
+    # 중간에 close() 로 취소된 스트림은 기록하지 않는다 (GeneratorExit 는 Exception 이 아님)
+    chunks = []
+    model = providers[ai_type].model
+    # 스트림을 다 읽을(닫을) 때까지 provider 의 동시 호출 자리를 잡고 있는다
+    with provider_slot(ai_type):
+        span = tracing.start_span('llm.request', provider=ai_type, model=model, prompt_chars=len(prompt),
+                                  stream=True)
+        started = time.monotonic()
+        try:
+            # provider 가 알려주는 usage 가 이 span 에 붙도록 꺼낼 때만 현재 span 으로 둔다
+            for delta in tracing.iterate(span, providers[ai_type].stream(messages, json_mode=json_mode)):
+                if not chunks:
+                    llm_ttft.observe(time.monotonic() - started, ai_type, model)
+                    provider_health.record_first_token(ai_type, time.monotonic() - started)
+                    span.add_event('first_token')
+                chunks.append(delta)
+                yield delta
+        except RequestCancelled:
+            # 다른 provider 가 먼저 응답해서 멈춘 요청은 장애로 기록하지 않는다
+            raise
+        except Exception as e:
+            provider_health.record(ai_type, time.monotonic() - started, False)
+            record_llm_call(ai_type, model, time.monotonic() - started, False)
+            span.record_error(e)
+            raise
+        finally:
+            span.set(response_chars=sum(len(chunk) for chunk in chunks))
+            span.finish()
+        provider_health.record(ai_type, time.monotonic() - started, True)
+        record_llm_call(ai_type, model, time.monotonic() - started, True)
+    if key and chunks:
+        llm_cache.put(key, ''.join(chunks))
+
+def configured_providers():
+    return [ai_type for ai_type, provider in providers.items() if provider.is_configured()]
+
+def provider_max_tokens():
+    return {ai_type: provider.max_tokens for ai_type, provider in providers.items()}
+
+def _cancellable_request(prompt, ai_type, use_cache, cancel, json_mode=False):
+    # 스트리밍으로 받으면서 cancel 이 설정되면 바로 스트림을 닫아 연결을 반환한다
+    chunks = []
+    stream = gpt_request_stream(prompt, ai_type, use_cache, json_mode)
+    try:
+        for delta in stream:
+            if cancel.is_set():
+                return None
+            chunks.append(delta)
+    finally:
+        stream.close()
+    return ''.join(chunks)
+
+def _hedged_request(prompt, ai_type, use_cache, cancel, max_retries, json_mode=False):
+    # limiter 대기, 재시도 대기 중에도 cancel 을 확인하고, 취소된 뒤에는 재시도하지 않는다
+    with cancellable(cancel):
+        try:
+            return call_with_retry(lambda: _cancellable_request(prompt, ai_type, use_cache, cancel, json_mode),
+                                   max_retries, ai_type)
+        except RequestCancelled:
+            return None
+
+# Helper function to retry transient errors (rate limit, timeout, 5xx, overload) of every provider
+# json_mode 면 provider 의 JSON 출력 모드를 쓴다 (GPT: response_format, Anthropic: '{' prefill)
+def gpt_request_with_retry(prompt, ai_type=AiType.GPT, max_retries=5, use_cache=True, hedge=None, json_mode=False):
+    if hedge is None:
+        hedge = HEDGING_ENABLED
+    candidates = choose_providers(ai_type, configured_providers(), provider_max_tokens())
+    with stage('llm', provider=candidates[0]):
+        if not hedge or len(candidates) == 1:
+            return call_with_retry(lambda: gpt_request(prompt, candidates[0], use_cache, json_mode), max_retries,
+                                   candidates[0])
+        return hedged_call(candidates, lambda hedge_type, cancel: _hedged_request(
+            prompt, hedge_type, use_cache, cancel, max_retries, json_mode))
+
+# 스트리밍은 첫 토큰을 받기 전에 발생한 에러만 재시도한다 (이미 보낸 토큰은 되돌릴 수 없음)
+# hedge 면 첫 토큰이 늦을 때 다른 provider 의 스트림을 하나 더 열고 먼저 토큰을 낸 쪽을 쓴다
+def gpt_request_stream_with_retry(prompt, ai_type=AiType.GPT, max_retries=5, use_cache=True, json_mode=False,
+                                  hedge=None):
+    if hedge is None:
+        hedge = HEDGING_ENABLED
+    candidates = choose_providers(ai_type, configured_providers(), provider_max_tokens())
+    stage_started = time.perf_counter()
+    try:
+        if not hedge or len(candidates) == 1:
+            yield from _stream_with_retry(prompt, candidates[0], max_retries, use_cache, json_mode)
+        else:
+            yield from hedged_stream(candidates, lambda hedge_type, cancel: _hedged_stream(
+                prompt, hedge_type, max_retries, use_cache, cancel, json_mode))
+    finally:
+        stage_duration.observe(time.perf_counter() - stage_started, 'llm')
+
+def _stream_with_retry(prompt, ai_type, max_retries, use_cache, json_mode=False):
     for attempt in range(max_retries):
+        started = False
+        try:
+            for delta in gpt_request_stream(prompt, ai_type, use_cache, json_mode):
+                started = True
+                yield delta
+            return
+        except RequestCancelled:
+            raise
+        except Exception as e:
+            if started or not is_transient_error(e) or attempt == max_retries - 1:
+                raise
+            delay = backoff_delay(attempt)
+            llm_retries.inc(ai_type, type(e).__name__)
+            tracing.add_event('retry', provider=ai_type, attempt=attempt + 1, error=type(e).__name__, delay=delay)
+            print(f"Transient error ({type(e).__name__}: {e}). Retrying in {delay:.1f} seconds...")
+            cancellable_sleep(delay)
+
+def _hedged_stream(prompt, ai_type, max_retries, use_cache, cancel, json_mode=False):
+    # limiter 대기, 재시도 대기 중에도 cancel 을 확인하고, 취소된 뒤에는 재시도하지 않는다
+    with cancellable(cancel):
         try:
-            return gpt_request(prompt, ai_type)
-        except openai.RateLimitError as e:
-            retry_after = e.response.headers.get("Retry-After", 20)  # Default to 20 seconds
-            print(f"Rate limit exceeded. Retrying in {retry_after} seconds...")
-            time.sleep(float(retry_after))
-    raise Exception("Rate limit exceeded after retries")
+            yield from _stream_with_retry(prompt, ai_type, max_retries, use_cache, json_mode)
+        except RequestCancelled:
+            return
@@ -0,0 +1,4 @@
+class AiType:
+    GPT = 'gpt'
+    ANTHROPIC = 'anthropic'
+    CLOVARX = 'clovar'
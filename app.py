@@ -1,21 +1,60 @@
+import hashlib
 import json
 import os
 import re
 import sys
 import threading
-import subprocess
-import shlex
 import time
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, g, render_template, request, jsonify
 from config import Config
-from ai_models import gpt_request_with_retry
+from ai_models import gpt_request_with_retry, gpt_request_stream_with_retry
+from jobs import JobStore, JobQueue, FileStatus, file_key
+from worker_pool import worker_pool
+from llm_cache import llm_cache
+from sse import format_sse, sse_response, resume_offset
+from scheduler import DependencyScheduler, spec_fingerprints, completed_future, FINGERPRINT_FILE
+from plan_stream import PlanStreamParser
+from structured_output import (request_structured, parse_structured, StructuredOutputError, CALL_CHART_SCHEMA,
+                               CODE_STRUCTURE_SCHEMA, FILE_EDITS_SCHEMA, stats as structured_output_stats)
+from file_index import file_index
+from storage import storage
+from project_context import ProjectContext, ProjectContextError
+from context_builder import build_file_context, merge_files, context_key, ContextBudgetError
+from symbol_index import symbol_index, PROJECT_META_FILES
+from patching import apply_patch, is_patch, PATCH_PROMPT
+from runner import runner_pool, RunnerError, PREWARM_ENABLED
+from env_cache import env_cache, EnvBuildError
+from metrics import metrics, http_duration, stage, CONTENT_TYPE as METRICS_CONTENT_TYPE
+import tracing
 
 app = Flask(__name__)
 app.config.from_object(Config)
 
-# Global variables for account and project GUIDs
-account_guid = ''
-project_guid = ''
+job_store = JobStore(app.config['JOB_STORE_DIR'])
+job_queue = JobQueue(job_store, app.config['JOB_WORKERS'])
+
+# /project_logs 에서 한 번에 돌려주는 기본 줄 수, 요청할 수 있는 최대 줄 수, offset 을 주지 않았을 때 보여주는 마지막 줄 수
+PROJECT_LOG_BATCH = 500
+PROJECT_LOG_MAX_BATCH = 5000
+PROJECT_LOG_TAIL = 200
+
+# 'full' 은 파일 전체, 'patch' 는 search/replace 블록으로 응답받음. 요청의 response_mode 로 바꿀 수 있음
+DEFAULT_RESPONSE_MODE = os.environ.get('LLM_RESPONSE_MODE') or 'full'
+
+# 이미 다른 곳에서 세고 있는 값은 /metrics 를 읽을 때 가져온다
+metrics.collector('generation_jobs', '이 프로세스의 상태별 생성 작업 수', 'gauge', ('status',),
+                  lambda: (((status,), count) for status, count in job_store.status_counts().items()))
+metrics.collector('job_queue_size', '워커를 기다리는 생성 작업 수', 'gauge', (), lambda: [((), job_queue.qsize())])
+metrics.collector('process_threads', '프로세스의 스레드 수', 'gauge', (), lambda: [((), threading.active_count())])
+metrics.collector('llm_cache_lookups_total', 'LLM 캐시 조회 결과', 'counter', ('result',),
+                  lambda: (((result,), llm_cache.stats()[result]) for result in ('memory_hits', 'disk_hits', 'misses')))
+metrics.collector('llm_cache_hit_ratio', 'LLM 캐시 적중률', 'gauge', (), lambda: [((), llm_cache.stats()['hit_rate'])])
+metrics.collector('structured_output_total', '스키마별 JSON 응답 처리 결과', 'counter', ('schema', 'result'),
+                  lambda: (((schema, result), counts[result])
+                           for schema, counts in structured_output_stats.snapshot().items()
+                           for result in ('parsed', 'repaired', 'retried', 'failed')))
+metrics.collector('file_index_content_bytes', '파일 인덱스가 메모리에 들고 있는 내용 크기', 'gauge', (),
+                  lambda: [((), file_index.stats()['content_bytes'])])
 
 
 def validate_flowchart(project_description, flowchart):
@@ -113,6 +152,82 @@ def construct_api_prompt(project_description, function_call_chart):
     return prompt
 
 
+@app.errorhandler(ProjectContextError)
+def handle_project_context_error(e):
+    return jsonify({'error': str(e)}), 400
+
+
+@app.errorhandler(ContextBudgetError)
+def handle_context_budget_error(e):
+    return jsonify({'error': str(e)}), 400
+
+
+def profile_requested():
+    # X-Profile: 1 헤더나 요청 본문의 "profile": true 로 켠다. 서버에서 TRACE_PROFILE_ENABLED 를 켜야 받아들인다
+    if not tracing.PROFILE_ENABLED:
+        return False
+    if request.headers.get('X-Profile') == '1':
+        return True
+    data = request.get_json(silent=True)
+    return isinstance(data, dict) and data.get('profile') is True
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    # 생성/수정 요청(POST)만 추적한다. 조회(GET)는 너무 잦고 단계가 없다
+    if request.method == 'POST':
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        profile = profile_requested()
+        root = tracing.start_trace(f'POST {route}', traceparent=request.headers.get('traceparent'),
+                                   profile=profile, **{'http.method': 'POST', 'http.route': route})
+        g.trace_root = root
+        g.trace_scope = tracing.trace(root, profile)
+        g.trace_scope.__enter__()
+
+
+@app.after_request
+def record_request_duration(response):
+    # 스트리밍(SSE) 응답은 본문을 다 보내기 전에 여기를 지나므로 응답을 시작할 때까지의 시간이다
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        http_duration.observe(time.perf_counter() - started, request.method, route, str(response.status_code))
+    root = g.get('trace_root')
+    if root is not None and root.trace_id:
+        root.set(**{'http.status_code': response.status_code})
+        response.headers['X-Trace-Id'] = root.trace_id
+        response.headers['traceparent'] = tracing.format_traceparent(root)
+    return response
+
+
+@app.teardown_request
+def finish_request_trace(exc):
+    scope = g.pop('trace_scope', None)
+    if scope is None:
+        return
+    scope.__exit__(None, None, None)
+    root = g.pop('trace_root')
+    if exc is not None:
+        root.record_error(exc)
+    root.finish()
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+
+@app.route('/trace/<trace_id>', methods=['GET'])
+def trace_detail(trace_id):
+    # 작업이 아직 진행 중이면 끝난 span 까지만 보인다
+    spans = tracing.exporter.find(trace_id)
+    profile = tracing.load_profile_summary(trace_id)
+    if not spans and profile is None:
+        return jsonify({'error': 'trace 를 찾을 수 없습니다.'}), 404
+    return jsonify({'trace_id': trace_id, 'spans': spans, 'profile': profile})
+
+
 @app.route('/', methods=['GET'])
 def index():
     return render_template('index.html')
@@ -120,11 +235,28 @@ def index():
 
 @app.route('/generate_code', methods=['POST'])
 def generate_code():
-    global account_guid, project_guid
+    data = request.get_json()
+    ctx = ProjectContext.from_request(data)
+    use_cache = not data.get('bypass_cache', False)
+    project_description = data['project_description']
+    flowchart = data['flowchart']
+
+    is_valid, error_message = validate_flowchart(project_description, flowchart)
+    if not is_valid:
+        return jsonify({'error': error_message}), 400
+
+    constructed_prompt = build_generate_code_prompt(ctx, project_description, flowchart)
+    response = gpt_request_with_retry(constructed_prompt, use_cache=use_cache, json_mode=True)
+    formatted_response = finish_generate_code(ctx, project_description, flowchart, response, use_cache)
 
+    return jsonify({'formatted_response': formatted_response})
+
+
+@app.route('/generate_code_stream', methods=['POST'])
+def generate_code_stream():
     data = request.get_json()
-    account_guid = data['account_guid']
-    project_guid = data['project_guid']
+    ctx = ProjectContext.from_request(data)
+    use_cache = not data.get('bypass_cache', False)
     project_description = data['project_description']
     flowchart = data['flowchart']
 
@@ -132,13 +264,31 @@ def generate_code():
     if not is_valid:
         return jsonify({'error': error_message}), 400
 
-    path = f'code/{account_guid}/{project_guid}/project_data.json'
-    if os.path.exists(path):
-        with open(path, 'r', encoding='utf-8') as f:
-            project_data = json.load(f)
-            existing_description = project_data['project_description']
-            is_new_project = False
-            has_been_requested_before = 'gpt_request' in project_data
+    constructed_prompt = build_generate_code_prompt(ctx, project_description, flowchart)
+
+    def events():
+        chunks = []
+        try:
+            for delta in gpt_request_stream_with_retry(constructed_prompt, use_cache=use_cache, json_mode=True):
+                chunks.append(delta)
+                yield format_sse({'delta': delta}, event='token')
+            formatted_response = finish_generate_code(ctx, project_description, flowchart, ''.join(chunks),
+                                                      use_cache)
+        except Exception as e:
+            yield format_sse({'error': str(e)}, event='error')
+            return
+        yield format_sse({'formatted_response': formatted_response}, event='done')
+
+    return sse_response(events())
+
+
+@stage('prompt_build')
+def build_generate_code_prompt(ctx, project_description, flowchart):
+    if storage.exists(*ctx, 'project_data.json'):
+        project_data = load_project_json(ctx, 'project_data.json')
+        existing_description = project_data['project_description']
+        is_new_project = False
+        has_been_requested_before = 'gpt_request' in project_data
     else:
         existing_description = ""
         is_new_project = True
@@ -147,88 +297,278 @@ def generate_code():
     if existing_description != project_description:
         is_new_project = True
 
-    constructed_prompt = construct_prompt(
+    return construct_prompt(
         project_description,
         flowchart,
         is_new_project,
         has_been_requested_before
     )
 
-    response = gpt_request_with_retry(constructed_prompt)
+
+def finish_generate_code(ctx, project_description, flowchart, response, use_cache=True):
     project_data = {
-        'account_guid': account_guid,
-        'project_guid': project_guid,
+        'account_guid': ctx.account_guid,
+        'project_guid': ctx.project_guid,
         'project_description': project_description,
         'flowchart': flowchart,
         'gpt_request': response
     }
-    save_project_data(project_data)
-    formatted_response = format_response(response)
-    save_function_call_chart(formatted_response)
-
-    return jsonify({'formatted_response': formatted_response})
+    save_project_data(ctx, project_data)
+    formatted_response = format_response(response, use_cache)
+    save_function_call_chart(ctx, formatted_response)
+    return formatted_response
 
 
 @app.route('/modify_function_call_chart', methods=['POST'])
 def modify_function_call_chart():
-    global account_guid, project_guid
+    data = request.get_json()
+    ctx = ProjectContext.from_request(data)
+    use_cache = not data.get('bypass_cache', False)
+    modification_prompt = data['modification_prompt']
+
+    if not storage.exists(*ctx, 'project_data.json'):
+        return jsonify({'error': '프로젝트를 찾을 수 없습니다.'}), 404
+
+    project_data = load_project_json(ctx, 'project_data.json')
+
+    constructed_prompt = build_modify_function_call_chart_prompt(project_data, modification_prompt)
 
+    response = gpt_request_with_retry(constructed_prompt, use_cache=use_cache, json_mode=True)
+    formatted_response = finish_modify_function_call_chart(ctx, project_data, modification_prompt, response, use_cache)
+
+    return jsonify({'formatted_response': formatted_response})
+
+
+@app.route('/modify_function_call_chart_stream', methods=['POST'])
+def modify_function_call_chart_stream():
     data = request.get_json()
-    account_guid = data['account_guid']
-    project_guid = data['project_guid']
+    ctx = ProjectContext.from_request(data)
+    use_cache = not data.get('bypass_cache', False)
     modification_prompt = data['modification_prompt']
 
-    path = f'code/{account_guid}/{project_guid}/project_data.json'
-    if not os.path.exists(path):
+    if not storage.exists(*ctx, 'project_data.json'):
         return jsonify({'error': '프로젝트를 찾을 수 없습니다.'}), 404
 
-    with open(path, 'r', encoding='utf-8') as f:
-        project_data = json.load(f)
+    project_data = load_project_json(ctx, 'project_data.json')
+
+    constructed_prompt = build_modify_function_call_chart_prompt(project_data, modification_prompt)
 
+    def events():
+        chunks = []
+        try:
+            for delta in gpt_request_stream_with_retry(constructed_prompt, use_cache=use_cache, json_mode=True):
+                chunks.append(delta)
+                yield format_sse({'delta': delta}, event='token')
+            formatted_response = finish_modify_function_call_chart(ctx, project_data, modification_prompt,
+                                                                   ''.join(chunks), use_cache)
+        except Exception as e:
+            yield format_sse({'error': str(e)}, event='error')
+            return
+        yield format_sse({'formatted_response': formatted_response}, event='done')
+
+    return sse_response(events())
+
+
+@stage('prompt_build')
+def build_modify_function_call_chart_prompt(project_data, modification_prompt):
     existing_chart = project_data.get('gpt_request', "")
     constructed_prompt = existing_chart + "\n\n" + modification_prompt
     constructed_prompt += "답변은 json으로만 해줘. 파싱하기 위함이라 다른걸로 하면 안돼."
+    return constructed_prompt
 
-    response = gpt_request_with_retry(constructed_prompt)
-    print(response)
-    try:
-        formatted_response = format_response(response)
-    except json.JSONDecodeError as e:
-        return jsonify({'error': '응답을 JSON으로 파싱하는데 실패했습니다.', 'details': str(e)}), 500
+
+def finish_modify_function_call_chart(ctx, project_data, modification_prompt, response, use_cache=True):
+    formatted_response = format_response(response, use_cache)
 
     # 수정된 Flowchart를 project_data에 업데이트하여 저장
     project_data['flowchart'] = modification_prompt
     project_data['gpt_request'] = response
-    save_project_data(project_data)  # 프로젝트 데이터를 저장
-
-    save_function_call_chart(formatted_response)
-
-    return jsonify({'formatted_response': formatted_response})
+    save_project_data(ctx, project_data)  # 프로젝트 데이터를 저장
 
+    save_function_call_chart(ctx, formatted_response)
+    return formatted_response
 
 
 @app.route('/generate_project_code', methods=['POST'])
 def generate_project_code():
-    global account_guid, project_guid
-
     data = request.get_json()
-    account_guid = data['account_guid']
-    project_guid = data['project_guid']
+    ctx = ProjectContext.from_request(data)
+    use_cache = not data.get('bypass_cache', False)
+    full_regenerate = data.get('full_regenerate', False)
 
-    path = f'code/{account_guid}/{project_guid}/project_data.json'
-    function_call_path = f'code/{account_guid}/{project_guid}/function_call_chart.txt'
-    if not os.path.exists(path):
+    if not storage.exists(*ctx, 'project_data.json'):
         return jsonify({'error': 'Project not found'}), 404
-    if not os.path.exists(function_call_path):
+    if not storage.exists(*ctx, 'function_call_chart.txt'):
         return jsonify({'error': 'function call chart not found'}), 404
 
-    with open(path, 'r', encoding='utf-8') as f:
-        project_data = json.load(f)
-        project_description = project_data['project_description']
-        flowchart = project_data['flowchart']
+    # 생성 작업은 백그라운드 워커에서 실행하고, 진행 상황은 /job_status 로 조회
+    job = job_store.create('generate_project_code', *ctx)
+    job_queue.submit(job['job_id'], run_generate_project_code, ctx, use_cache, full_regenerate)
+
+    return jsonify({'job_id': job['job_id'], 'status': job['status']}), 202
+
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    stats = llm_cache.stats()
+    stats['file_index'] = file_index.stats()
+    stats['symbol_index'] = symbol_index.stats()
+    stats['structured_output'] = structured_output_stats.snapshot()
+    return jsonify(stats)
+
+
+@app.route('/symbol_lookup', methods=['POST'])
+def symbol_lookup():
+    data = request.get_json()
+    ctx = ProjectContext.from_request(data)
+    symbol = data.get('symbol')
+    if not symbol or not isinstance(symbol, str):
+        return jsonify({'error': 'symbol 이 필요합니다.'}), 400
+    index = symbol_index.get(ctx.account_guid, ctx.project_guid)
+    return jsonify({
+        'symbol': symbol,
+        'definitions': index.find(symbol),
+        'files': index.files_touching(symbol),
+    })
+
+
+@app.route('/code_structure_report', methods=['POST'])
+def code_structure_report():
+    data = request.get_json()
+    ctx = ProjectContext.from_request(data)
+
+    code_structure = load_project_json(ctx, 'code_structure.json')
+    if code_structure is None:
+        return jsonify({'error': '프로젝트를 찾을 수 없습니다.'}), 404
+
+    index = symbol_index.get(*ctx)
+    report = index.mismatch_report(code_structure)
+    report['import_graph'] = index.import_graph()
+    return jsonify(report)
+
+
+@app.route('/job_status/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': '작업을 찾을 수 없습니다.'}), 404
+
+    files = list(job['files'].values())
+    job['files'] = files
+    job['progress'] = {
+        'total': len(files),
+        'done': sum(1 for f in files if f['status'] == FileStatus.DONE),
+        'failed': sum(1 for f in files if f['status'] == FileStatus.FAILED),
+    }
+    return jsonify(job)
+
+
+@app.route('/job_stream/<job_id>', methods=['GET'])
+def job_stream(job_id):
+    if job_store.get(job_id) is None:
+        return jsonify({'error': '작업을 찾을 수 없습니다.'}), 404
+
+    # EventSource 가 재연결하면 Last-Event-ID 부터 이어서 보낸다
+    offset = resume_offset(request.headers.get('Last-Event-ID'), request.args.get('offset'))
+
+    def events():
+        position = offset
+        while True:
+            start, output, finished = job_store.wait_output(job_id, position)
+            if start > position:
+                # 메모리 한도 때문에 버려진 출력은 건너뛴다
+                yield format_sse({'dropped': start - position}, event='dropped')
+                position = start
+            for item in output:
+                position += 1
+                yield format_sse(item, event=item['type'], event_id=position)
+            if finished and not output:
+                job = job_store.get(job_id)
+                yield format_sse({'status': job['status'], 'error': job['error']}, event='done')
+                return
+            if not output:
+                yield ': keep-alive\n\n'
+
+    return sse_response(events())
+
+
+def run_generate_project_code(job_id, ctx, use_cache=True, full_regenerate=False):
+    job_store.update(job_id, stage='planning')
+    prompt, function_call_chart_content = build_project_plan_prompt(ctx)
+    previous = load_previous_fingerprints(ctx, full_regenerate)
+    parser = PlanStreamParser()
+    state = {'code_structure': None, 'reused': {}}
+    # 파일은 작업 스레드가 설계를 받는 중(plan span 안)에도 제출하므로, 파일 span 이 plan 밑에 들어가지 않도록
+    # 작업의 trace 를 잡아두었다가 되살린다
+    job_trace = tracing.capture()
+
+    def submit(file_info, dependency_context):
+        key = file_key(file_info.get('path', ''), file_info.get('fname', ''))
+        if key in state['reused']:
+            return completed_future(state['reused'][key])
+        # 설계가 끝나기 전에 시작한 파일은 그때까지 받은 파일 목록을 설계로 쓴다
+        code_structure = state['code_structure'] or {'Files': list(parser.files)}
+        with tracing.restore(job_trace):
+            return worker_pool.submit(implement_file_for_job, job_id, ctx, file_info, code_structure,
+                                      dependency_context, use_cache)
+
+    # sqlite backend 에서는 생성 결과를 한 트랜잭션으로 모아서 작업이 끝날 때 원자적으로 저장하고,
+    # 파일 시스템 backend 에서는 파일이 끝나는 대로 바로 저장한다
+    with storage.job_transaction(*ctx):
+        # 의존하는 파일이 먼저 만들어지도록 순서를 정하고, 준비된 파일은 공용 worker pool 에서 병렬로 구현
+        scheduler = DependencyScheduler(submit)
+        try:
+            with tracing.span('plan'):
+                if app.config['PIPELINE_PLAN'] and not previous:
+                    # 이전 생성 기록이 없으면 설계를 스트리밍으로 받으면서 완성된 파일부터 구현을 시작
+                    chunks = []
+                    for delta in gpt_request_stream_with_retry(prompt, use_cache=use_cache, json_mode=True):
+                        chunks.append(delta)
+                        for file_info in parser.feed(delta):
+                            start_streamed_file(job_id, scheduler, file_info)
+                    response = ''.join(chunks)
+                else:
+                    response = gpt_request_with_retry(prompt, use_cache=use_cache, json_mode=True)
+                code_structure = parse_code_structure(response, use_cache)
+            if not code_structure:
+                raise ValueError('코드 구조를 파싱하지 못했습니다.')
+        except Exception:
+            # 먼저 시작한 파일이 트랜잭션이 끝난 뒤에 쓰지 않도록 기다린다
+            scheduler.join()
+            raise
+
+        state['code_structure'] = code_structure
+        files, fingerprints, reused = plan_project_files(
+            job_id, ctx, code_structure, function_call_chart_content, previous)
+        state['reused'].update(reused)
+        scheduler.close(files)
+        results = scheduler.join()
+        save_generated_fingerprints(ctx, fingerprints, results, reused)
+
+    prewarm_project(ctx)
+    return code_structure
 
-    with open(function_call_path, 'r', encoding='utf-8') as f:
-        function_call_chart_content = f.read()
+
+def start_streamed_file(job_id, scheduler, file_info):
+    """설계 스트림에서 완성된 파일 하나를 작업에 등록하고 스케줄러에 넘긴다."""
+    register_streamed_file(job_id, file_info)
+    scheduler.add(file_info)
+
+
+def register_streamed_file(job_id, file_info):
+    """설계 스트림에서 완성된 파일 하나를 작업에 대기 중으로 등록한다."""
+    job_store.set_file_status(job_id, file_info.get('path', ''), file_info['fname'], FileStatus.PENDING)
+    job_store.update(job_id, stage='implementing')
+
+
+@stage('prompt_build')
+def build_project_plan_prompt(ctx):
+    """코드 파일 리스트(설계)를 요청하는 프롬프트와 함수 호출표. 반환값은 (prompt, function_call_chart)."""
+    project_data = load_project_json(ctx, 'project_data.json')
+    project_description = project_data['project_description']
+    flowchart = project_data['flowchart']
+
+    function_call_chart_content = read_project_file(ctx, 'function_call_chart.txt')
 
     prompt = f"{project_description}\n\n{flowchart}\n\n{function_call_chart_content}\n\n"
     prompt += """
@@ -254,10 +594,20 @@ def generate_project_code():
     }
     """
 
-    response = gpt_request_with_retry(prompt)
-    print(response)
-    code_structure = parse_code_structure(response)
-    save_code_structure(code_structure)
+    return prompt, function_call_chart_content
+
+
+def load_previous_fingerprints(ctx, full_regenerate=False):
+    return {} if full_regenerate else (load_project_json(ctx, FINGERPRINT_FILE) or {})
+
+
+def plan_project_files(job_id, ctx, code_structure, function_call_chart_content, previous):
+    """설계를 저장하고 파일별 명세 fingerprint 를 계산한다.
+
+    반환값은 (files, fingerprints, reused). reused 는 fingerprint 가 previous(이전 생성 때)와 같고 파일이
+    남아 있어서 다시 만들지 않을 파일의 {key: 내용} 이다.
+    """
+    save_code_structure(ctx, code_structure)
 
     # API 목록 생성
     # api_prompt = construct_api_prompt(project_description, function_call_chart)
@@ -266,114 +616,187 @@ def generate_project_code():
     # save_api_list(api_list)
 
     files = code_structure.get('Files', [])
-    threads = []
+    job_store.set_files(job_id, files)
+    job_store.update(job_id, stage='implementing')
 
+    # 명세 fingerprint 가 이전 생성 때와 같고 파일이 남아 있으면 다시 만들지 않음
+    fingerprints = spec_fingerprints(files, function_call_chart_content)
+    reused = {}
     for file_info in files:
-        # t = threading.Thread(target=implement_file, args=(file_info, code_structure, api_list))
-        t = threading.Thread(target=implement_file, args=(file_info, code_structure))
-        threads.append(t)
-        t.start()
+        path = file_info.get('path', '')
+        fname = file_info.get('fname', '')
+        key = file_key(path, fname)
+        if previous.get(key) == fingerprints[key]:
+            content = read_project_file(ctx, f'{path}/{fname}')
+            if content is not None:
+                reused[key] = content
+                job_store.set_file_status(job_id, path, fname, FileStatus.DONE)
+    return files, fingerprints, reused
 
-    for t in threads:
-        t.join()
 
-    return jsonify(code_structure)
+def save_generated_fingerprints(ctx, fingerprints, results, reused):
+    # 실패한 파일은 fingerprint 를 남기지 않아서 다음 번에 다시 생성
+    save_fingerprints(ctx, {key: fingerprint for key, fingerprint in fingerprints.items() if results.get(key)})
+    print(f"Regenerated {len(fingerprints) - len(reused)} / {len(fingerprints)} files")
+
+
+def implement_file_for_job(job_id, ctx, file_info, full_code_structure, dependency_context='', use_cache=True):
+    path = file_info.get('path', '')
+    fname = file_info.get('fname', '')
+    job_store.set_file_status(job_id, path, fname, FileStatus.RUNNING)
+    try:
+        with tracing.span('implement_file', path=path, fname=fname):
+            file_content = implement_file(ctx, file_info, full_code_structure,
+                                          on_token=lambda delta: job_store.append_output(job_id, path, fname, delta),
+                                          use_cache=use_cache, dependency_context=dependency_context)
+    except Exception as e:
+        print(f"Failed to implement file {fname}: {e}")
+        job_store.set_file_status(job_id, path, fname, FileStatus.FAILED, str(e))
+        return None
+    job_store.set_file_status(job_id, path, fname, FileStatus.DONE)
+    return file_content
 
 
 @app.route('/update_project_code', methods=['POST'])
 def update_project_code():
-    global account_guid, project_guid
-
     data = request.get_json()
-    account_guid = data['account_guid']
-    project_guid = data['project_guid']
+    ctx = ProjectContext.from_request(data)
+    use_cache = not data.get('bypass_cache', False)
+    patch_mode = data.get('response_mode', DEFAULT_RESPONSE_MODE) == 'patch'
 
-    project_data_path = f'code/{account_guid}/{project_guid}/project_data.json'
-    code_structure_path = f'code/{account_guid}/{project_guid}/code_structure.json'
-
-    if not os.path.exists(project_data_path) or not os.path.exists(code_structure_path):
+    if (not storage.exists(*ctx, 'project_data.json')
+            or not storage.exists(*ctx, 'code_structure.json')):
         return jsonify({'error': '프로젝트를 찾을 수 없습니다.'}), 404
 
-    with open(project_data_path, 'r', encoding='utf-8') as f:
-        project_data = json.load(f)
-        project_description = project_data['project_description']
-        flowchart = project_data['flowchart']
-        function_call_chart = project_data['gpt_request']
+    project_data = load_project_json(ctx, 'project_data.json')
+    project_description = project_data['project_description']
+    flowchart = project_data['flowchart']
+    function_call_chart = project_data['gpt_request']
 
-    with open(code_structure_path, 'r', encoding='utf-8') as f:
-        code_structure = json.load(f)
+    code_structure = load_project_json(ctx, 'code_structure.json')
 
-    prompt = f"{project_description}\n\n{flowchart}\n\n{function_call_chart}\n\n"
+    # 토큰 예산 안에서 수정된 flow chart 와 관련이 높은 파일부터 전체 내용을, 나머지는 시그니처만 넣음
+    header, files_section, full_files = build_file_context(
+        code_structure['Files'], project_file_reader(ctx),
+        query=f"{flowchart}\n{function_call_chart}",
+        header=f"{project_description}\n\n{flowchart}\n\n{function_call_chart}\n\n",
+        symbols=symbol_index.get(*ctx))
+    prompt = header
     prompt += "위에 적어 놓은 설명과 수정된 flow chart를 이용해서 기존 코드를 최대한 유지하면서 새로운 기능만 추가해줘. 기존 기능은 수정하지 말고, 새로운 기능만 반영할 수 있도록 코드를 수정해줘. 답변은 json으로만 해줘. 파싱하기 위함이라 다른걸로 하면 안돼."
 
-    # 선택한 파일들의 내용을 포함
     prompt += "기존 파일들의 내용:\n"
-    for file_info in code_structure['Files']:
-        file_path = f'code/{account_guid}/{project_guid}/{file_info["path"]}/{file_info["fname"]}'
-        if os.path.exists(file_path):
-            with open(file_path, 'r', encoding='utf-8') as f:
-                file_content = f.read()
-            prompt += f"파일: {file_info['fname']} 내용:\n{file_content}\n\n"
+    prompt += files_section
 
-    prompt += "위 파일들을 수정하여 새로운 코드를 생성해주세요. JSON 형식으로만 응답해줘."
+    if patch_mode:
+        prompt += PATCH_PROMPT
+    else:
+        prompt += "위 파일들을 수정하여 새로운 코드를 생성해주세요. JSON 형식으로만 응답해줘."
 
-    response = gpt_request_with_retry(prompt)
-    print(response)
     try:
-        if response.strip().startswith("```json"):
-            response = response.strip()[7:-3].strip()
-        if not response:
-            return jsonify({'error': '빈 JSON 응답입니다.'}), 500
-        response_json = json.loads(response)
-    except json.JSONDecodeError as e:
-        return jsonify({'error': '응답을 JSON으로 파싱하는데 실패했습니다.', 'details': str(e)}), 500
-
-    # 파일 저장 로직 수정
+        response_json = request_structured(prompt, FILE_EDITS_SCHEMA, use_cache=use_cache)
+    except StructuredOutputError as e:
+        return jsonify({'error': str(e), 'details': '; '.join(e.details)}), 500
+
+    patch_report = save_file_changes(ctx, response_json, code_structure, prompt, use_cache, full_files)
+    return jsonify(file_changes_result(response_json, patch_report, patch_mode))
+
+
+def save_file_changes(ctx, response_json, code_structure, prompt, use_cache=True, full_files=None):
+    """LLM 이 돌려준 파일 변경을 저장한다. 전체 내용이면 그대로, patch 면 기존 파일에 적용한다.
+
+    patch 블록이 하나라도 적용되지 않았거나(찾지 못함, 여러 곳과 맞음) 없는 파일에 대한 patch 는
+    그 파일만 전체 내용으로 다시 요청한다. full_files(build_file_context 의 full)가 있으면 프롬프트에 전체 내용을
+    넣지 않은 기존 파일은 전체 내용으로 덮어쓰지 않는다. 반환값은 파일별 적용/거절 내역.
+    """
+    paths = {file['fname']: file.get('path', '') for file in code_structure['Files']}
+
+    def summarized_only(path, fname):
+        # 프롬프트에 요약만 넣은 기존 파일. 전체 내용으로 덮어쓰면 요약에 없던 코드가 사라진다
+        return (full_files is not None and context_key(path, fname) not in full_files
+                and read_project_file(ctx, f'{path}/{fname}') is not None)
+
+    report = {}
+    failed = []
     for fname, file_info in response_json.items():
         # code_structure에서 해당 파일의 경로를 찾음
-        path = ''
-        for file in code_structure['Files']:
-            if file['fname'] == fname:
-                path = file.get('path', '')
-                break
-
-        # file_info가 문자열인지 확인하고, content가 문자열이면 그대로 사용
-        if isinstance(file_info, dict):
+        path = paths.get(fname, '')
+        if not is_patch(file_info) and summarized_only(path, fname):
+            print(f"Skipping full rewrite of {fname}: only its summary was in the prompt")
+            report[fname] = {'applied': [], 'rejected': [], 'skipped': True,
+                             'error': '프롬프트에 요약만 넣은 파일이라 전체 내용으로 덮어쓰지 않았습니다.'}
+            continue
+        if is_patch(file_info):
+            current = read_project_file(ctx, f'{path}/{fname}')
+            if current is None:
+                # 고칠 파일이 없으면 patch 만으로는 내용을 만들 수 없다
+                report[fname] = {'applied': [], 'rejected': [], 'error': '파일이 없어서 patch 를 적용할 수 없습니다.'}
+                failed.append(fname)
+                continue
+            content, result = apply_patch(current, file_info)
+            report[fname] = result.to_dict()
+            if not result.ok:
+                failed.append(fname)
+                continue
+        elif isinstance(file_info, dict):
             content = file_info.get('content', '')
         else:
             content = file_info  # file_info가 문자열일 경우 그대로 content로 사용
 
-        save_file(path, fname, content)
+        save_file(ctx, path, fname, content)
+
+    # 요약만 넣은 파일은 patch 가 실패해도 전체 내용으로 다시 받지 않는다
+    for fname in [fname for fname in failed if summarized_only(paths.get(fname, ''), fname)]:
+        failed.remove(fname)
+        report[fname]['fallback'] = 'failed'
+        report[fname]['error'] = '프롬프트에 요약만 넣은 파일이라 전체 내용으로 다시 받지 않았습니다.'
+    if failed:
+        print(f"Patch rejected for {failed}. Requesting full files")
+        fallback_prompt = prompt + f"\n\n다음 파일들은 patch 를 적용하지 못했어: {', '.join(failed)}\n"
+        fallback_prompt += "이 파일들만 수정이 반영된 전체 내용으로 다시 줘. 답변은 json으로만 해줘. {\"파일이름\": \"전체 내용\"}"
+        try:
+            fallback_files = request_structured(fallback_prompt, FILE_EDITS_SCHEMA, use_cache=use_cache)
+        except StructuredOutputError as e:
+            print(f"Full file fallback failed: {e}")
+            fallback_files = {}
+        for fname in failed:
+            content = fallback_files.get(fname)
+            if isinstance(content, dict):
+                content = content.get('content')
+            if content:
+                save_file(ctx, paths.get(fname, ''), fname, content)
+                report[fname]['fallback'] = 'full_file'
+            else:
+                report[fname]['fallback'] = 'failed'
+    return report
 
-    return jsonify({'status': 'success', 'files': response_json})
 
+def file_changes_result(response_json, patch_report, patch_mode):
+    """파일 수정 route 의 응답. 전체 내용으로 다시 받는 것까지 실패한 파일이 있으면 status 가 partial 이다."""
+    failed = [fname for fname, item in patch_report.items() if item.get('fallback') == 'failed' or item.get('skipped')]
+    result = {'status': 'partial' if failed else 'success', 'files': response_json}
+    if failed:
+        result['failed_files'] = failed
+        result['error'] = f"다음 파일은 수정을 적용하지 못했습니다: {', '.join(failed)}"
+    if patch_mode or failed:
+        result['patch_report'] = patch_report
+    return result
 
-def save_modified_files(modified_files):
-    global account_guid, project_guid
 
-    for file_info in modified_files.get('modified_files', []):
-        path = file_info['path']
-        content = file_info['content']
-        file_path = f'code/{account_guid}/{project_guid}/{path}'
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        with open(file_path, 'w') as file:
-            file.write(content)
+def save_modified_files(ctx, modified_files):
+    with storage.transaction(*ctx):
+        for file_info in modified_files.get('modified_files', []):
+            storage.write(*ctx, file_info['path'], file_info['content'])
 
 
 @app.route('/load_project', methods=['POST'])
 def load_project():
-    global account_guid, project_guid
-
     data = request.get_json()
-    account_guid = data['account_guid']
-    project_guid = data['project_guid']
-
-    path = f'code/{account_guid}/{project_guid}/project_data.json'
-    if os.path.exists(path):
-        with open(path, 'r', encoding='utf-8') as f:
-            project_data = json.load(f)
-        function_call_chart = load_function_call_chart()
-        files = load_file_list(account_guid, project_guid)
+    ctx = ProjectContext.from_request(data)
+
+    if storage.exists(*ctx, 'project_data.json'):
+        project_data = load_project_json(ctx, 'project_data.json')
+        function_call_chart = load_function_call_chart(ctx)
+        files = load_file_list(ctx)
         return jsonify(
             {"exists": True, "project_data": project_data, "function_call_chart": function_call_chart, "files": files})
     else:
@@ -382,16 +805,13 @@ def load_project():
 
 @app.route('/get_file_code', methods=['POST'])
 def get_file_code():
-    global account_guid, project_guid
-
     file_info = request.get_json()
+    ctx = ProjectContext.from_request(file_info)
     path = file_info.get('path', '')
     fname = file_info.get('fname', '')
 
-    file_path = f'code/{account_guid}/{project_guid}/{path}/{fname}'
-    if os.path.exists(file_path):
-        with open(file_path, 'r', encoding='utf-8') as file:
-            code = file.read()
+    code = read_project_file(ctx, f'{path}/{fname}')
+    if code is not None:
         return jsonify({"code": code})
     else:
         return jsonify({"code": "파일을 찾을 수 없습니다."}), 404
@@ -399,83 +819,83 @@ def get_file_code():
 
 @app.route('/save_file_code', methods=['POST'])
 def save_file_code():
-    global account_guid, project_guid
-
     data = request.get_json()
+    ctx = ProjectContext.from_request(data)
     path = data.get('path', '')
     fname = data.get('fname', '')
     code = data.get('code', '')
 
-    file_path = f'code/{account_guid}/{project_guid}/{path}/{fname}'
-    with open(file_path, 'w') as file:
-        file.write(code)
+    storage.write(*ctx, f'{path}/{fname}', code)
     return jsonify({"status": "success"})
 
 
-def load_file_list(account_guid, project_guid):
-    path = f'code/{account_guid}/{project_guid}'
-    excluded_files = {'function_call_chart.txt', 'code_structure.json', 'project_data.json'}
+def load_file_list(ctx):
     file_list = []
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            if file not in excluded_files:
-                file_info = {
-                    'path': os.path.relpath(root, path),
-                    'fname': file
-                }
-                file_list.append(file_info)
+    for rel_path in storage.list_files(*ctx):
+        file = os.path.basename(rel_path)
+        if file not in PROJECT_META_FILES:
+            file_info = {
+                'path': os.path.dirname(rel_path) or '.',
+                'fname': file
+            }
+            file_list.append(file_info)
     return file_list
 
 
-def parse_code_structure(response):
-    response = response.strip()
-    print(f"Response: {response}")
-    if response.startswith('{'):
-        try:
-            code_structure = json.loads(response)
-            return code_structure
-        except json.JSONDecodeError as e:
-            print(f"JSON decode error: {e}")
-            return {}
-    else:
-        json_match = re.search(r'```json(.*?)```', response, re.DOTALL)
-        if json_match:
-            json_content = json_match.group(1).strip()
-            print(json_content)
-            try:
-                code_structure = json.loads(json_content)
-                return code_structure
-            except json.JSONDecodeError as e:
-                print(f"JSON decode error: {e}")
-                return {}
-        else:
-            print("No JSON content found.")
-            return {}
-    return {}
+def read_project_file(ctx, rel_path):
+    # 프로젝트 파일 읽기는 모두 storage 를 거침 (fs backend 는 file_index 캐시를 사용)
+    return storage.read(*ctx, rel_path)
 
 
-def save_code_structure(code_structure):
-    global account_guid, project_guid
+def project_file_reader(ctx):
+    def read_file(file_info):
+        return read_project_file(ctx, f'{file_info.get("path", "")}/{file_info["fname"]}')
+    return read_file
 
-    path = f'code/{account_guid}/{project_guid}'
-    os.makedirs(path, exist_ok=True)
-    with open(f'{path}/code_structure.json', 'w') as f:
-        json.dump(code_structure, f, ensure_ascii=False, indent=4)
 
+def load_project_json(ctx, rel_path):
+    content = read_project_file(ctx, rel_path)
+    if content is None:
+        return None
+    return json.loads(content)
 
-def save_api_list(api_list):
-    global account_guid, project_guid
 
-    path = f'code/{account_guid}/{project_guid}'
-    os.makedirs(path, exist_ok=True)
-    with open(f'{path}/api_list.json', 'w') as f:
-        json.dump(api_list, f, ensure_ascii=False, indent=4)
+def parse_code_structure(response, use_cache=True):
+    """설계 응답에서 code_structure 를 꺼낸다. 고쳐도 읽을 수 없으면 {}."""
+    try:
+        return parse_structured(response, CODE_STRUCTURE_SCHEMA, use_cache)
+    except StructuredOutputError as e:
+        print(f"Code structure parse error: {e} {e.details[:3]}")
+        return {}
 
 
-def implement_file(file_info, full_code_structure):
-    global account_guid, project_guid
+def save_code_structure(ctx, code_structure):
+    content = json.dumps(code_structure, ensure_ascii=False, indent=4)
+    storage.write(*ctx, 'code_structure.json', content)
 
-    path = file_info.get('path', '')
+
+def save_api_list(ctx, api_list):
+    storage.write(*ctx, 'api_list.json', json.dumps(api_list, ensure_ascii=False, indent=4))
+
+
+def implement_file(ctx, file_info, full_code_structure, on_token=None, use_cache=True, dependency_context=''):
+    prompt = build_implement_file_prompt(file_info, full_code_structure, dependency_context)
+
+    if on_token is None:
+        response = gpt_request_with_retry(prompt, use_cache=use_cache)
+    else:
+        # 생성되는 코드를 토큰 단위로 전달 (job_stream 으로 브라우저에 전송됨)
+        chunks = []
+        for delta in gpt_request_stream_with_retry(prompt, use_cache=use_cache):
+            chunks.append(delta)
+            on_token(delta)
+        response = ''.join(chunks)
+
+    return finish_implement_file(ctx, file_info, response)
+
+
+@stage('prompt_build')
+def build_implement_file_prompt(file_info, full_code_structure, dependency_context=''):
     fname = file_info.get('fname', '')
     object_name = file_info.get('objectName', '')
     function_list = file_info.get('functionList', [])
@@ -483,25 +903,18 @@ def implement_file(file_info, full_code_structure):
     print(f"Implementing file: {fname}, object_name: {object_name}")
     print(f"Function list: {function_list}")
 
-    # 이전에 생성된 파일들의 내용을 읽어옴
-    previous_files_content = ""
-    base_path = f'code/{account_guid}/{project_guid}/{path}'
-    if os.path.exists(base_path):
-        for root, dirs, files in os.walk(base_path):
-            for file in files:
-                if file != fname:  # 현재 생성 중인 파일은 제외
-                    with open(os.path.join(root, file), 'r', encoding='utf-8') as f:
-                        file_content = f.read()
-                        previous_files_content += f"\n\n# {file} 내용:\n{file_content}\n"
-
     prompt = f"Based on the following code structure and previous file contents, implement the functions for the file {fname}:\n\n"
     prompt += json.dumps(full_code_structure, indent=2)
     prompt += "\n\nConsidering the relationship with other files, make it immediately viable\n"
     prompt += "\n\nPlease pay attention to the import and function name when you create the code\n"
     prompt += "\n\nDo not use files that are not in code structure. For example, do not use html files with different names\n"
 
+    if dependency_context:
+        # 이 파일이 의존하는 파일들은 이미 만들어져 있으므로 실제 시그니처에 맞춰 import/호출하도록 전달
+        prompt += "\n\nThese files are already implemented. Import and call them exactly with these signatures:\n"
+        prompt += dependency_context
+
     prompt += f"\n\nImplement the following functions for {object_name}:\n"
-    # prompt += f"\n\nPrevious files content:\n{previous_files_content}\n"
     # prompt += f"\n\nAPI list:\n{json.dumps(api_list, indent=2)}\n"
 
     if function_list:
@@ -529,15 +942,19 @@ def implement_file(file_info, full_code_structure):
     else:
         prompt += "No specific functions provided."
 
-    response = gpt_request_with_retry(prompt)
+    return prompt
 
-    code_match = re.search(r'```(?:.|\n)*?\n(.*?)```', response, re.DOTALL)
-    if code_match:
-        file_content = code_match.group(1).strip()
-    else:
-        file_content = response
 
-    save_file(path, fname, file_content)
+def finish_implement_file(ctx, file_info, response):
+    with stage('parse'):
+        code_match = re.search(r'```(?:.|\n)*?\n(.*?)```', response, re.DOTALL)
+        if code_match:
+            file_content = code_match.group(1).strip()
+        else:
+            file_content = response
+
+    save_file(ctx, file_info.get('path', ''), file_info.get('fname', ''), file_content)
+    return file_content
 
 
 # @app.route('/modify_code', methods=['POST'])
@@ -612,285 +1029,257 @@ def implement_file(file_info, full_code_structure):
 
 @app.route('/modify_code', methods=['POST'])
 def modify_code():
-    global account_guid, project_guid
-
     data = request.get_json()
-    account_guid = data['account_guid']
-    project_guid = data['project_guid']
+    ctx = ProjectContext.from_request(data)
+    use_cache = not data.get('bypass_cache', False)
+    patch_mode = data.get('response_mode', DEFAULT_RESPONSE_MODE) == 'patch'
     code_modification_prompt = data['code_modification_prompt']
-    selected_files = data['selected_files']
+    selected_files = data.get('selected_files') or []
 
-    project_data_path = f'code/{account_guid}/{project_guid}/project_data.json'
-    code_structure_path = f'code/{account_guid}/{project_guid}/code_structure.json'
-
-    if not os.path.exists(project_data_path) or not os.path.exists(code_structure_path):
+    if (not storage.exists(*ctx, 'project_data.json')
+            or not storage.exists(*ctx, 'code_structure.json')):
         return jsonify({'error': '프로젝트를 찾을 수 없습니다.'}), 404
 
-    with open(project_data_path, 'r', encoding='utf-8') as f:
-        project_data = json.load(f)
-        project_description = project_data['project_description']
-        flowchart = project_data['flowchart']
-        function_call_chart = project_data['gpt_request']
-
-    with open(code_structure_path, 'r', encoding='utf-8') as f:
-        code_structure = json.load(f)
-
-    prompt = f"{project_description}\n\n{flowchart}\n\n{function_call_chart}\n\n"
+    project_data = load_project_json(ctx, 'project_data.json')
+    project_description = project_data['project_description']
+    flowchart = project_data['flowchart']
+    function_call_chart = project_data['gpt_request']
+
+    code_structure = load_project_json(ctx, 'code_structure.json')
+    # 설계에 없는 파일을 선택했어도 그 경로로 저장되도록 파일 목록에 더한다
+    code_structure = dict(code_structure, Files=merge_files(code_structure['Files'], selected_files))
+
+    # 선택한 파일들을 먼저, 나머지 파일은 수정 요청과 관련 있는 순서로 예산이 남는 만큼 넣음
+    header, files_section, full_files = build_file_context(
+        code_structure['Files'], project_file_reader(ctx),
+        query=code_modification_prompt, pinned=selected_files,
+        header=f"{project_description}\n\n{flowchart}\n\n{function_call_chart}\n\n",
+        symbols=symbol_index.get(*ctx))
+    prompt = header
     prompt += "위에 적어 놓은 설명, flow chart 그리고 함수 호출표를 이용해서 내가 앞으로 주는 코드들을 수정해줘."
     prompt += f"수정 요청: {code_modification_prompt}\n\n"
 
-    # 선택한 파일들의 내용을 포함
     prompt += "수정할 파일들의 내용:\n"
-    for file_info in selected_files:
-        file_path = f'code/{account_guid}/{project_guid}/{file_info["path"]}/{file_info["fname"]}'
-        if os.path.exists(file_path):
-            with open(file_path, 'r', encoding='utf-8') as f:
-                file_content = f.read()
-            prompt += f"파일: {file_info['fname']} 내용:\n{file_content}\n\n"
+    prompt += files_section
 
-    prompt += "위 파일들을 수정하여 새로운 코드를 생성해주세요. JSON 형식으로만 응답해줘."
+    if patch_mode:
+        prompt += PATCH_PROMPT
+    else:
+        prompt += "위 파일들을 수정하여 새로운 코드를 생성해주세요. JSON 형식으로만 응답해줘."
 
-    response = gpt_request_with_retry(prompt)
-    print(response)
     try:
-        if response.strip().startswith("```json"):
-            response = response.strip()[7:-3].strip()
-        if not response:
-            return jsonify({'error': '빈 JSON 응답입니다.'}), 500
-        response_json = json.loads(response)
-    except json.JSONDecodeError as e:
-        return jsonify({'error': '응답을 JSON으로 파싱하는데 실패했습니다.', 'details': str(e)}), 500
-
-    # 파일 저장 로직 수정
-    for fname, file_info in response_json.items():
-        # code_structure에서 해당 파일의 경로를 찾음
-        path = ''
-        for file in code_structure['Files']:
-            if file['fname'] == fname:
-                path = file.get('path', '')
-                break
-
-        # file_info가 문자열인지 확인하고, content가 문자열이면 그대로 사용
-        if isinstance(file_info, dict):
-            content = file_info.get('content', '')
-        else:
-            content = file_info  # file_info가 문자열일 경우 그대로 content로 사용
-
-        save_file(path, fname, content)
+        response_json = request_structured(prompt, FILE_EDITS_SCHEMA, use_cache=use_cache)
+    except StructuredOutputError as e:
+        return jsonify({'error': str(e), 'details': '; '.join(e.details)}), 500
 
-    return jsonify({'status': 'success', 'files': response_json})
+    patch_report = save_file_changes(ctx, response_json, code_structure, prompt, use_cache, full_files)
+    return jsonify(file_changes_result(response_json, patch_report, patch_mode))
 
 
 @app.route('/get_flowchart', methods=['POST'])
 def get_flowchart():
-    global account_guid, project_guid
-
     data = request.get_json()
-    account_guid = data['account_guid']
-    project_guid = data['project_guid']
-
-    project_data_path = f'code/{account_guid}/{project_guid}/project_data.json'
+    ctx = ProjectContext.from_request(data)
 
-    if not os.path.exists(project_data_path):
+    if not storage.exists(*ctx, 'project_data.json'):
         return jsonify({'error': '프로젝트를 찾을 수 없습니다.'}), 404
 
-    with open(project_data_path, 'r', encoding='utf-8') as f:
-        project_data = json.load(f)
-        flowchart = project_data.get('flowchart', '')
+    project_data = load_project_json(ctx, 'project_data.json')
+    flowchart = project_data.get('flowchart', '')
 
     return jsonify({'flowchart': flowchart})
 
 @app.route('/add_feature', methods=['POST'])
 def add_feature():
-    global account_guid, project_guid
-
     data = request.get_json()
-    account_guid = data['account_guid']
-    project_guid = data['project_guid']
+    ctx = ProjectContext.from_request(data)
+    use_cache = not data.get('bypass_cache', False)
+    patch_mode = data.get('response_mode', DEFAULT_RESPONSE_MODE) == 'patch'
     new_feature_description = data['new_feature_description']
 
-    project_data_path = f'code/{account_guid}/{project_guid}/project_data.json'
-    code_structure_path = f'code/{account_guid}/{project_guid}/code_structure.json'
-
-    if not os.path.exists(project_data_path) or not os.path.exists(code_structure_path):
+    if (not storage.exists(*ctx, 'project_data.json')
+            or not storage.exists(*ctx, 'code_structure.json')):
         return jsonify({'error': '프로젝트를 찾을 수 없습니다.'}), 404
 
-    with open(project_data_path, 'r', encoding='utf-8') as f:
-        project_data = json.load(f)
-        project_description = project_data['project_description']
-        flowchart = project_data['flowchart']
-        function_call_chart = project_data['gpt_request']
+    project_data = load_project_json(ctx, 'project_data.json')
+    project_description = project_data['project_description']
+    flowchart = project_data['flowchart']
+    function_call_chart = project_data['gpt_request']
 
-    with open(code_structure_path, 'r', encoding='utf-8') as f:
-        code_structure = json.load(f)
+    code_structure = load_project_json(ctx, 'code_structure.json')
 
     # 기존 플로우차트와 기능 호출표에 새로운 기능을 추가하는 프롬프트 생성
-    prompt = f"{project_description}\n\n{flowchart}\n\n{function_call_chart}\n\n"
+    header, files_section, full_files = build_file_context(
+        code_structure['Files'], project_file_reader(ctx),
+        query=new_feature_description,
+        header=f"{project_description}\n\n{flowchart}\n\n{function_call_chart}\n\n",
+        symbols=symbol_index.get(*ctx))
+    prompt = header
     prompt += "위에 적어 놓은 설명, flow chart 그리고 함수 호출표를 이용해서 새로운 기능을 추가해줘."
     prompt += f"새로운 기능: {new_feature_description}\n\n"
-    prompt += "기존 기능을 유지하며 새로운 기능을 추가할 수 있도록 코드를 수정하고, JSON 형식으로만 응답해줘."
+    prompt += "기존 파일들의 내용:\n"
+    prompt += files_section
+    if patch_mode:
+        prompt += PATCH_PROMPT
+    else:
+        prompt += "기존 기능을 유지하며 새로운 기능을 추가할 수 있도록 코드를 수정하고, JSON 형식으로만 응답해줘."
 
-    response = gpt_request_with_retry(prompt)
-    print(response)
     try:
-        if response.strip().startswith("```json"):
-            response = response.strip()[7:-3].strip()
-        if not response:
-            return jsonify({'error': '빈 JSON 응답입니다.'}), 500
-        response_json = json.loads(response)
-    except json.JSONDecodeError as e:
-        return jsonify({'error': '응답을 JSON으로 파싱하는데 실패했습니다.', 'details': str(e)}), 500
-
-    # 파일 저장 로직 수정
-    for fname, file_info in response_json.items():
-        # code_structure에서 해당 파일의 경로를 찾음
-        path = ''
-        for file in code_structure['Files']:
-            if file['fname'] == fname:
-                path = file.get('path', '')
-                break
-
-        if isinstance(file_info, dict):
-            content = file_info.get('content', '')
-        else:
-            content = file_info
-
-        save_file(path, fname, content)
+        response_json = request_structured(prompt, FILE_EDITS_SCHEMA, use_cache=use_cache)
+    except StructuredOutputError as e:
+        return jsonify({'error': str(e), 'details': '; '.join(e.details)}), 500
 
-    return jsonify({'status': 'success', 'files': response_json})
+    patch_report = save_file_changes(ctx, response_json, code_structure, prompt, use_cache, full_files)
+    return jsonify(file_changes_result(response_json, patch_report, patch_mode))
 
 
 
 # Flask 프로젝트 실행 엔드포인트 추가
 @app.route('/run_project', methods=['POST'])
 def run_project():
-    global account_guid, project_guid
-
     data = request.get_json()
-    account_guid = data['account_guid']
-    project_guid = data['project_guid']
+    ctx = ProjectContext.from_request(data)
 
-    project_path = f'code/{account_guid}/{project_guid}/app'
+    # sqlite backend 면 실행할 수 있도록 파일로 풀어놓음
+    project_path = os.path.join(storage.export(*ctx), 'app')
 
     if not os.path.exists(project_path):
         return jsonify({'error': 'app 폴더를 찾을 수 없습니다.'}), 404
 
-    # 포트 5001이 이미 사용 중인지 확인하고, 사용 중인 경우 프로세스를 종료합니다.
+    # requirements.txt 가 같은 프로젝트끼리 공유하는 virtualenv 에서 실행 (처음 한 번만 만듦)
+    # 프로젝트마다 비어 있는 포트로 실행하고, 코드가 그대로면 실행 중인 앱을 다시 씀
+    lease = None
     try:
-        # 포트가 사용 중인지 확인하는 명령
-        command_check = 'lsof -i :6001'
-        process_check = subprocess.Popen(shlex.split(command_check), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process_check.communicate()
-
-        # 포트가 사용 중일 때, 결과를 분석하여 해당 프로세스를 종료
-        if stdout:
-            # lsof 결과에서 PID를 추출하여 프로세스를 종료
-            for line in stdout.decode().splitlines():
-                if "LISTEN" in line:
-                    parts = line.split()
-                    pid = parts[1]  # PID는 두 번째 열에 있습니다.
-                    subprocess.call(['kill', '-9', pid])
-                    time.sleep(1)  # 프로세스 종료 대기 시간
-
-        # Flask 서버를 subprocess로 실행
-        # env = os.environ.copy()
-        # env["FLASK_APP"] = "app.py"
-        # command = 'flask run --host=0.0.0.0 --port=6001'
-        #
-        # process = subprocess.Popen(
-        #     shlex.split(command),
-        #     cwd=project_path,
-        #     stdout=subprocess.PIPE,
-        #     stderr=subprocess.PIPE,
-        #     env=env,
-        #     bufsize=1,
-        #     universal_newlines=True
-        # )
-
-        command = 'python -m flask run --host=0.0.0.0 --port=6001'
-        process = subprocess.Popen(
-            shlex.split(command),
-            cwd=project_path,  # Flask 앱의 경로
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            bufsize=1,
-            universal_newlines=True
-        )
-
-        # 서버가 실행될 시간을 줌
-        time.sleep(5)
-
-        # 서버가 정상적으로 실행되었는지 확인하고, 결과 반환
-        if process.poll() is None:
-            return jsonify({'url': 'http://localhost:6001/'})
-        else:
-            # 오류가 발생한 경우, 로그를 전송
-            stdout, stderr = process.communicate(timeout=5)
-            error_logs = stdout.splitlines() + stderr.splitlines()
-            return jsonify({'error': 'Flask 서버 실행에 실패했습니다.', 'logs': error_logs}), 500
-
-    except subprocess.TimeoutExpired:
-        process.kill()
-        return jsonify({'error': 'Flask 서버 실행 시간이 초과되었습니다.'}), 500
+        python, lease = env_cache.lease_for(project_path, runner_pool.pythons())
+        running, reused = runner_pool.run(*ctx, project_path, project_fingerprint(ctx), python, lease)
+    except (RunnerError, EnvBuildError) as e:
+        return jsonify({'error': str(e), 'logs': e.logs}), 500
     except Exception as e:
         return jsonify({'error': f'Flask 서버 실행 중 오류: {str(e)}'}), 500
+    finally:
+        # 실행한 앱이 잠금을 물려받았으므로 여기서는 닫는다
+        if lease is not None:
+            lease.close()
+
+    return jsonify({'url': running.url, 'port': running.port, 'reused': reused})
+
+
+@app.route('/stop_project', methods=['POST'])
+def stop_project():
+    data = request.get_json()
+    ctx = ProjectContext.from_request(data)
+    return jsonify({'stopped': runner_pool.stop(*ctx)})
 
 
+@app.route('/running_projects', methods=['GET'])
+def running_projects():
+    return jsonify({'apps': runner_pool.list(), 'envs': env_cache.stats()})
 
-def save_file(path, fname, content):
-    global account_guid, project_guid
 
-    full_path = f'code/{account_guid}/{project_guid}/{path}'
-    os.makedirs(full_path, exist_ok=True)
-    with open(f'{full_path}/{fname}', 'w') as f:
-        f.write(content)
+@app.route('/project_logs', methods=['POST'])
+def project_logs():
+    data = request.get_json()
+    ctx = ProjectContext.from_request(data)
+    logs = runner_pool.logs(*ctx)
+    if logs is None:
+        return jsonify({'error': '실행한 기록이 없습니다.'}), 404
 
+    # offset 을 주지 않으면 마지막 PROJECT_LOG_TAIL 줄
+    try:
+        offset = int(data.get('offset', -PROJECT_LOG_TAIL))
+        limit = int(data.get('limit', PROJECT_LOG_BATCH))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'offset 과 limit 은 정수여야 합니다.'}), 400
+    result = logs.read(offset, max(1, min(limit, PROJECT_LOG_MAX_BATCH)))
+    result['running'] = runner_pool.get(*ctx) is not None
+    return jsonify(result)
+
+
+@app.route('/project_logs_stream/<account_guid>/<project_guid>', methods=['GET'])
+def project_logs_stream(account_guid, project_guid):
+    ctx = ProjectContext.from_request({'account_guid': account_guid, 'project_guid': project_guid})
+    logs = runner_pool.logs(*ctx)
+    if logs is None:
+        return jsonify({'error': '실행한 기록이 없습니다.'}), 404
+
+    # EventSource 가 재연결하면 Last-Event-ID 부터 이어서 보낸다. follow=0 이면 지금까지의 로그만 보내고 끝낸다
+    offset = resume_offset(request.headers.get('Last-Event-ID'), request.args.get('offset'), -PROJECT_LOG_TAIL)
+    follow = request.args.get('follow', '1') == '1'
+
+    def events():
+        position = offset
+        while True:
+            if follow:
+                result = logs.wait(position, limit=PROJECT_LOG_BATCH)
+            else:
+                result = logs.read(position, PROJECT_LOG_BATCH)
+            position = result['next_offset']
+            if result['lines'] or result['dropped']:
+                yield format_sse({'lines': result['lines'], 'offset': result['offset'], 'dropped': result['dropped']},
+                                 event='log', event_id=position)
+            elif result['closed'] or not follow:
+                yield format_sse({'closed': result['closed']}, event='done')
+                return
+            else:
+                yield ': keep-alive\n\n'
 
-def format_response(response):
+    return sse_response(events())
+
+
+def project_fingerprint(ctx):
+    # app 폴더 파일들의 (경로, sha256) 으로 만든 해시. 코드가 바뀌었는지 확인하는 데 쓴다
+    digest = hashlib.sha256()
+    for rel_path in sorted(storage.list_files(*ctx)):
+        if not rel_path.startswith('app' + os.sep):
+            continue
+        meta = storage.describe(*ctx, rel_path)
+        if meta:
+            digest.update(f"{rel_path}\0{meta['sha256']}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def prewarm_project(ctx):
+    if not PREWARM_ENABLED:
+        return
+    project_path = os.path.join(storage.export(*ctx), 'app')
+    if os.path.exists(project_path):
+        runner_pool.prewarm(*ctx, project_path, project_fingerprint(ctx),
+                            lambda: env_cache.lease_for(project_path, runner_pool.pythons()))
+
+
+def save_file(ctx, path, fname, content):
+    storage.write(*ctx, f'{path}/{fname}', content)
+
+
+def format_response(response, use_cache=True):
     formatted_response = ""
     try:
-        if response.strip().startswith("```json"):
-            response = response.strip()[7:-3].strip()
-        if not response:
-            return '빈 JSON 응답입니다.'
-        print(response)
-        response_json = json.loads(response)
+        response_json = parse_structured(response, CALL_CHART_SCHEMA, use_cache)
         for key, value in response_json.items():
             formatted_response += f"{key}. {value['title']}\n"
             for func in value['functions']:
-                parameters = ', '.join(['{}: {}'.format(p['name'], p['type']) for p in func['parameters']])
-                formatted_response += f"    - {func['name']}({parameters}): {func['description']}\n"
+                parameters = ', '.join(['{}: {}'.format(p['name'], p.get('type', '')) for p in func.get('parameters', [])])
+                formatted_response += f"    - {func['name']}({parameters}): {func.get('description', '')}\n"
     except Exception as e:
         return f'오류: {str(e)}'
     return formatted_response
 
 
-def save_function_call_chart(chart):
-    global account_guid, project_guid
-
-    path = f'code/{account_guid}/{project_guid}'
-    os.makedirs(path, exist_ok=True)
-    with open(f'{path}/function_call_chart.txt', 'w') as f:
-        f.write(chart)
+def save_fingerprints(ctx, fingerprints):
+    storage.write(*ctx, FINGERPRINT_FILE, json.dumps(fingerprints, indent=4))
 
 
-def load_function_call_chart():
-    global account_guid, project_guid
+def save_function_call_chart(ctx, chart):
+    storage.write(*ctx, 'function_call_chart.txt', chart)
 
-    path = f'code/{account_guid}/{project_guid}/function_call_chart.txt'
-    if os.path.exists(path):
-        with open(path, 'r', encoding='utf-8') as f:
-            return f.read()
-    return ""
 
+def load_function_call_chart(ctx):
+    content = read_project_file(ctx, 'function_call_chart.txt')
+    return content if content is not None else ""
 
-def save_project_data(project_data):
-    global account_guid, project_guid
 
-    path = f'code/{account_guid}/{project_guid}'
-    os.makedirs(path, exist_ok=True)
-    with open(f'{path}/project_data.json', 'w') as f:
-        json.dump(project_data, f)
+def save_project_data(ctx, project_data):
+    storage.write(*ctx, 'project_data.json', json.dumps(project_data))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,142 @@
+import os
+import threading
+import time
+from collections import deque
+
+# 실행 중인 앱 하나가 메모리에 남기는 최근 로그 줄 수와 한 줄의 최대 길이
+LOG_LINES = int(os.environ.get('RUNNER_LOG_LINES') or 2000)
+LOG_LINE_CHARS = int(os.environ.get('RUNNER_LOG_LINE_CHARS') or 2000)
+# 설정하면 로그를 {RUNNER_LOG_DIR}/{account_guid}/{project_guid}.log 에도 쓰고, 크기가 넘으면 돌려쓴다
+LOG_DIR = os.environ.get('RUNNER_LOG_DIR') or ''
+LOG_FILE_BYTES = int(os.environ.get('RUNNER_LOG_FILE_BYTES') or 10 * 1024 * 1024)
+LOG_FILE_BACKUPS = int(os.environ.get('RUNNER_LOG_FILE_BACKUPS') or 3)
+
+
+class SpillFile:
+    """크기가 max_bytes 를 넘으면 name.1, name.2 ... 로 밀어내고 새로 쓰는 로그 파일."""
+
+    def __init__(self, path, max_bytes=LOG_FILE_BYTES, backups=LOG_FILE_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def _rotate(self):
+        self._file.close()
+        for index in range(self.backups - 1, 0, -1):
+            source = f'{self.path}.{index}'
+            if os.path.exists(source):
+                os.replace(source, f'{self.path}.{index + 1}')
+        if self.backups > 0:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def write(self, line):
+        self._file.write(line + '\n')
+        self._file.flush()
+        if self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def close(self):
+        self._file.close()
+
+
+class LogBuffer:
+    """최근 max_lines 줄만 남기는 로그 ring buffer.
+
+    줄마다 0 부터 증가하는 번호(offset)가 붙어서, 클라이언트는 마지막으로 받은 offset 부터 이어서 읽는다.
+    오래되어 밀려난 줄을 요청하면 남아 있는 첫 줄부터 돌려주고 밀려난 줄 수를 dropped 로 알려준다.
+    """
+
+    def __init__(self, max_lines=LOG_LINES, max_line_chars=LOG_LINE_CHARS, spill=None):
+        self._lines = deque(maxlen=max_lines)
+        self._max_line_chars = max_line_chars
+        self._first = 0  # _lines[0] 의 offset
+        self._closed = False
+        # 마지막으로 줄이 들어온 시각 (time.monotonic). 앱이 요청을 처리하면 로그가 남으므로 활동 시각으로 쓴다
+        self.last_append = time.monotonic()
+        self._spill = spill
+        self._cond = threading.Condition()
+
+    def append(self, line):
+        line = line.rstrip('\r\n')
+        if len(line) > self._max_line_chars:
+            line = line[:self._max_line_chars] + '...(생략)'
+        with self._cond:
+            if len(self._lines) == self._lines.maxlen:
+                self._first += 1
+            self._lines.append(line)
+            self.last_append = time.monotonic()
+            self._cond.notify_all()
+        if self._spill is not None:
+            try:
+                self._spill.write(line)
+            except OSError as e:
+                print(f"Log spill failed: {e}")
+                self._spill = None
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._spill is not None:
+            self._spill.close()
+
+    @property
+    def closed(self):
+        with self._cond:
+            return self._closed
+
+    def _read(self, offset, limit):
+        end = self._first + len(self._lines)
+        if offset < 0:
+            # 음수면 마지막 -offset 줄 (tail)
+            offset = max(self._first, end + offset)
+        dropped = max(0, self._first - offset)
+        start = max(offset, self._first)
+        stop = end if limit is None else min(end, start + limit)
+        lines = [self._lines[i - self._first] for i in range(start, stop)]
+        return {'lines': lines, 'offset': start, 'next_offset': stop, 'dropped': dropped, 'closed': self._closed}
+
+    def read(self, offset=0, limit=None):
+        with self._cond:
+            return self._read(offset, limit)
+
+    def wait(self, offset, timeout=15, limit=None):
+        """offset 이후의 줄이 생기거나 닫힐 때까지 timeout 초까지 기다렸다가 read 와 같은 결과를 돌려준다."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._first + len(self._lines) > offset or self._closed, timeout)
+            return self._read(offset, limit)
+
+
+def spill_path(account_guid, project_guid):
+    return os.path.join(LOG_DIR, account_guid, f'{project_guid}.log') if LOG_DIR else None
+
+
+def start_pump(stream, buffer, name='app-log-pump', max_line_chars=LOG_LINE_CHARS):
+    """stream(텍스트 모드 파이프)을 끝까지 읽어서 buffer 에 넣는 스레드. 파이프가 차서 앱이 멈추지 않도록 계속 비운다.
+
+    줄바꿈 없이 계속 출력하는 앱 때문에 메모리가 늘지 않도록 한 번에 max_line_chars + 1 글자까지만 읽는다.
+    그보다 긴 줄은 앞부분만 buffer 에 넣고 나머지는 줄이 끝날 때까지 버린다.
+    """
+    def pump():
+        skipping = False
+        try:
+            while True:
+                chunk = stream.readline(max_line_chars + 1)
+                if not chunk:
+                    break
+                if not skipping:
+                    buffer.append(chunk)
+                skipping = not chunk.endswith('\n')
+        except (OSError, ValueError):
+            pass
+        finally:
+            buffer.close()
+            stream.close()
+    thread = threading.Thread(target=pump, name=name, daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,468 @@
+import asyncio
+import io
+import json
+import os
+import sys
+import time
+import traceback
+from contextlib import aclosing
+from urllib.parse import parse_qs
+from app import (app as flask_app, job_store, validate_flowchart, build_generate_code_prompt, finish_generate_code,
+                 build_project_plan_prompt, parse_code_structure, plan_project_files, save_generated_fingerprints,
+                 build_implement_file_prompt, finish_implement_file, prewarm_project, load_previous_fingerprints,
+                 register_streamed_file)
+from async_ai_models import agpt_request_with_retry, agpt_request_stream_with_retry
+from jobs import JobStatus, FileStatus, file_key
+from metrics import metrics, http_duration
+from project_context import ProjectContext, ProjectContextError
+from plan_stream import PlanStreamParser
+from scheduler import DependencyScheduler
+from sse import format_sse, resume_offset, SSE_HEADERS
+from storage import storage
+import tracing
+
+# uvicorn asgi:app --workers 2
+# gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+#
+# 생성 엔드포인트(/generate_code, /generate_code_stream, /generate_project_code, /job_stream)는
+# event loop 에서 async provider 클라이언트로 처리해서 요청마다 스레드를 쓰지 않는다.
+# 나머지 경로는 기존 Flask 앱을 스레드에서 실행해서 그대로 동작한다.
+
+# 한 번에 받을 수 있는 요청 본문 크기
+MAX_BODY_SIZE = int(os.environ.get('ASGI_MAX_BODY_SIZE') or 16 * 1024 * 1024)
+# /job_stream 이 새 출력을 확인하는 간격(초)
+JOB_STREAM_POLL_INTERVAL = float(os.environ.get('JOB_STREAM_POLL_INTERVAL') or 0.2)
+JOB_STREAM_KEEPALIVE = 15
+
+# 동시에 실행하는 프로젝트 생성 작업 수. 넘치는 작업은 pending 상태로 기다린다.
+_job_slots = asyncio.Semaphore(flask_app.config['ASYNC_JOBS'])
+# 실행 중인 task 가 GC 되지 않도록 참조를 잡아둔다
+_job_tasks = set()
+metrics.collector('asgi_generation_tasks', 'event loop 에서 진행 중인 프로젝트 생성 task 수', 'gauge', (),
+                  lambda: [((), len(_job_tasks))])
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+async def read_body(receive):
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ConnectionError('client disconnected')
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > MAX_BODY_SIZE:
+            raise HttpError(413, '요청 본문이 너무 큽니다.')
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+def read_json(body):
+    try:
+        return json.loads(body or b'null')
+    except ValueError:
+        raise HttpError(400, 'JSON 본문을 파싱하지 못했습니다.')
+
+
+def request_header(scope, name):
+    name = name.encode('latin-1')
+    for key, value in scope['headers']:
+        if key.lower() == name:
+            return value.decode('latin-1')
+    return None
+
+
+async def send_json(send, data, status=200):
+    body = json.dumps(data).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def send_sse(send, receive, events):
+    """events(문자열 async generator)를 text/event-stream 으로 보낸다.
+
+    클라이언트가 연결을 끊으면 events 를 cancel 해서 진행 중인 LLM 스트림도 바로 닫는다.
+    """
+    headers = [(b'content-type', b'text/event-stream; charset=utf-8')]
+    headers += [(name.lower().encode(), value.encode()) for name, value in SSE_HEADERS.items()]
+    await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+
+    async def pump():
+        async with aclosing(events) as stream:
+            async for chunk in stream:
+                await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    sender = asyncio.ensure_future(pump())
+    watcher = asyncio.ensure_future(_wait_disconnect(receive))
+    done, _ = await asyncio.wait({sender, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    if sender in done:
+        watcher.cancel()
+        sender.result()
+    else:
+        sender.cancel()
+        await asyncio.gather(sender, return_exceptions=True)
+
+
+async def generate_code(scope, receive, send, body):
+    data = read_json(body)
+    ctx = ProjectContext.from_request(data)
+    use_cache = not data.get('bypass_cache', False)
+    project_description = data['project_description']
+    flowchart = data['flowchart']
+
+    is_valid, error_message = validate_flowchart(project_description, flowchart)
+    if not is_valid:
+        raise HttpError(400, error_message)
+
+    constructed_prompt = await asyncio.to_thread(build_generate_code_prompt, ctx, project_description, flowchart)
+    response = await agpt_request_with_retry(constructed_prompt, use_cache=use_cache, json_mode=True)
+    formatted_response = await asyncio.to_thread(
+        finish_generate_code, ctx, project_description, flowchart, response, use_cache)
+    await send_json(send, {'formatted_response': formatted_response})
+
+
+async def generate_code_stream(scope, receive, send, body):
+    data = read_json(body)
+    ctx = ProjectContext.from_request(data)
+    use_cache = not data.get('bypass_cache', False)
+    project_description = data['project_description']
+    flowchart = data['flowchart']
+
+    is_valid, error_message = validate_flowchart(project_description, flowchart)
+    if not is_valid:
+        raise HttpError(400, error_message)
+
+    constructed_prompt = await asyncio.to_thread(build_generate_code_prompt, ctx, project_description, flowchart)
+
+    async def events():
+        chunks = []
+        try:
+            async with aclosing(agpt_request_stream_with_retry(
+                    constructed_prompt, use_cache=use_cache, json_mode=True)) as stream:
+                async for delta in stream:
+                    chunks.append(delta)
+                    yield format_sse({'delta': delta}, event='token')
+            formatted_response = await asyncio.to_thread(
+                finish_generate_code, ctx, project_description, flowchart, ''.join(chunks), use_cache)
+        except Exception as e:
+            yield format_sse({'error': str(e)}, event='error')
+            return
+        yield format_sse({'formatted_response': formatted_response}, event='done')
+
+    await send_sse(send, receive, events())
+
+
+async def generate_project_code(scope, receive, send, body):
+    data = read_json(body)
+    ctx = ProjectContext.from_request(data)
+    use_cache = not data.get('bypass_cache', False)
+    full_regenerate = data.get('full_regenerate', False)
+
+    if not await asyncio.to_thread(storage.exists, *ctx, 'project_data.json'):
+        raise HttpError(404, 'Project not found')
+    if not await asyncio.to_thread(storage.exists, *ctx, 'function_call_chart.txt'):
+        raise HttpError(404, 'function call chart not found')
+
+    job = await asyncio.to_thread(job_store.create, 'generate_project_code', *ctx)
+    task = asyncio.ensure_future(run_job(job['job_id'], arun_generate_project_code, ctx, use_cache, full_regenerate))
+    _job_tasks.add(task)
+    task.add_done_callback(_job_tasks.discard)
+
+    await send_json(send, {'job_id': job['job_id'], 'status': job['status']}, 202)
+
+
+async def run_job(job_id, target, *args):
+    """JobQueue._run 과 같은 상태 전이를 event loop 안에서 한다.
+
+    job_store 는 바뀔 때마다 파일에 쓰고 다른 스레드와 잠금을 같이 쓰므로 event loop 를 막지 않도록 스레드에서 부른다.
+    """
+    async with _job_slots:
+        await asyncio.to_thread(job_store.update, job_id, status=JobStatus.RUNNING)
+        try:
+            with tracing.span('job', job_id=job_id):
+                result = await target(job_id, *args)
+            await asyncio.to_thread(job_store.update, job_id, status=JobStatus.DONE, stage='', result=result)
+        except Exception as e:
+            traceback.print_exc()
+            await asyncio.to_thread(job_store.update, job_id, status=JobStatus.FAILED, error=str(e))
+
+
+async def arun_generate_project_code(job_id, ctx, use_cache=True, full_regenerate=False):
+    await asyncio.to_thread(job_store.update, job_id, stage='planning')
+    prompt, function_call_chart_content = await asyncio.to_thread(build_project_plan_prompt, ctx)
+    previous = await asyncio.to_thread(load_previous_fingerprints, ctx, full_regenerate)
+    parser = PlanStreamParser()
+    state = {'code_structure': None, 'reused': {}}
+
+    async def implement(file_info, dependency_context):
+        key = file_key(file_info.get('path', ''), file_info.get('fname', ''))
+        if key in state['reused']:
+            return state['reused'][key]
+        code_structure = state['code_structure'] or {'Files': list(parser.files)}
+        return await aimplement_file_for_job(job_id, ctx, file_info, code_structure, dependency_context, use_cache)
+
+    # 파일은 작업 task 가 설계를 받는 중(plan span 안)에도 제출하므로, 파일 span 이 plan 밑에 들어가지 않도록
+    # 작업의 trace 를 잡아두었다가 되살린다
+    job_trace = tracing.capture()
+
+    def submit(file_info, dependency_context):
+        with tracing.restore(job_trace):
+            return asyncio.ensure_future(implement(file_info, dependency_context))
+
+    # 트랜잭션은 프로젝트 단위라 이 task 의 파일 구현 coroutine 들이 쓴 내용이 모두 한 번에 저장된다 (sqlite backend 만)
+    with storage.job_transaction(*ctx):
+        scheduler = DependencyScheduler(submit)
+        try:
+            with tracing.span('plan'):
+                if flask_app.config['PIPELINE_PLAN'] and not previous:
+                    chunks = []
+                    async with aclosing(agpt_request_stream_with_retry(
+                            prompt, use_cache=use_cache, json_mode=True)) as stream:
+                        async for delta in stream:
+                            chunks.append(delta)
+                            for file_info in parser.feed(delta):
+                                # 스케줄러는 파일 구현 task 를 만들므로 event loop 에서 부른다
+                                await asyncio.to_thread(register_streamed_file, job_id, file_info)
+                                scheduler.add(file_info)
+                    response = ''.join(chunks)
+                else:
+                    response = await agpt_request_with_retry(prompt, use_cache=use_cache, json_mode=True)
+                # 로컬에서 고치지 못하면 고쳐달라는 요청을 보낼 수 있으므로 스레드에서 파싱
+                code_structure = await asyncio.to_thread(parse_code_structure, response, use_cache)
+            if not code_structure:
+                raise ValueError('코드 구조를 파싱하지 못했습니다.')
+        except Exception:
+            await scheduler.ajoin()
+            raise
+
+        state['code_structure'] = code_structure
+        files, fingerprints, reused = await asyncio.to_thread(
+            plan_project_files, job_id, ctx, code_structure, function_call_chart_content, previous)
+        state['reused'].update(reused)
+        scheduler.close(files)
+        results = await scheduler.ajoin()
+        await asyncio.to_thread(save_generated_fingerprints, ctx, fingerprints, results, reused)
+
+    await asyncio.to_thread(prewarm_project, ctx)
+    return code_structure
+
+
+async def aimplement_file_for_job(job_id, ctx, file_info, full_code_structure, dependency_context='', use_cache=True):
+    path = file_info.get('path', '')
+    fname = file_info.get('fname', '')
+    await asyncio.to_thread(job_store.set_file_status, job_id, path, fname, FileStatus.RUNNING)
+    try:
+        with tracing.span('implement_file', path=path, fname=fname):
+            prompt = build_implement_file_prompt(file_info, full_code_structure, dependency_context)
+            chunks = []
+            async with aclosing(agpt_request_stream_with_retry(prompt, use_cache=use_cache)) as stream:
+                async for delta in stream:
+                    chunks.append(delta)
+                    await asyncio.to_thread(job_store.append_output, job_id, path, fname, delta)
+            file_content = await asyncio.to_thread(finish_implement_file, ctx, file_info, ''.join(chunks))
+    except Exception as e:
+        print(f"Failed to implement file {fname}: {e}")
+        await asyncio.to_thread(job_store.set_file_status, job_id, path, fname, FileStatus.FAILED, str(e))
+        return None
+    await asyncio.to_thread(job_store.set_file_status, job_id, path, fname, FileStatus.DONE)
+    return file_content
+
+
+async def job_stream(scope, receive, send, body):
+    job_id = scope['path'][len('/job_stream/'):]
+    if await asyncio.to_thread(job_store.get, job_id) is None:
+        raise HttpError(404, '작업을 찾을 수 없습니다.')
+
+    headers = dict(scope['headers'])
+    query = parse_qs(scope['query_string'].decode('latin-1'))
+    offset = resume_offset(headers.get(b'last-event-id', b'').decode('latin-1'), query.get('offset', [None])[0])
+
+    async def events():
+        # Flask 의 job_stream 과 같은 이벤트를 보내지만, 스레드에서 기다리지 않고 짧은 간격으로 확인한다
+        position = offset
+        idle = 0.0
+        while True:
+            # 다른 프로세스의 작업이면 파일을 읽으므로 스레드에서 확인한다
+            start, output, finished = await asyncio.to_thread(job_store.wait_output, job_id, position, 0)
+            if start > position:
+                # 메모리 한도 때문에 버려진 출력은 건너뛴다
+                yield format_sse({'dropped': start - position}, event='dropped')
+                position = start
+            for item in output:
+                position += 1
+                yield format_sse(item, event=item['type'], event_id=position)
+            if finished and not output:
+                job = await asyncio.to_thread(job_store.get, job_id)
+                yield format_sse({'status': job['status'], 'error': job['error']}, event='done')
+                return
+            if output:
+                idle = 0.0
+                continue
+            idle += JOB_STREAM_POLL_INTERVAL
+            if idle >= JOB_STREAM_KEEPALIVE:
+                idle = 0.0
+                yield ': keep-alive\n\n'
+            await asyncio.sleep(JOB_STREAM_POLL_INTERVAL)
+
+    await send_sse(send, receive, events())
+
+
+ROUTES = {
+    ('POST', '/generate_code'): generate_code,
+    ('POST', '/generate_code_stream'): generate_code_stream,
+    ('POST', '/generate_project_code'): generate_project_code,
+}
+PREFIX_ROUTES = [
+    ('GET', '/job_stream/', job_stream),
+]
+# 지표의 route label. Flask 의 url_rule 과 같은 형식으로 맞춘다
+PREFIX_ROUTE_NAMES = {'/job_stream/': '/job_stream/<job_id>'}
+
+
+def find_route(method, path):
+    """(handler, 지표에 쓰는 route 이름). 없으면 (None, None)."""
+    handler = ROUTES.get((method, path))
+    if handler:
+        return handler, path
+    for route_method, prefix, prefix_handler in PREFIX_ROUTES:
+        if method == route_method and path.startswith(prefix) and len(path) > len(prefix):
+            return prefix_handler, PREFIX_ROUTE_NAMES[prefix]
+    return None, None
+
+
+def wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = f'HTTP_{name}'
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def call_wsgi(scope, receive, send, body):
+    """Flask 앱을 스레드에서 실행하고, 응답 본문은 조각 단위로 이어서 보낸다 (Flask 의 SSE 응답도 그대로 동작)."""
+    environ = wsgi_environ(scope, body)
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+    result = await asyncio.to_thread(flask_app, environ, start_response)
+    try:
+        iterator = iter(result)
+        await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+        while True:
+            chunk = await asyncio.to_thread(next, iterator, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        close = getattr(result, 'close', None)
+        if close:
+            await asyncio.to_thread(close)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    try:
+        body = await read_body(receive)
+    except ConnectionError:
+        return
+    except HttpError as e:
+        await send_json(send, {'error': str(e)}, e.status)
+        return
+
+    handler, route = find_route(scope['method'], scope['path'])
+    if handler is None:
+        # Flask 경로의 응답 시간은 Flask 의 after_request 에서 기록한다
+        await call_wsgi(scope, receive, send, body)
+        return
+
+    started = time.perf_counter()
+    original_send = send
+    # event loop 를 여러 요청이 같이 쓰므로 cProfile 은 붙이지 않는다 (프로파일은 Flask 경로에서만)
+    root = tracing.NOOP_SPAN
+    if scope['method'] == 'POST':
+        root = tracing.start_trace(f'POST {route}', traceparent=request_header(scope, 'traceparent'),
+                                   **{'http.method': 'POST', 'http.route': route})
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            http_duration.observe(time.perf_counter() - started, scope['method'], route, str(message['status']))
+            if root.trace_id:
+                root.set(**{'http.status_code': message['status']})
+                message = dict(message, headers=list(message.get('headers', [])) + [
+                    (b'x-trace-id', root.trace_id.encode()),
+                    (b'traceparent', tracing.format_traceparent(root).encode())])
+        await original_send(message)
+
+    with tracing.trace(root):
+        try:
+            await handler(scope, receive, send, body)
+        except HttpError as e:
+            await send_json(send, {'error': str(e)}, e.status)
+        except ProjectContextError as e:
+            await send_json(send, {'error': str(e)}, 400)
+        except Exception as e:
+            traceback.print_exc()
+            root.record_error(e)
+            await send_json(send, {'error': str(e)}, 500)
+    root.finish()
@@ -0,0 +1,336 @@
+import asyncio
+import json
+import os
+import time
+from contextlib import aclosing
+import httpx
+from ai_types import AiType
+from ai_models import Gpt, Anthropic3, ClovarX, ClovarXError, configured_providers, provider_max_tokens, _cache_key
+from sse import aiter_sse_events
+from llm_cache import llm_cache
+from provider_clients import (ClientPool, split_keys, pair_keys, make_async_openai_client, make_async_anthropic_client,
+                              make_httpx_client)
+from rate_limiter import limited_async, estimate_tokens, call_with_retry_async, is_transient_error, backoff_delay
+from hedging import (HEDGING_ENABLED, HEDGE_PERCENTILE, HEDGE_DEFAULT_DELAY, provider_health,
+                     choose_providers)
+from metrics import record_llm_call, record_llm_usage, llm_ttft, llm_retries, stage_duration, stage
+import tracing
+
+# ai_models 와 같은 provider 를 asyncio 로 호출한다. 스레드 대신 coroutine 하나가 요청 하나를 맡으므로
+# 한 프로세스에서 수백 개의 생성을 동시에 진행할 수 있다. 설정(env)과 캐시, rate limiter, 장애 기록은 공유한다.
+
+# 동시에 진행하는 provider 호출 수. LLM_ASYNC_CONCURRENCY_GPT=128 처럼 바꿀 수 있다.
+DEFAULT_ASYNC_CONCURRENCY = {
+    AiType.GPT: 64,
+    AiType.ANTHROPIC: 32,
+    AiType.CLOVARX: 16,
+}
+
+
+def load_async_concurrency_from_env():
+    concurrency = dict(DEFAULT_ASYNC_CONCURRENCY)
+    for ai_type in concurrency:
+        value = os.environ.get(f'LLM_ASYNC_CONCURRENCY_{ai_type.upper()}')
+        if value:
+            concurrency[ai_type] = int(value)
+    return concurrency
+
+
+class AsyncGpt(Gpt):
+    def __init__(self):
+        self.clients = ClientPool(split_keys(os.environ.get('OpenaiAPI')), make_async_openai_client)
+
+    async def request(self, messages, json_mode=False):
+        key_id, client = self.clients.next()
+        async with limited_async(AiType.GPT, key_id, estimate_tokens(messages, self.max_tokens)) as limiter:
+            raw = await client.chat.completions.with_raw_response.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=self.max_tokens,
+                temperature=self.temperature,
+                **self._format_params(json_mode),
+            )
+            limiter.update_from_headers(raw.headers)
+        response = raw.parse()
+        if response.usage:
+            record_llm_usage(AiType.GPT, self.model, response.usage.prompt_tokens, response.usage.completion_tokens)
+        return response.choices[0].message.content
+
+    async def stream(self, messages, json_mode=False):
+        key_id, client = self.clients.next()
+        async with limited_async(AiType.GPT, key_id, estimate_tokens(messages, self.max_tokens)) as limiter:
+            raw = await client.chat.completions.with_raw_response.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=self.max_tokens,
+                temperature=self.temperature,
+                stream=True,
+                stream_options={'include_usage': True},
+                **self._format_params(json_mode),
+            )
+            limiter.update_from_headers(raw.headers)
+        stream = raw.parse()
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+                if chunk.usage:
+                    record_llm_usage(AiType.GPT, self.model, chunk.usage.prompt_tokens,
+                                     chunk.usage.completion_tokens)
+        finally:
+            await stream.close()
+
+
+class AsyncAnthropic3(Anthropic3):
+    def __init__(self):
+        self.clients = ClientPool(split_keys(os.environ.get('Anthropic3API')), make_async_anthropic_client)
+
+    def _params(self, msg, json_mode=False):
+        return {
+            "model": self.model,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "messages": self._messages(msg, json_mode)
+        }
+
+    async def request(self, msg=None, json_mode=False):
+        key_id, client = self.clients.next()
+        async with limited_async(AiType.ANTHROPIC, key_id, estimate_tokens(msg, self.max_tokens)) as limiter:
+            raw = await client.messages.with_raw_response.create(**self._params(msg, json_mode))
+            limiter.update_from_headers(raw.headers)
+        response = raw.parse()
+        record_llm_usage(AiType.ANTHROPIC, self.model, response.usage.input_tokens, response.usage.output_tokens)
+        return (self.JSON_PREFILL if json_mode else '') + response.content[0].text
+
+    async def stream(self, msg=None, json_mode=False):
+        key_id, client = self.clients.next()
+        async with limited_async(AiType.ANTHROPIC, key_id, estimate_tokens(msg, self.max_tokens)) as limiter:
+            raw = await client.messages.with_raw_response.create(stream=True, **self._params(msg, json_mode))
+            limiter.update_from_headers(raw.headers)
+        stream = raw.parse()
+        try:
+            if json_mode:
+                yield self.JSON_PREFILL
+            input_tokens = None
+            async for event in stream:
+                if event.type == 'content_block_delta' and event.delta.type == 'text_delta':
+                    yield event.delta.text
+                elif event.type == 'message_start':
+                    input_tokens = event.message.usage.input_tokens
+                elif event.type == 'message_delta':
+                    record_llm_usage(AiType.ANTHROPIC, self.model, input_tokens, event.usage.output_tokens)
+        finally:
+            await stream.close()
+
+
+class AsyncClovarX(ClovarX):
+    def __init__(self):
+        self._host = self.host
+        self._request_id = self.request_id
+        keys = pair_keys(self.api_key, self.api_key_primary_val, ('CloverAPI', 'CloverAPIPrimary'))
+        self.clients = ClientPool(keys, make_httpx_client)
+
+    async def _events(self, completion_request):
+        key_id, client = self.clients.next()
+        headers = self._headers(self.clients.key(key_id))
+        tokens = estimate_tokens(completion_request['messages'], completion_request['maxTokens'])
+        async with limited_async(AiType.CLOVARX, key_id, tokens) as limiter:
+            r = await client.send(
+                client.build_request('POST', self._host + f'/testapp/v1/chat-completions/{self.model}',
+                                     headers=headers, json=completion_request),
+                stream=True)
+            try:
+                r.raise_for_status()
+            except httpx.HTTPStatusError:
+                await r.aclose()
+                raise
+            limiter.update_from_headers(r.headers)
+        try:
+            async for event in aiter_sse_events(r.aiter_lines()):
+                yield event
+                if event.event == 'result':
+                    # 최종 결과를 받으면 남은 trailer 를 기다리지 않고 연결을 닫는다
+                    return
+        finally:
+            await r.aclose()
+
+    async def execute(self, completion_request):
+        chunks = []
+        async for event in self._events(completion_request):
+            if event.event == 'token':
+                chunks.append(json.loads(event.data)["message"]["content"])
+            elif event.event == 'result':
+                return self._result_content(event)
+            elif event.event == 'error':
+                raise ClovarXError(event.data)
+        # result 이벤트 없이 스트림이 끝나면 받은 토큰만 이어서 반환
+        return ''.join(chunks)
+
+    async def execute_stream(self, completion_request):
+        async for event in self._events(completion_request):
+            if event.event == 'token':
+                yield json.loads(event.data)["message"]["content"]
+            elif event.event == 'result':
+                self._result_content(event)
+                return
+            elif event.event == 'error':
+                raise ClovarXError(event.data)
+
+    async def request(self, messages, json_mode=False, **kwargs):
+        return await self.execute(self._request_data(messages, **kwargs))
+
+    def stream(self, messages, json_mode=False, **kwargs):
+        return self.execute_stream(self._request_data(messages, **kwargs))
+
+
+async_providers = {
+    AiType.GPT: AsyncGpt(),
+    AiType.ANTHROPIC: AsyncAnthropic3(),
+    AiType.CLOVARX: AsyncClovarX(),
+}
+
+_semaphores = {ai_type: asyncio.Semaphore(limit) for ai_type, limit in load_async_concurrency_from_env().items()}
+
+
+async def agpt_request(prompt, ai_type=AiType.GPT, use_cache=True, json_mode=False):
+    messages = [{"role": "user", "content": prompt}]
+    key = _cache_key(ai_type, messages, json_mode) if use_cache else None
+    if key:
+        cached = llm_cache.get(key)
+        if cached is not None:
+            tracing.add_event('cache_hit', provider=ai_type)
+            return cached
+
+    model = async_providers[ai_type].model
+    async with _semaphores[ai_type]:
+        started = time.monotonic()
+        try:
+            with tracing.span('llm.request', provider=ai_type, model=model, prompt_chars=len(prompt)):
+                response = await async_providers[ai_type].request(messages, json_mode=json_mode)
+        except Exception:
+            provider_health.record(ai_type, time.monotonic() - started, False)
+            record_llm_call(ai_type, model, time.monotonic() - started, False)
+            raise
+        provider_health.record(ai_type, time.monotonic() - started, True)
+        record_llm_call(ai_type, model, time.monotonic() - started, True)
+    if key and response:
+        llm_cache.put(key, response)
+    return response
+
+
+async def agpt_request_stream(prompt, ai_type=AiType.GPT, use_cache=True, json_mode=False):
+    messages = [{"role": "user", "content": prompt}]
+    key = _cache_key(ai_type, messages, json_mode) if use_cache else None
+    if key:
+        cached = llm_cache.get(key)
+        if cached is not None:
+            tracing.add_event('cache_hit', provider=ai_type)
+            yield cached
+            return
+
+    # 중간에 취소된 스트림(CancelledError, GeneratorExit)은 기록하지 않는다
+    chunks = []
+    model = async_providers[ai_type].model
+    async with _semaphores[ai_type]:
+        span = tracing.start_span('llm.request', provider=ai_type, model=model, prompt_chars=len(prompt), stream=True)
+        started = time.monotonic()
+        stream = async_providers[ai_type].stream(messages, json_mode=json_mode)
+        try:
+            # provider 가 알려주는 usage 가 이 span 에 붙도록 꺼낼 때만 현재 span 으로 둔다
+            async for delta in tracing.aiterate(span, stream):
+                if not chunks:
+                    llm_ttft.observe(time.monotonic() - started, ai_type, model)
+                    span.add_event('first_token')
+                chunks.append(delta)
+                yield delta
+        except Exception as e:
+            provider_health.record(ai_type, time.monotonic() - started, False)
+            record_llm_call(ai_type, model, time.monotonic() - started, False)
+            span.record_error(e)
+            raise
+        finally:
+            span.set(response_chars=sum(len(chunk) for chunk in chunks))
+            span.finish()
+            await stream.aclose()
+        provider_health.record(ai_type, time.monotonic() - started, True)
+        record_llm_call(ai_type, model, time.monotonic() - started, True)
+    if key and chunks:
+        llm_cache.put(key, ''.join(chunks))
+
+
+async def _ahedged_call(candidates, call):
+    """hedging.hedged_call 의 asyncio 버전. 늦어지면 다음 provider 로 같은 요청을 보내고, 먼저 성공한 결과를 쓴다.
+
+    나머지 요청은 task 를 cancel 해서 연결을 바로 정리한다.
+    """
+    tasks = {}
+    errors = []
+
+    def launch(ai_type):
+        tasks[asyncio.ensure_future(call(ai_type))] = ai_type
+
+    launch(candidates[0])
+    pending = set(tasks)
+    try:
+        while True:
+            timeout = None
+            if len(tasks) < len(candidates):
+                timeout = provider_health.latency_percentile(candidates[len(tasks) - 1], HEDGE_PERCENTILE)
+                if timeout is None:
+                    timeout = HEDGE_DEFAULT_DELAY
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                    continue
+                return task.result()
+
+            if len(tasks) < len(candidates) and (not done or not pending):
+                next_type = candidates[len(tasks)]
+                print(f"Hedging request to {next_type} after {timeout:.1f}s")
+                launch(next_type)
+                pending = {t for t in tasks if not t.done()}
+            elif not pending:
+                raise errors[-1]
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def agpt_request_with_retry(prompt, ai_type=AiType.GPT, max_retries=5, use_cache=True, hedge=None,
+                                  json_mode=False):
+    if hedge is None:
+        hedge = HEDGING_ENABLED
+    candidates = choose_providers(ai_type, configured_providers(), provider_max_tokens())
+    with stage('llm', provider=candidates[0]):
+        if not hedge or len(candidates) == 1:
+            return await call_with_retry_async(
+                lambda: agpt_request(prompt, candidates[0], use_cache, json_mode), max_retries, candidates[0])
+        return await _ahedged_call(candidates, lambda hedge_type: call_with_retry_async(
+            lambda: agpt_request(prompt, hedge_type, use_cache, json_mode), max_retries, hedge_type))
+
+
+# 스트리밍은 첫 토큰을 받기 전에 발생한 에러만 재시도한다 (이미 보낸 토큰은 되돌릴 수 없음)
+async def agpt_request_stream_with_retry(prompt, ai_type=AiType.GPT, max_retries=5, use_cache=True,
+                                         json_mode=False):
+    ai_type = choose_providers(ai_type, configured_providers(), provider_max_tokens())[0]
+    stage_started = time.perf_counter()
+    try:
+        for attempt in range(max_retries):
+            started = False
+            try:
+                async with aclosing(agpt_request_stream(prompt, ai_type, use_cache, json_mode)) as stream:
+                    async for delta in stream:
+                        started = True
+                        yield delta
+                return
+            except Exception as e:
+                if started or not is_transient_error(e) or attempt == max_retries - 1:
+                    raise
+                delay = backoff_delay(attempt)
+                llm_retries.inc(ai_type, type(e).__name__)
+                tracing.add_event('retry', provider=ai_type, attempt=attempt + 1, error=type(e).__name__, delay=delay)
+                print(f"Transient error ({type(e).__name__}: {e}). Retrying in {delay:.1f} seconds...")
+                await asyncio.sleep(delay)
+    finally:
+        stage_duration.observe(time.perf_counter() - stage_started, 'llm')
@@ -0,0 +1,387 @@
+import argparse
+import glob
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+# fake_provider.py 를 provider 로 두고 app.py(또는 asgi.py)의 전체 흐름을 동시에 여러 개 실행해서
+# 경로별 지연 시간(p50/p95/p99), 처리량, 서버 메모리를 잰다. 결과는 RESULTS_DIR 에 JSON 으로 남겨서 비교한다.
+#
+# 서버와 fake provider 를 같이 띄워서 실행:
+#   python benchmark.py --spawn --flows 40 --concurrency 8
+#   python benchmark.py --spawn --server-cmd "uvicorn asgi:app --port {port}" --label asgi
+# 이미 떠 있는 서버를 대상으로 실행 (서버는 fake provider 를 보도록 설정되어 있어야 함):
+#   python benchmark.py --url http://127.0.0.1:5000 --server-pid 1234
+# 지난 결과와 비교:
+#   python benchmark.py --spawn --compare latest
+
+RESULTS_DIR = os.environ.get('BENCH_RESULTS_DIR') or 'bench_results'
+DEFAULT_SERVER_CMD = 'gunicorn -c gunicorn.conf.py app:app --bind 127.0.0.1:{port}'
+ROUTES = ['generate_code', 'generate_project_code', 'project_job', 'modify_code', 'run_project', 'stop_project']
+JOB_POLL_INTERVAL = 0.2
+MEMORY_SAMPLE_INTERVAL = 0.5
+
+FLOWCHART = """flowchart TD
+    A[사용자] --> B[메인 페이지]
+    B --> C[인사말 표시]
+"""
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+class Recorder:
+    def __init__(self):
+        self._samples = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+
+    def add(self, route, seconds, ok, error=None):
+        with self._lock:
+            self._samples.setdefault(route, []).append(seconds)
+            if not ok:
+                self._errors.setdefault(route, []).append(error)
+
+    def summary(self):
+        with self._lock:
+            result = {}
+            for route, samples in self._samples.items():
+                samples = sorted(samples)
+                errors = self._errors.get(route, [])
+                result[route] = {
+                    'count': len(samples),
+                    'errors': len(errors),
+                    'error_samples': errors[:3],
+                    'mean': sum(samples) / len(samples),
+                    'p50': percentile(samples, 50),
+                    'p95': percentile(samples, 95),
+                    'p99': percentile(samples, 99),
+                    'max': samples[-1],
+                }
+            return result
+
+
+def percentile(sorted_samples, p):
+    # nearest-rank
+    if not sorted_samples:
+        return None
+    index = max(0, min(len(sorted_samples) - 1, int(round(p / 100 * len(sorted_samples) + 0.5)) - 1))
+    return sorted_samples[index]
+
+
+def _children(pid):
+    children = []
+    for stat in glob.glob('/proc/[0-9]*/stat'):
+        try:
+            with open(stat, 'r') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(stat.split('/')[2]))
+    return children
+
+
+def _rss_bytes(pid):
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def process_tree_rss(pid):
+    """pid 와 그 자식 프로세스(gunicorn worker 등)의 RSS 합. 생성된 앱(runner)은 세지 않도록 한 단계만 본다."""
+    return _rss_bytes(pid) + sum(_rss_bytes(child) for child in _children(pid))
+
+
+class MemorySampler:
+    def __init__(self, pid):
+        self.pid = pid
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='bench-memory', daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.samples.append(process_tree_rss(self.pid))
+            self._stop.wait(MEMORY_SAMPLE_INTERVAL)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        samples = [s for s in self.samples if s] or [0]
+        return {'start': samples[0], 'peak': max(samples), 'end': samples[-1]}
+
+
+class Flow:
+    """프로젝트 하나를 generate_code → generate_project_code → modify_code → run_project 순서로 진행한다."""
+
+    def __init__(self, url, recorder, routes, use_cache, job_timeout):
+        self.url = url.rstrip('/')
+        self.recorder = recorder
+        self.routes = routes
+        self.use_cache = use_cache
+        self.job_timeout = job_timeout
+        self.session = requests.Session()
+
+    def _call(self, route, method, path, payload=None, expected=(200,)):
+        started = time.monotonic()
+        try:
+            r = self.session.request(method, self.url + path, json=payload, timeout=self.job_timeout)
+            ok = r.status_code in expected
+            body = r.json() if r.headers.get('content-type', '').startswith('application/json') else {}
+            error = None if ok else f'{r.status_code} {str(body)[:200]}'
+        except (requests.RequestException, ValueError) as e:
+            ok, body, error = False, {}, f'{type(e).__name__}: {e}'
+        self.recorder.add(route, time.monotonic() - started, ok, error)
+        if not ok:
+            raise BenchmarkError(f'{route}: {error}')
+        return body
+
+    def _wait_job(self, job_id, started):
+        deadline = started + self.job_timeout
+        while time.monotonic() < deadline:
+            r = self.session.get(f'{self.url}/job_status/{job_id}', timeout=30)
+            job = r.json()
+            if job.get('status') in ('done', 'failed'):
+                ok = job['status'] == 'done'
+                self.recorder.add('project_job', time.monotonic() - started, ok, None if ok else job.get('error'))
+                if not ok:
+                    raise BenchmarkError(f"project_job: {job.get('error')}")
+                return job
+            time.sleep(JOB_POLL_INTERVAL)
+        self.recorder.add('project_job', time.monotonic() - started, False, 'timeout')
+        raise BenchmarkError('project_job: timeout')
+
+    def run(self, index):
+        ctx = {'account_guid': 'bench', 'project_guid': f'p{index}{uuid.uuid4().hex[:8]}'}
+        bypass = {'bypass_cache': not self.use_cache}
+        self._call('generate_code', 'POST', '/generate_code', dict(
+            ctx, project_description=f'인사말을 보여주는 웹 페이지 {index}', flowchart=FLOWCHART, **bypass))
+        if 'generate_project_code' not in self.routes:
+            return
+        started = time.monotonic()
+        job = self._call('generate_project_code', 'POST', '/generate_project_code', dict(ctx, **bypass),
+                         expected=(202,))
+        self._wait_job(job['job_id'], started)
+        if 'modify_code' in self.routes:
+            self._call('modify_code', 'POST', '/modify_code', dict(
+                ctx, code_modification_prompt='인사말을 한국어로 바꿔줘',
+                selected_files=[{'path': '', 'fname': 'app.py'}], **bypass))
+        if 'run_project' in self.routes:
+            self._call('run_project', 'POST', '/run_project', ctx)
+            self._call('stop_project', 'POST', '/stop_project', ctx)
+
+
+def wait_http(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=2)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise BenchmarkError(f'{url} 가 응답하지 않습니다.')
+
+
+def free_port():
+    import socket
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def spawn(args, work_dir):
+    """fake provider 와 서버를 띄우고 (서버 url, 서버 pid, 프로세스 목록) 을 돌려준다."""
+    fake_port = free_port()
+    server_port = free_port()
+    repo = os.path.dirname(os.path.abspath(__file__))
+    log = open(os.path.join(work_dir, 'server.log'), 'w')
+    fake = subprocess.Popen(
+        [sys.executable, os.path.join(repo, 'fake_provider.py'), '--port', str(fake_port),
+         '--latency', str(args.latency), '--tokens-per-sec', str(args.tokens_per_sec),
+         '--error-rate', str(args.error_rate)],
+        stdout=log, stderr=subprocess.STDOUT)
+    env = dict(
+        os.environ,
+        OpenaiAPI='fake', OpenaiBaseUrl=f'http://127.0.0.1:{fake_port}/v1',
+        Anthropic3API='fake', Anthropic3BaseUrl=f'http://127.0.0.1:{fake_port}',
+        CloverAPI='fake', CloverAPIPrimary='fake', CloverHost=f'http://127.0.0.1:{fake_port}', CloverRequestId='bench',
+        # 작업 결과가 저장소를 어지럽히지 않도록 작업 디렉터리에 둔다
+        STORAGE_BASE_DIR=os.path.join(work_dir, 'code'),
+        STORAGE_SQLITE_PATH=os.path.join(work_dir, 'project_state.db'),
+        JOB_STORE_DIR=os.path.join(work_dir, 'jobs'),
+        LLM_CACHE_DIR=os.path.join(work_dir, 'llm_cache'),
+        ENV_CACHE_DIR=os.environ.get('ENV_CACHE_DIR') or os.path.join(work_dir, 'envs'),
+    )
+    server = subprocess.Popen(shlex.split(args.server_cmd.format(port=server_port)), cwd=repo, env=env,
+                              stdout=log, stderr=subprocess.STDOUT)
+    processes = [server, fake]
+    try:
+        wait_http(f'http://127.0.0.1:{fake_port}/fake/settings')
+        wait_http(f'http://127.0.0.1:{server_port}/cache_stats')
+    except BenchmarkError:
+        stop_processes(processes)
+        raise
+    return f'http://127.0.0.1:{server_port}', server.pid, processes
+
+
+def stop_processes(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def run_benchmark(args):
+    work_dir = tempfile.mkdtemp(prefix='bench-')
+    processes = []
+    url, pid = args.url, args.server_pid
+    if args.spawn:
+        url, pid, processes = spawn(args, work_dir)
+    try:
+        recorder = Recorder()
+        sampler = MemorySampler(pid).start() if pid else None
+        routes = set(args.routes.split(','))
+        failures = []
+
+        def one(index):
+            try:
+                Flow(url, recorder, routes, args.use_cache, args.job_timeout).run(index)
+            except BenchmarkError as e:
+                failures.append(str(e))
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(one, range(args.flows)))
+        elapsed = time.monotonic() - started
+        memory = sampler.stop() if sampler else None
+    finally:
+        stop_processes(processes)
+
+    routes = recorder.summary()
+    requests_total = sum(route['count'] for name, route in routes.items() if name != 'project_job')
+    return {
+        'label': args.label,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'config': {
+            'flows': args.flows, 'concurrency': args.concurrency, 'routes': args.routes, 'use_cache': args.use_cache,
+            'server_cmd': args.server_cmd if args.spawn else args.url, 'latency': args.latency,
+            'tokens_per_sec': args.tokens_per_sec, 'error_rate': args.error_rate,
+        },
+        'elapsed': elapsed,
+        'flows_per_sec': (args.flows - len(failures)) / elapsed,
+        'requests_per_sec': requests_total / elapsed,
+        'failed_flows': len(failures),
+        'failure_samples': failures[:5],
+        'memory': memory,
+        'routes': routes,
+        'work_dir': work_dir,
+    }
+
+
+def save_result(result):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{result['label'] or 'run'}.json"
+    path = os.path.join(RESULTS_DIR, name)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=4)
+    return path
+
+
+def load_previous(compare, exclude):
+    if compare == 'latest':
+        paths = sorted(p for p in glob.glob(os.path.join(RESULTS_DIR, '*.json')) if os.path.abspath(p) != exclude)
+        if not paths:
+            return None, None
+        compare = paths[-1]
+    with open(compare, 'r', encoding='utf-8') as f:
+        return compare, json.load(f)
+
+
+def _ms(seconds):
+    return '-' if seconds is None else f'{seconds * 1000:.0f}'
+
+
+def _delta(current, previous):
+    if not previous or current is None:
+        return ''
+    return f' ({(current - previous) / previous * 100:+.0f}%)'
+
+
+def print_report(result, previous=None):
+    prev_routes = (previous or {}).get('routes', {})
+    print(f"flows {result['config']['flows']} x concurrency {result['config']['concurrency']} "
+          f"in {result['elapsed']:.1f}s, failed {result['failed_flows']}")
+    print(f"throughput {result['flows_per_sec']:.2f} flows/s{_delta(result['flows_per_sec'], (previous or {}).get('flows_per_sec'))}, "
+          f"{result['requests_per_sec']:.2f} req/s")
+    if result['memory']:
+        peak = result['memory']['peak']
+        prev_peak = ((previous or {}).get('memory') or {}).get('peak')
+        print(f"server memory peak {peak / 1024 / 1024:.1f} MB{_delta(peak, prev_peak)}")
+    print(f"{'route':<24}{'count':>7}{'errors':>8}{'p50 ms':>16}{'p95 ms':>16}{'p99 ms':>16}")
+    for name in ROUTES:
+        route = result['routes'].get(name)
+        if not route:
+            continue
+        prev = prev_routes.get(name, {})
+        print(f"{name:<24}{route['count']:>7}{route['errors']:>8}"
+              + ''.join(f"{_ms(route[p]) + _delta(route[p], prev.get(p)):>16}" for p in ('p50', 'p95', 'p99')))
+    for sample in result['failure_samples']:
+        print(f"  failure: {sample}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='fake provider 로 app.py 전체 흐름의 부하 테스트를 합니다.')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='--spawn 이 아닐 때 대상 서버')
+    parser.add_argument('--server-pid', type=int, help='--spawn 이 아닐 때 메모리를 잴 서버 프로세스')
+    parser.add_argument('--spawn', action='store_true', help='fake provider 와 서버를 띄워서 실행')
+    parser.add_argument('--server-cmd', default=DEFAULT_SERVER_CMD, help='{port} 는 서버 포트로 바뀐다')
+    parser.add_argument('--flows', type=int, default=20, help='진행할 프로젝트 흐름 수')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--routes', default=','.join(ROUTES), help='generate_project_code,modify_code,run_project 중 실행할 단계')
+    parser.add_argument('--use-cache', action='store_true', help='LLM 캐시를 쓴다 (기본은 bypass_cache)')
+    parser.add_argument('--job-timeout', type=float, default=600)
+    parser.add_argument('--latency', type=float, default=0.5, help='--spawn 일 때 fake provider 첫 토큰 지연(초)')
+    parser.add_argument('--tokens-per-sec', type=float, default=200)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--label', default='')
+    parser.add_argument('--compare', help="비교할 결과 파일 경로 또는 'latest'")
+    args = parser.parse_args()
+
+    result = run_benchmark(args)
+    path = save_result(result)
+    previous_path, previous = load_previous(args.compare, os.path.abspath(path)) if args.compare else (None, None)
+    if previous_path:
+        print(f"compared with {previous_path}")
+    print_report(result, previous)
+    print(f"saved {path}")
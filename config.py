@@ -3,3 +3,9 @@ import os
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'a_hard_to_guess_string'
     WTF_CSRF_ENABLED = True
+    JOB_STORE_DIR = os.environ.get('JOB_STORE_DIR') or 'jobs'
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS') or 2)
+    # asgi.py 로 실행할 때 동시에 진행하는 프로젝트 생성 작업 수
+    ASYNC_JOBS = int(os.environ.get('ASYNC_JOBS') or 256)
+    # 1 이면 설계 응답을 스트리밍으로 받으면서 완성된 파일부터 구현을 시작한다 (이전 생성 기록이 없을 때)
+    PIPELINE_PLAN = os.environ.get('PIPELINE_PLAN', '1') == '1'
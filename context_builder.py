@@ -0,0 +1,194 @@
+import os
+import re
+from ai_types import AiType
+from jobs import file_key
+from scheduler import extract_signatures
+from metrics import stage
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 프롬프트 입력에 쓸 최대 토큰 수. 출력(max_tokens)과 여유분을 뺀 값이다.
+# LLM_CONTEXT_BUDGET_GPT=60000 처럼 provider 별로 바꿀 수 있다.
+DEFAULT_CONTEXT_BUDGET = {
+    AiType.GPT: 60000,
+    AiType.ANTHROPIC: 80000,
+    AiType.CLOVARX: 6000,
+}
+
+# 토크나이저가 없을 때 토큰 하나에 해당하는 대략의 글자 수 (한글이 많으면 더 작아진다)
+CHARS_PER_TOKEN = {
+    AiType.GPT: 3.0,
+    AiType.ANTHROPIC: 3.0,
+    AiType.CLOVARX: 2.0,
+}
+
+# 프로젝트 설명/flowchart/함수 호출표 같은 공통 부분이 예산에서 차지할 수 있는 최대 비율
+HEADER_BUDGET_RATIO = 0.4
+
+_WORD_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]{2,}|[가-힣]{2,}')
+_encodings = {}
+
+
+class ContextBudgetError(Exception):
+    """사용자가 선택한 파일의 전체 내용이 토큰 예산에 들어가지 않는다."""
+
+
+def context_budget(ai_type):
+    value = os.environ.get(f'LLM_CONTEXT_BUDGET_{ai_type.upper()}')
+    return int(value) if value else DEFAULT_CONTEXT_BUDGET[ai_type]
+
+
+def count_tokens(text, ai_type=AiType.GPT):
+    if not text:
+        return 0
+    if ai_type == AiType.GPT and tiktoken is not None:
+        encoding = _encodings.get(ai_type)
+        if encoding is None:
+            encoding = _encodings[ai_type] = tiktoken.get_encoding('o200k_base')
+        return len(encoding.encode(text, disallowed_special=()))
+    # 한글은 거의 글자마다 토큰이 되므로 따로 센다
+    hangul = sum(1 for ch in text if '가' <= ch <= '힣')
+    return int(hangul + (len(text) - hangul) / CHARS_PER_TOKEN[ai_type]) + 1
+
+
+def truncate_to_tokens(text, max_tokens, ai_type=AiType.GPT):
+    """max_tokens 안에 들어가도록 뒤쪽을 잘라낸다."""
+    if count_tokens(text, ai_type) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle], ai_type) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low] + "\n...(생략)"
+
+
+def _words(text):
+    return {word.lower() for word in _WORD_RE.findall(text or '')}
+
+
+def _symbol_scores(query, symbols):
+    # 요청에 나온 식별자를 실제로 정의한 파일은 5점, 참조만 하는 파일은 2점
+    scores = {}
+    for name in set(re.findall(r'[A-Za-z_][A-Za-z0-9_]{2,}', query or '')):
+        for path in symbols.files_touching(name):
+            scores[path] = scores.get(path, 0) + 2
+        for location in symbols.find(name):
+            scores[location['path']] = scores.get(location['path'], 0) + 3
+    return scores
+
+
+def rank_files(query, files, contents, symbols=None):
+    """수정 요청(query)과 관련이 높은 순서로 파일을 정렬한다.
+
+    파일 이름과 functionList 에 요청의 단어가 나오면 높은 점수를, 본문에 나오면 낮은 점수를 준다.
+    symbols(ProjectSymbolIndex)가 있으면 요청의 식별자를 정의/참조하는 파일에 점수를 더한다.
+    """
+    query_words = _words(query)
+    symbol_scores = _symbol_scores(query, symbols) if symbols is not None else {}
+
+    def score(file_info):
+        name_words = _words(f"{file_info.get('path', '')} {file_info.get('fname', '')} "
+                            f"{file_info.get('objectName', '')} {' '.join(map(str, file_info.get('functionList', [])))}")
+        content_words = _words(contents.get(_file_key(file_info)))
+        return (3 * len(query_words & name_words) + len(query_words & content_words)
+                + symbol_scores.get(os.path.normpath(_file_key(file_info)), 0))
+
+    return sorted(files, key=lambda f: (-score(f), f.get('path', ''), f.get('fname', '')))
+
+
+def _file_key(file_info):
+    # UI 의 파일 목록은 최상위 파일의 path 를 '.' 로 보내므로 ('.', 'a.py') 와 ('', 'a.py') 를 같은 파일로 본다
+    return os.path.normpath(file_key(file_info.get('path', ''), file_info.get('fname', '')))
+
+
+def context_key(path, fname):
+    """build_file_context 가 돌려주는 full 집합의 키."""
+    return _file_key({'path': path, 'fname': fname})
+
+
+def merge_files(files, extra):
+    """files 에 없는 extra 파일을 뒤에 붙인다. 설계(code_structure)에 없는 파일을 사용자가 고른 경우에 쓴다."""
+    keys = {_file_key(f) for f in files}
+    merged = list(files)
+    for file_info in extra:
+        if _file_key(file_info) not in keys:
+            keys.add(_file_key(file_info))
+            merged.append(file_info)
+    return merged
+
+
+def summarize_file(file_info, content):
+    """본문 대신 넣을 짧은 요약. 파이썬 파일은 시그니처, 그 밖에는 functionList 나 첫 줄들."""
+    signatures = extract_signatures(file_info.get('fname', ''), content)
+    if signatures:
+        return signatures
+    if file_info.get('functionList'):
+        return '\n'.join(map(str, file_info['functionList']))
+    return '\n'.join((content or '').splitlines()[:10])
+
+
+@stage('prompt_build')
+def build_file_context(files, read_file, query, ai_type=AiType.GPT, header='', pinned=(), symbols=None):
+    """예산 안에서 파일 내용을 채운 프롬프트 조각과 공통 부분(header)을 돌려준다.
+
+    - header 는 예산의 HEADER_BUDGET_RATIO 까지만 쓰고 넘치면 잘라낸다
+    - pinned 에 있는 파일(사용자가 선택한 파일)은 files 에 없어도 항상 전체 내용을 넣는다.
+      다 들어가지 않으면 요약으로 바꾸지 않고 ContextBudgetError 를 낸다
+    - 나머지는 관련도 순서로 전체 내용을, 들어가지 않으면 시그니처 요약을, 그것도 안 되면 이름만 넣는다
+    반환값은 (header, files_section, full). full 은 전체 내용을 넣은 파일의 키(context_key) 집합이다.
+    요약만 보낸 파일을 모델이 전체 내용으로 다시 쓰면 실제 코드가 시그니처로 만든 코드로 바뀌므로
+    저장할 때 full 에 없는 기존 파일은 전체 내용으로 덮어쓰지 않는다.
+    """
+    budget = context_budget(ai_type)
+    header = truncate_to_tokens(header, int(budget * HEADER_BUDGET_RATIO), ai_type)
+    remaining = budget - count_tokens(header, ai_type) - count_tokens(query, ai_type)
+
+    files = merge_files(files, pinned)
+    contents = {}
+    for file_info in files:
+        content = read_file(file_info)
+        if content is not None:
+            contents[_file_key(file_info)] = content
+
+    pinned_keys = {_file_key(f) for f in pinned}
+    ordered = [f for f in files if _file_key(f) in pinned_keys]
+    ordered += rank_files(query, [f for f in files if _file_key(f) not in pinned_keys], contents, symbols)
+
+    full_parts = []
+    summary_parts = []
+    omitted = []
+    full = set()
+    for file_info in ordered:
+        key = _file_key(file_info)
+        if key not in contents:
+            continue
+        part = f"파일: {file_info['fname']} 내용:\n{contents[key]}\n\n"
+        cost = count_tokens(part, ai_type)
+        if cost <= remaining:
+            full_parts.append(part)
+            full.add(key)
+            remaining -= cost
+            continue
+        if key in pinned_keys:
+            raise ContextBudgetError(f'선택한 파일이 너무 커서 프롬프트에 모두 넣을 수 없습니다: {key}. '
+                                     f'선택한 파일 수를 줄여주세요.')
+        summary = f"파일: {file_info['fname']} (요약, 시그니처만):\n{summarize_file(file_info, contents[key])}\n\n"
+        cost = count_tokens(summary, ai_type)
+        if cost <= remaining:
+            summary_parts.append(summary)
+            remaining -= cost
+        else:
+            omitted.append(key)
+
+    section = ''.join(full_parts) + ''.join(summary_parts)
+    if omitted:
+        section += f"(토큰 예산 때문에 생략된 파일: {', '.join(omitted)})\n\n"
+    if summary_parts or omitted:
+        section += "(요약만 보냈거나 생략한 파일은 전체 내용을 다시 쓰지 마. 고쳐야 하면 patches 로 바뀌는 부분만 줘.)\n\n"
+    return header, section, full
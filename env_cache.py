@@ -0,0 +1,285 @@
+import argparse
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+# 생성된 앱의 requirements.txt 별로 만들어두는 virtualenv 위치
+ENV_CACHE_DIR = os.environ.get('ENV_CACHE_DIR') or 'envs'
+# 패키지를 설치할 wheel 디렉터리. 설정하지 않으면 env 를 만들지 않고 지금처럼 서버의 python 으로 실행한다
+WHEELHOUSE = os.environ.get('ENV_WHEELHOUSE') or ''
+# env 전체가 쓸 수 있는 디스크 용량(MB)과 최대 개수. 넘으면 가장 오래 쓰지 않은 env 부터 지운다
+DISK_QUOTA_MB = int(os.environ.get('ENV_CACHE_QUOTA_MB') or 4096)
+MAX_ENVS = int(os.environ.get('ENV_CACHE_MAX_ENVS') or 50)
+BUILD_TIMEOUT = int(os.environ.get('ENV_BUILD_TIMEOUT') or 600)
+
+READY_FILE = '.ready'
+_NAME_RE = re.compile(r'^([A-Za-z0-9][A-Za-z0-9._-]*)(.*)$')
+
+
+class EnvBuildError(Exception):
+    def __init__(self, message, logs=None):
+        super().__init__(message)
+        self.logs = logs or []
+
+
+def normalize_requirements(content):
+    """주석/빈 줄/공백/대소문자/순서 차이를 없앤 requirements 줄 목록. 같은 의존성이면 같은 결과가 나온다."""
+    lines = set()
+    for line in (content or '').splitlines():
+        line = line.split('#', 1)[0].strip()
+        if not line or line.startswith('-'):
+            # -r / -e / --index-url 같은 옵션은 오프라인 설치에 쓰지 않는다
+            continue
+        line = re.sub(r'\s+', '', line)
+        match = _NAME_RE.match(line)
+        if match:
+            # PEP 503 이름 정규화
+            line = re.sub(r'[-_.]+', '-', match.group(1)).lower() + match.group(2)
+        lines.add(line)
+    return sorted(lines)
+
+
+def _requirement_name(line):
+    match = _NAME_RE.match(line)
+    return re.split(r'[\[<>=!~;@]', match.group(1) + match.group(2), 1)[0] if match else ''
+
+
+def requirements_key(requirements):
+    data = '\n'.join(requirements) + f'\npython={sys.version_info.major}.{sys.version_info.minor}'
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()[:16]
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class EnvCache:
+    """requirements.txt 해시로 찾는 virtualenv 캐시.
+
+    같은 requirements 를 쓰는 프로젝트는 env 하나를 같이 쓴다. env 는 WHEELHOUSE 의 wheel 로만
+    (--no-index) 설치하므로 실행할 때 네트워크가 필요 없고, 이미 만들어진 env 는 디렉터리 확인만으로 찾는다.
+    만드는 중인 env 는 임시 디렉터리에 만든 뒤 이름을 바꾸고, 여러 프로세스가 같은 env 를 동시에 만들지 않도록
+    파일 잠금({key}.lock)을 쓴다. 마지막으로 쓴 시각은 .ready 파일의 mtime 으로 기록해서 LRU 정리에 쓴다.
+    env 로 실행한 앱은 같은 잠금 파일의 공유 잠금(lease)을 물려받아 살아 있는 동안 들고 있고, evict 는 배타 잠금을
+    바로 잡을 수 있는(어느 프로세스도 쓰지 않는) env 만 지운다.
+    """
+
+    def __init__(self, root=ENV_CACHE_DIR, wheelhouse=WHEELHOUSE, quota_mb=DISK_QUOTA_MB, max_envs=MAX_ENVS):
+        # 앱은 프로젝트 디렉터리에서 실행하므로 절대 경로로 둔다
+        self.root = os.path.abspath(root)
+        self.wheelhouse = wheelhouse
+        self.quota_bytes = quota_mb * 1024 * 1024
+        self.max_envs = max_envs
+        self._sizes = {}  # key -> (.ready 의 inode, 크기). 만들어진 env 는 바뀌지 않으므로 한 번만 잰다
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.wheelhouse)
+
+    def env_dir(self, key):
+        return os.path.join(self.root, key)
+
+    @staticmethod
+    def python_path(env_dir):
+        return os.path.join(env_dir, 'bin', 'python')
+
+    def _ready(self, env_dir):
+        return os.path.exists(os.path.join(env_dir, READY_FILE))
+
+    def _touch(self, env_dir):
+        try:
+            os.utime(os.path.join(env_dir, READY_FILE))
+        except OSError:
+            pass
+
+    def _lock_path(self, key):
+        return os.path.join(self.root, f'{key}.lock')
+
+    def python_for(self, project_path, running_pythons=()):
+        """project_path 의 requirements.txt 에 맞는 env 의 python. 캐시를 쓰지 않으면 서버의 python.
+
+        미리 만들어두기처럼 앱을 바로 실행하지 않을 때 쓴다. 실행할 때는 lease_for 를 쓴다.
+        """
+        python, lease = self.lease_for(project_path, running_pythons)
+        if lease is not None:
+            lease.close()
+        return python
+
+    def lease_for(self, project_path, running_pythons=()):
+        """(python, lease). lease 는 env 의 공유 잠금을 잡은 열린 파일이고 캐시를 쓰지 않으면 None.
+
+        lease 를 실행할 앱에 물려준 뒤(pass_fds) 닫으면 앱이 살아 있는 동안 env 가 지워지지 않는다.
+        running_pythons 는 이 프로세스에서 실행 중인 앱들의 python 경로로, 그 env 도 정리 대상에서 뺀다.
+        """
+        requirements_path = os.path.join(project_path, 'requirements.txt')
+        if not self.enabled or not os.path.exists(requirements_path):
+            return sys.executable, None
+        with open(requirements_path, 'r', encoding='utf-8') as f:
+            requirements = normalize_requirements(f.read())
+        if not requirements:
+            return sys.executable, None
+        # 앱은 python -m flask run 으로 띄우므로 requirements 에 빠져 있어도 flask 는 설치한다
+        if not any(_requirement_name(line) == 'flask' for line in requirements):
+            requirements = sorted(requirements + ['flask'])
+        in_use = [os.path.dirname(os.path.dirname(python)) for python in running_pythons]
+        env_dir, lease = self.ensure(requirements, in_use)
+        return self.python_path(env_dir), lease
+
+    def ensure(self, requirements, in_use=()):
+        """(env 디렉터리, lease). 없으면 만든다. 실패하면 EnvBuildError.
+
+        lease 는 env 의 공유 잠금을 잡은 열린 파일로, 닫을 때까지 어느 프로세스의 evict 도 이 env 를 지우지 않는다.
+        """
+        key = requirements_key(requirements)
+        env_dir = self.env_dir(key)
+        os.makedirs(self.root, exist_ok=True)
+        lease = open(self._lock_path(key), 'a')
+        try:
+            fcntl.flock(lease, fcntl.LOCK_SH)
+            while not self._ready(env_dir):
+                # 만드는 동안만 배타 잠금으로 바꾼다 (flock 은 파일을 따로 연 스레드끼리도 막는다).
+                # 기다리는 동안 다른 스레드/프로세스가 만들었을 수 있고, 공유 잠금으로 돌아가기 전에 지워졌으면 다시 만든다
+                fcntl.flock(lease, fcntl.LOCK_UN)
+                fcntl.flock(lease, fcntl.LOCK_EX)
+                if not self._ready(env_dir):
+                    self._build(env_dir, requirements)
+                fcntl.flock(lease, fcntl.LOCK_SH)
+        except BaseException:
+            lease.close()
+            raise
+        self._touch(env_dir)
+        self.evict(in_use=set(in_use) | {env_dir})
+        return env_dir, lease
+
+    def _build(self, env_dir, requirements):
+        started = time.time()
+        tmp_dir = f'{env_dir}.{os.getpid()}.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        try:
+            # pip 는 서버의 것을 --python 으로 써서 env 마다 pip 를 설치하지 않는다
+            commands = [
+                [sys.executable, '-m', 'venv', '--without-pip', tmp_dir],
+                [sys.executable, '-m', 'pip', '--python', self.python_path(tmp_dir), 'install',
+                 '--no-index', '--find-links', self.wheelhouse, '--disable-pip-version-check', '--quiet',
+                 *requirements],
+            ]
+            for command in commands:
+                result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        universal_newlines=True, timeout=BUILD_TIMEOUT)
+                if result.returncode != 0:
+                    raise EnvBuildError('실행 환경을 만들지 못했습니다.', result.stdout.splitlines()[-50:])
+            with open(os.path.join(tmp_dir, READY_FILE), 'w', encoding='utf-8') as f:
+                f.write('\n'.join(requirements))
+            shutil.rmtree(env_dir, ignore_errors=True)
+            os.replace(tmp_dir, env_dir)
+        except subprocess.TimeoutExpired:
+            raise EnvBuildError('실행 환경을 만드는 시간이 초과되었습니다.')
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        print(f"Built env {os.path.basename(env_dir)} ({len(requirements)} requirements) in {time.time() - started:.1f}s")
+
+    def envs(self):
+        """만들어진 env 목록 [{'key', 'path', 'last_used', 'size'}], 오래 쓰지 않은 순서."""
+        if not os.path.isdir(self.root):
+            return []
+        result = []
+        for name in os.listdir(self.root):
+            path = self.env_dir(name)
+            ready = os.path.join(path, READY_FILE)
+            if name.endswith(('.lock', '.tmp')) or not os.path.exists(ready):
+                continue
+            try:
+                stat = os.stat(ready)
+            except FileNotFoundError:
+                continue
+            result.append({'key': name, 'path': path, 'last_used': stat.st_mtime,
+                           'size': self._size(name, path, stat.st_ino)})
+        return sorted(result, key=lambda env: env['last_used'])
+
+    def _size(self, key, path, ready_inode):
+        with self._lock:
+            cached = self._sizes.get(key)
+        if cached is not None and cached[0] == ready_inode:
+            return cached[1]
+        size = _dir_size(path)
+        with self._lock:
+            self._sizes[key] = (ready_inode, size)
+        return size
+
+    def _remove_unused(self, env):
+        """어느 프로세스도 lease 를 들고 있지 않으면 env 를 지우고 True."""
+        with open(self._lock_path(env['key']), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            # .ready 를 먼저 지워서 지우는 도중의 env 를 쓰지 않게 한다
+            try:
+                os.remove(os.path.join(env['path'], READY_FILE))
+            except FileNotFoundError:
+                pass
+            shutil.rmtree(env['path'], ignore_errors=True)
+        with self._lock:
+            self._sizes.pop(env['key'], None)
+        return True
+
+    def evict(self, in_use=()):
+        """MAX_ENVS 와 디스크 용량을 넘으면 in_use 가 아니고 lease 도 없는 env 를 오래 쓰지 않은 순서로 지운다."""
+        in_use = {os.path.abspath(path) for path in in_use}
+        envs = self.envs()
+        total = sum(env['size'] for env in envs)
+        count = len(envs)
+        removed = []
+        for env in envs:
+            if count <= self.max_envs and total <= self.quota_bytes:
+                break
+            if os.path.abspath(env['path']) in in_use or not self._remove_unused(env):
+                continue
+            total -= env['size']
+            count -= 1
+            removed.append(env['key'])
+        if removed:
+            print(f"Evicted envs {removed}")
+        return removed
+
+    def stats(self):
+        envs = self.envs()
+        return {
+            'enabled': self.enabled,
+            'envs': len(envs),
+            'size': sum(env['size'] for env in envs),
+            'quota': self.quota_bytes,
+        }
+
+
+env_cache = EnvCache()
+
+
+if __name__ == '__main__':
+    # python env_cache.py --build code/{account_guid}/{project_guid}/app   (배포 전에 미리 만들어두기)
+    # python env_cache.py --prune
+    parser = argparse.ArgumentParser(description='생성된 앱의 실행 환경 캐시를 관리합니다.')
+    parser.add_argument('--build', metavar='PROJECT_APP_DIR', nargs='*', default=[])
+    parser.add_argument('--prune', action='store_true')
+    args = parser.parse_args()
+    if not env_cache.enabled:
+        parser.error('ENV_WHEELHOUSE 가 설정되어 있지 않습니다.')
+    for project_path in args.build:
+        print(project_path, env_cache.python_for(project_path))
+    if args.prune:
+        env_cache.evict()
+    print(env_cache.stats())
@@ -0,0 +1,326 @@
+import argparse
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from flask import Flask, Response, request, jsonify
+
+# OpenAI chat completions, Anthropic messages, ClovaX chat-completions(SSE) 형식으로 답하는 가짜 provider.
+# 토큰 비용 없이 app.py / asgi.py 를 부하 테스트할 때 쓴다.
+#
+# python fake_provider.py --port 8900 --latency 0.5 --tokens-per-sec 200 --error-rate 0.01
+# OpenaiAPI=fake OpenaiBaseUrl=http://127.0.0.1:8900/v1 \
+# Anthropic3API=fake Anthropic3BaseUrl=http://127.0.0.1:8900 \
+# CloverAPI=fake CloverAPIPrimary=fake CloverHost=http://127.0.0.1:8900 python app.py
+
+# 첫 토큰까지의 시간(초)과 흔들림, 초당 토큰 수, 에러(429/500/529) 비율
+LATENCY = float(os.environ.get('FAKE_LLM_LATENCY') or 0.5)
+LATENCY_JITTER = float(os.environ.get('FAKE_LLM_LATENCY_JITTER') or 0.1)
+TOKENS_PER_SEC = float(os.environ.get('FAKE_LLM_TOKENS_PER_SEC') or 200)
+ERROR_RATE = float(os.environ.get('FAKE_LLM_ERROR_RATE') or 0)
+# [{"match": "프롬프트에 들어 있는 문자열", "response": "응답"}] 형식의 JSON 파일. 앞에서부터 먼저 맞는 것을 쓴다
+RESPONSES_FILE = os.environ.get('FAKE_LLM_RESPONSES') or ''
+# 토큰 하나로 보내는 글자 수
+TOKEN_CHARS = 4
+
+app = Flask(__name__)
+settings = {
+    'latency': LATENCY,
+    'latency_jitter': LATENCY_JITTER,
+    'tokens_per_sec': TOKENS_PER_SEC,
+    'error_rate': ERROR_RATE,
+    'responses': [],
+}
+counters = {'requests': 0, 'errors': 0, 'tokens': 0}
+_counters_lock = threading.Lock()
+
+CALL_CHART = {
+    "1": {
+        "title": "메인 페이지",
+        "functions": [
+            {"name": "app.index", "description": "메인 페이지 표시", "parameters": []},
+            {"name": "utils.greeting", "description": "인사말 생성", "parameters": [{"name": "name", "type": "string"}]},
+        ],
+    },
+}
+
+CODE_STRUCTURE = {
+    "plan": "인사말을 보여주는 flask 앱",
+    "Files": [
+        {"path": "app", "fname": "utils.py", "objectName": "NoneObject", "functionList": ["greeting(name)"]},
+        {"path": "app", "fname": "app.py", "objectName": "NoneObject", "functionList": ["index()"]},
+        {"path": "app/templates", "fname": "index.html"},
+        {"path": "app", "fname": "requirements.txt"},
+    ],
+}
+
+FILES = {
+    'app.py': '''from flask import Flask, render_template
+from utils import greeting
+
+app = Flask(__name__)
+
+
+@app.route('/')
+def index():
+    return render_template('index.html', message=greeting('world'))
+''',
+    'utils.py': '''def greeting(name):
+    return f'Hello, {name}!'
+''',
+    'index.html': '''<!DOCTYPE html>
+<html>
+<body>
+    <h1>{{ message }}</h1>
+</body>
+</html>
+''',
+    'requirements.txt': 'flask\n',
+}
+
+
+def canned_response(prompt):
+    """프롬프트 종류를 보고 app.py 가 그대로 처리할 수 있는 응답을 만든다."""
+    for item in settings['responses']:
+        if item.get('match', '') in prompt:
+            return item['response']
+    if '고쳐서 다시 줘' in prompt:
+        match = re.search(r'JSON:\n(.*)$', prompt, re.DOTALL)
+        return match.group(1).strip() if match else '{}'
+    if '설계파일' in prompt:
+        return '```json\n' + json.dumps(CODE_STRUCTURE, ensure_ascii=False, indent=4) + '\n```'
+    if '함수 호출표를 만들어줘' in prompt:
+        return json.dumps(CALL_CHART, ensure_ascii=False, indent=4)
+    match = re.search(r'implement the functions for the file (\S+?):', prompt)
+    if match:
+        fname = match.group(1)
+        content = FILES.get(fname, f'# {fname}\n')
+        language = 'html' if fname.endswith('.html') else 'python' if fname.endswith('.py') else ''
+        return f'```{language}\n{content}```'
+    if '파일들의 내용' in prompt:
+        content = FILES['app.py'] + f"\n\n# modified {uuid.uuid4().hex[:8]}\n"
+        return json.dumps({'app.py': {'content': content}}, ensure_ascii=False)
+    return '{"result": "ok"}'
+
+
+def _tokens(text):
+    return [text[i:i + TOKEN_CHARS] for i in range(0, len(text), TOKEN_CHARS)] or ['']
+
+
+def _count(key, value=1):
+    with _counters_lock:
+        counters[key] += value
+
+
+def _wait_first_token():
+    latency = settings['latency'] + random.uniform(-1, 1) * settings['latency_jitter']
+    if latency > 0:
+        time.sleep(latency)
+
+
+def _wait_tokens(count):
+    if settings['tokens_per_sec'] > 0:
+        time.sleep(count / settings['tokens_per_sec'])
+
+
+def _stream_tokens(text):
+    """첫 토큰 지연 후 tokens_per_sec 속도로 토큰을 하나씩 돌려준다."""
+    _wait_first_token()
+    for token in _tokens(text):
+        _wait_tokens(1)
+        yield token
+
+
+def _fail(kind):
+    """error_rate 확률로 provider 와 같은 형식의 에러 응답을 만든다. 아니면 None."""
+    if random.random() >= settings['error_rate']:
+        return None
+    _count('errors')
+    status = random.choice([429, 500, 529 if kind == 'anthropic' else 503])
+    headers = {'retry-after': '0'} if status == 429 else {}
+    if kind == 'anthropic':
+        error_type = {429: 'rate_limit_error', 500: 'api_error', 529: 'overloaded_error'}[status]
+        body = {'type': 'error', 'error': {'type': error_type, 'message': 'fake error'}}
+    else:
+        body = {'error': {'message': 'fake error', 'type': 'server_error', 'code': status}}
+    return jsonify(body), status, headers
+
+
+def _usage_tokens(text):
+    return max(1, len(text) // TOKEN_CHARS)
+
+
+def _prompt_text(messages):
+    parts = []
+    for message in messages or []:
+        content = message.get('content', '')
+        if isinstance(content, list):
+            content = ''.join(block.get('text', '') for block in content if isinstance(block, dict))
+        parts.append(content)
+    return '\n'.join(parts)
+
+
+def _sse(data, event=None):
+    prefix = f'event: {event}\n' if event else ''
+    return f'{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+RATE_LIMIT_HEADERS = {
+    'x-ratelimit-limit-requests': '100000',
+    'x-ratelimit-remaining-requests': '99999',
+}
+
+
+@app.route('/v1/chat/completions', methods=['POST'])
+def openai_chat_completions():
+    error = _fail('openai')
+    if error:
+        return error
+    body = request.get_json()
+    prompt = _prompt_text(body.get('messages'))
+    text = canned_response(prompt)
+    model = body.get('model', 'fake')
+    completion_id = f'chatcmpl-{uuid.uuid4().hex}'
+    _count('requests')
+    _count('tokens', len(_tokens(text)))
+
+    if not body.get('stream'):
+        _wait_first_token()
+        _wait_tokens(len(_tokens(text)))
+        return jsonify({
+            'id': completion_id,
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': _usage_tokens(prompt), 'completion_tokens': _usage_tokens(text),
+                      'total_tokens': _usage_tokens(prompt) + _usage_tokens(text)},
+        }), 200, RATE_LIMIT_HEADERS
+
+    def events():
+        def chunk(delta, finish_reason=None):
+            return {
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+            }
+        yield _sse(chunk({'role': 'assistant', 'content': ''}))
+        for token in _stream_tokens(text):
+            yield _sse(chunk({'content': token}))
+        yield _sse(chunk({}, 'stop'))
+        yield 'data: [DONE]\n\n'
+
+    return Response(events(), mimetype='text/event-stream', headers=RATE_LIMIT_HEADERS)
+
+
+@app.route('/v1/messages', methods=['POST'])
+def anthropic_messages():
+    error = _fail('anthropic')
+    if error:
+        return error
+    body = request.get_json()
+    messages = body.get('messages') or []
+    prompt = _prompt_text(messages)
+    text = canned_response(prompt)
+    # assistant 메시지로 응답 앞부분을 채워 보냈으면(prefill) 그 뒤부터 돌려준다
+    if messages and messages[-1].get('role') == 'assistant':
+        prefill = _prompt_text(messages[-1:])
+        start = text.find(prefill)
+        text = text[start + len(prefill):] if start >= 0 else text
+    model = body.get('model', 'fake')
+    message_id = f'msg_{uuid.uuid4().hex}'
+    usage = {'input_tokens': _usage_tokens(prompt), 'output_tokens': _usage_tokens(text)}
+    _count('requests')
+    _count('tokens', len(_tokens(text)))
+
+    if not body.get('stream'):
+        _wait_first_token()
+        _wait_tokens(len(_tokens(text)))
+        return jsonify({
+            'id': message_id,
+            'type': 'message',
+            'role': 'assistant',
+            'model': model,
+            'content': [{'type': 'text', 'text': text}],
+            'stop_reason': 'end_turn',
+            'stop_sequence': None,
+            'usage': usage,
+        })
+
+    def events():
+        yield _sse({'type': 'message_start', 'message': {
+            'id': message_id, 'type': 'message', 'role': 'assistant', 'model': model, 'content': [],
+            'stop_reason': None, 'stop_sequence': None, 'usage': {'input_tokens': usage['input_tokens'],
+                                                                  'output_tokens': 0}}},
+                   event='message_start')
+        yield _sse({'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}},
+                   event='content_block_start')
+        for token in _stream_tokens(text):
+            yield _sse({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': token}},
+                       event='content_block_delta')
+        yield _sse({'type': 'content_block_stop', 'index': 0}, event='content_block_stop')
+        yield _sse({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                    'usage': {'output_tokens': usage['output_tokens']}}, event='message_delta')
+        yield _sse({'type': 'message_stop'}, event='message_stop')
+
+    return Response(events(), mimetype='text/event-stream')
+
+
+@app.route('/testapp/v1/chat-completions/<model>', methods=['POST'])
+def clovax_chat_completions(model):
+    error = _fail('clovax')
+    if error:
+        return error
+    body = request.get_json()
+    prompt = _prompt_text(body.get('messages'))
+    text = canned_response(prompt)
+    _count('requests')
+    _count('tokens', len(_tokens(text)))
+
+    def events():
+        for index, token in enumerate(_stream_tokens(text)):
+            yield _sse({'index': index, 'inputLength': 0, 'outputLength': 1,
+                        'message': {'role': 'assistant', 'content': token}}, event='token')
+        yield _sse({'index': 0, 'message': {'role': 'assistant', 'content': text}, 'stopReason': 'stop_before',
+                    'inputLength': _usage_tokens(prompt), 'outputLength': _usage_tokens(text)}, event='result')
+
+    return Response(events(), mimetype='text/event-stream')
+
+
+@app.route('/fake/settings', methods=['GET', 'POST'])
+def fake_settings():
+    """실행 중에 지연/속도/에러 비율을 바꾸거나 요청 수를 확인한다."""
+    if request.method == 'POST':
+        for key, value in (request.get_json() or {}).items():
+            if key in settings and key != 'responses':
+                settings[key] = float(value)
+    with _counters_lock:
+        stats = dict(counters)
+    return jsonify({key: value for key, value in settings.items() if key != 'responses'} | stats)
+
+
+def load_responses(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='부하 테스트용 가짜 LLM provider 서버')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', type=float, default=LATENCY, help='첫 토큰까지의 시간(초)')
+    parser.add_argument('--latency-jitter', type=float, default=LATENCY_JITTER)
+    parser.add_argument('--tokens-per-sec', type=float, default=TOKENS_PER_SEC)
+    parser.add_argument('--error-rate', type=float, default=ERROR_RATE)
+    parser.add_argument('--responses', default=RESPONSES_FILE, help='canned 응답 JSON 파일')
+    args = parser.parse_args()
+    settings.update(latency=args.latency, latency_jitter=args.latency_jitter,
+                    tokens_per_sec=args.tokens_per_sec, error_rate=args.error_rate)
+    if args.responses:
+        settings['responses'] = load_responses(args.responses)
+    app.run(host=args.host, port=args.port, threaded=True)
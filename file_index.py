@@ -0,0 +1,201 @@
+import hashlib
+import os
+import threading
+from stat import S_ISREG
+from collections import OrderedDict
+
+# 이보다 큰 파일은 내용을 메모리에 두지 않고 메타데이터만 관리한다
+MAX_CACHED_FILE_BYTES = 1024 * 1024
+
+
+class ProjectFileIndex:
+    """code/{account_guid}/{project_guid} 아래 파일 목록과 내용을 메모리에 둔다.
+
+    목록은 디렉터리 mtime 이 바뀌었을 때만 다시 훑고, 파일 내용은 mtime/size 가 같으면 캐시에서 돌려준다.
+    save_file 등에서 notify_write 로 알려주면 디스크를 다시 읽지 않고 바로 갱신한다.
+    """
+
+    def __init__(self, root, cache_contents=True):
+        self.root = root
+        self.cache_contents = cache_contents
+        self._entries = {}  # rel_path -> {'size', 'mtime', 'sha256', 'content'}
+        self._dir_mtimes = None  # rel_dir -> mtime, None 이면 아직 훑지 않음
+        self._lock = threading.Lock()
+        self.content_bytes = 0
+
+    @staticmethod
+    def _normalize(rel_path):
+        return os.path.normpath(rel_path).lstrip(os.sep)
+
+    def _dirs_changed(self):
+        if self._dir_mtimes is None:
+            return True
+        for rel_dir, mtime in self._dir_mtimes.items():
+            try:
+                if os.stat(os.path.join(self.root, rel_dir)).st_mtime != mtime:
+                    return True
+            except FileNotFoundError:
+                return True
+        return False
+
+    def _rescan(self):
+        dir_mtimes = {}
+        seen = set()
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            rel_dir = os.path.relpath(dirpath, self.root)
+            dir_mtimes[rel_dir] = os.stat(dirpath).st_mtime
+            for name in filenames:
+                rel_path = self._normalize(os.path.join(rel_dir, name))
+                seen.add(rel_path)
+                self._entries.setdefault(rel_path, None)
+        for rel_path in list(self._entries):
+            if rel_path not in seen:
+                self._drop(rel_path)
+        self._dir_mtimes = dir_mtimes
+
+    def _drop(self, rel_path):
+        entry = self._entries.pop(rel_path, None)
+        if entry and entry.get('content') is not None:
+            self.content_bytes -= entry['size']
+
+    def _store(self, rel_path, stat, content):
+        self._drop(rel_path)
+        data = content.encode('utf-8')
+        entry = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha256': hashlib.sha256(data).hexdigest(),
+            'content': None,
+        }
+        if self.cache_contents and len(data) <= MAX_CACHED_FILE_BYTES:
+            entry['content'] = content
+            self.content_bytes += entry['size']
+        self._entries[rel_path] = entry
+        return entry
+
+    def list_files(self):
+        with self._lock:
+            if self._dirs_changed():
+                self._rescan()
+            return sorted(self._entries)
+
+    def read(self, rel_path):
+        """파일 내용을 돌려준다. 파일이 없으면 None."""
+        rel_path = self._normalize(rel_path)
+        full_path = os.path.join(self.root, rel_path)
+        with self._lock:
+            try:
+                stat = os.stat(full_path)
+            except FileNotFoundError:
+                self._drop(rel_path)
+                return None
+            if not S_ISREG(stat.st_mode):
+                return None
+            entry = self._entries.get(rel_path)
+            if (entry and entry['content'] is not None
+                    and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size):
+                return entry['content']
+            with open(full_path, 'r', encoding='utf-8') as f:
+                content = f.read()
+            self._store(rel_path, stat, content)
+            return content
+
+    def exists(self, rel_path):
+        return os.path.exists(os.path.join(self.root, self._normalize(rel_path)))
+
+    def describe(self, rel_path):
+        """path, size, sha256 메타데이터. 내용이 아직 인덱스에 없으면 한 번 읽는다."""
+        rel_path = self._normalize(rel_path)
+        if self.read(rel_path) is None:
+            return None
+        with self._lock:
+            entry = self._entries[rel_path]
+            return {'path': rel_path, 'size': entry['size'], 'sha256': entry['sha256']}
+
+    def modified_at(self):
+        """(가장 최근에 바뀐 파일의 mtime, 파일 수). 내용은 읽지 않고 stat 만 한다."""
+        files = self.list_files()
+        latest = 0.0
+        for rel_path in files:
+            try:
+                latest = max(latest, os.stat(os.path.join(self.root, rel_path)).st_mtime)
+            except FileNotFoundError:
+                pass
+        return latest, len(files)
+
+    def notify_write(self, rel_path, content):
+        rel_path = self._normalize(rel_path)
+        full_path = os.path.join(self.root, rel_path)
+        with self._lock:
+            try:
+                stat = os.stat(full_path)
+            except FileNotFoundError:
+                self._drop(rel_path)
+                return
+            # 새 파일이면 디렉터리 mtime 이 바뀌어 다음 list_files 때 목록에도 반영된다
+            self._store(rel_path, stat, content)
+
+    def evict_contents(self):
+        with self._lock:
+            for entry in self._entries.values():
+                if entry and entry.get('content') is not None:
+                    entry['content'] = None
+            self.content_bytes = 0
+
+
+class FileIndexRegistry:
+    """프로젝트별 ProjectFileIndex 를 관리한다.
+
+    캐시된 내용의 총합이 memory_budget 을 넘으면 가장 오래 쓰이지 않은 프로젝트부터 인덱스를 버린다.
+    """
+
+    def __init__(self, base_dir='code', memory_budget=64 * 1024 * 1024):
+        self.base_dir = base_dir
+        self.memory_budget = memory_budget
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, account_guid, project_guid):
+        key = (account_guid, project_guid)
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is None:
+                index = ProjectFileIndex(os.path.join(self.base_dir, account_guid, project_guid))
+                self._indexes[key] = index
+            self._indexes.move_to_end(key)
+            return index
+
+    def _enforce_budget(self):
+        with self._lock:
+            total = sum(index.content_bytes for index in self._indexes.values())
+            while total > self.memory_budget and len(self._indexes) > 1:
+                key, index = self._indexes.popitem(last=False)
+                total -= index.content_bytes
+            if total > self.memory_budget and self._indexes:
+                # 프로젝트 하나만으로 예산을 넘으면 목록/해시만 남기고 내용을 비운다
+                next(reversed(self._indexes.values())).evict_contents()
+
+    def read(self, account_guid, project_guid, rel_path):
+        content = self.get(account_guid, project_guid).read(rel_path)
+        self._enforce_budget()
+        return content
+
+    def list_files(self, account_guid, project_guid):
+        return self.get(account_guid, project_guid).list_files()
+
+    def notify_write(self, account_guid, project_guid, rel_path, content):
+        self.get(account_guid, project_guid).notify_write(rel_path, content)
+        self._enforce_budget()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'projects': len(self._indexes),
+                'content_bytes': sum(index.content_bytes for index in self._indexes.values()),
+                'memory_budget': self.memory_budget,
+            }
+
+
+# 파일 시스템 저장소(storage.FileSystemStorage)와 같은 디렉터리를 본다
+file_index = FileIndexRegistry(base_dir=os.environ.get('STORAGE_BASE_DIR') or 'code',
+                               memory_budget=int(os.environ.get('FILE_INDEX_MEMORY_BYTES') or 64 * 1024 * 1024))
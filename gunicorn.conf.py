@@ -0,0 +1,14 @@
+import os
+
+# gunicorn -c gunicorn.conf.py app:app
+# 프로젝트 정보는 요청마다 ProjectContext 로 넘기므로 여러 프로세스 / 스레드로 실행할 수 있다.
+bind = os.environ.get('BIND') or '0.0.0.0:5000'
+workers = int(os.environ.get('WEB_CONCURRENCY') or 2)
+# LLM rate limit 은 worker 마다 따로 세므로 worker 끼리 한도를 나눠 쓰도록 알려준다 (fork 한 worker 가 물려받는다)
+os.environ.setdefault('RATE_LIMIT_PROCESSES', str(workers))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS') or 8)
+# SSE 스트리밍 응답이 오래 열려 있으므로 넉넉하게 잡는다
+timeout = int(os.environ.get('WEB_TIMEOUT') or 600)
+# 작업 큐 / worker pool 스레드는 fork 이후 각 worker 에서 만들어져야 하므로 preload 하지 않는다
+preload_app = False
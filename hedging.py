@@ -0,0 +1,250 @@
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from ai_types import AiType
+import tracing
+
+HEDGING_ENABLED = os.environ.get('LLM_HEDGING', '0') == '1'
+# 이 백분위 지연 시간을 넘기면 다른 provider 로 같은 요청을 하나 더 보낸다
+HEDGE_PERCENTILE = float(os.environ.get('LLM_HEDGE_PERCENTILE') or 95)
+# 지연 시간 표본이 충분하지 않을 때 쓰는 hedge 대기 시간(초)
+HEDGE_DEFAULT_DELAY = float(os.environ.get('LLM_HEDGE_DEFAULT_DELAY') or 60)
+HEDGE_MIN_SAMPLES = 20
+
+FAILOVER_ENABLED = os.environ.get('LLM_FAILOVER', '1') == '1'
+FAILOVER_ERROR_RATE = float(os.environ.get('LLM_FAILOVER_ERROR_RATE') or 0.5)
+FAILOVER_MIN_SAMPLES = 10
+FAILOVER_COOLDOWN = float(os.environ.get('LLM_FAILOVER_COOLDOWN') or 60)
+
+# max_tokens 가 이보다 작은 provider 는 fallback/hedge 대상에서 뺀다 (ClovarX 762 는 파일 하나도 잘린다)
+FALLBACK_MIN_MAX_TOKENS = int(os.environ.get('LLM_FALLBACK_MIN_MAX_TOKENS') or 2048)
+
+FALLBACK_ORDER = {
+    AiType.GPT: [AiType.ANTHROPIC, AiType.CLOVARX],
+    AiType.ANTHROPIC: [AiType.GPT, AiType.CLOVARX],
+    AiType.CLOVARX: [AiType.GPT, AiType.ANTHROPIC],
+}
+
+
+def _percentile(latencies, percentile):
+    if len(latencies) < HEDGE_MIN_SAMPLES:
+        return None
+    index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+    return latencies[index]
+
+
+class ProviderHealth:
+    """provider 별 최근 지연 시간과 성공/실패 기록.
+
+    최근 window 개 호출 중 실패 비율이 FAILOVER_ERROR_RATE 를 넘으면 FAILOVER_COOLDOWN 초 동안
+    해당 provider 를 사용하지 않는다.
+    """
+
+    def __init__(self, window=200):
+        self._latencies = {ai_type: deque(maxlen=window) for ai_type in FALLBACK_ORDER}
+        # 스트리밍 요청의 첫 토큰까지 걸린 시간. 스트리밍 hedge 의 대기 시간으로 쓴다
+        self._first_tokens = {ai_type: deque(maxlen=window) for ai_type in FALLBACK_ORDER}
+        self._outcomes = {ai_type: deque(maxlen=window) for ai_type in FALLBACK_ORDER}
+        self._down_until = {}
+        self._lock = threading.Lock()
+
+    def record(self, ai_type, latency, ok):
+        with self._lock:
+            outcomes = self._outcomes[ai_type]
+            outcomes.append(ok)
+            if ok:
+                self._latencies[ai_type].append(latency)
+            if len(outcomes) >= FAILOVER_MIN_SAMPLES:
+                error_rate = outcomes.count(False) / len(outcomes)
+                if error_rate >= FAILOVER_ERROR_RATE:
+                    print(f"Provider {ai_type} error rate {error_rate:.0%}. Failing over for {FAILOVER_COOLDOWN}s")
+                    self._down_until[ai_type] = time.monotonic() + FAILOVER_COOLDOWN
+                    # 쿨다운이 끝나면 새 표본으로 다시 판단
+                    outcomes.clear()
+
+    def record_first_token(self, ai_type, latency):
+        with self._lock:
+            self._first_tokens[ai_type].append(latency)
+
+    def latency_percentile(self, ai_type, percentile):
+        with self._lock:
+            latencies = sorted(self._latencies[ai_type])
+        return _percentile(latencies, percentile)
+
+    def first_token_percentile(self, ai_type, percentile):
+        with self._lock:
+            latencies = sorted(self._first_tokens[ai_type])
+        return _percentile(latencies, percentile)
+
+    def is_available(self, ai_type):
+        with self._lock:
+            return self._down_until.get(ai_type, 0) <= time.monotonic()
+
+    def snapshot(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                ai_type: {
+                    'samples': len(self._outcomes[ai_type]),
+                    'error_rate': (self._outcomes[ai_type].count(False) / len(self._outcomes[ai_type])
+                                   if self._outcomes[ai_type] else 0.0),
+                    'down_for': max(0.0, self._down_until.get(ai_type, 0) - now),
+                }
+                for ai_type in FALLBACK_ORDER
+            }
+
+
+provider_health = ProviderHealth()
+
+_hedge_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('LLM_HEDGE_WORKERS') or 32),
+    thread_name_prefix='llm-hedge',
+)
+
+
+def choose_providers(primary, configured, max_tokens=None):
+    """primary 와 fallback 중 설정되어 있고 쿨다운 중이 아닌 provider 를 우선순위 순서로 돌려준다.
+
+    max_tokens({ai_type: 출력 한도}) 를 주면 출력 한도가 FALLBACK_MIN_MAX_TOKENS 보다 작은 fallback 은 쓰지 않는다.
+    primary 는 호출자가 직접 고른 것이므로 한도와 상관없이 남긴다.
+    """
+    max_tokens = max_tokens or {}
+    candidates = [primary] + [t for t in FALLBACK_ORDER[primary] if t in configured
+                              and max_tokens.get(t, FALLBACK_MIN_MAX_TOKENS) >= FALLBACK_MIN_MAX_TOKENS]
+    if FAILOVER_ENABLED:
+        available = [t for t in candidates if provider_health.is_available(t)]
+        if available:
+            candidates = available
+    return candidates or [primary]
+
+
+def hedged_call(candidates, call):
+    """candidates[0] 에 먼저 요청하고, 응답이 늦거나 실패하면 다음 provider 로 같은 요청을 보낸다.
+
+    call(ai_type, cancel) 은 cancel 이벤트가 설정되면 가능한 빨리 연결을 정리하고 돌아와야 한다.
+    가장 먼저 성공한 결과를 돌려주고 나머지 요청은 취소한다.
+    """
+    cancels = {}
+    futures = {}
+
+    def launch(ai_type):
+        cancels[ai_type] = threading.Event()
+        future = _hedge_executor.submit(tracing.wrap(call), ai_type, cancels[ai_type])
+        futures[future] = ai_type
+        return future
+
+    pending = {launch(candidates[0])}
+    errors = []
+    while True:
+        timeout = None
+        if len(futures) < len(candidates):
+            timeout = provider_health.latency_percentile(candidates[len(futures) - 1], HEDGE_PERCENTILE)
+            if timeout is None:
+                timeout = HEDGE_DEFAULT_DELAY
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                result = future.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            winner = futures[future]
+            for ai_type, cancel in cancels.items():
+                if ai_type != winner:
+                    cancel.set()
+            return result
+
+        if len(futures) < len(candidates) and (not done or not pending):
+            # 시간이 초과했거나 진행 중인 요청이 모두 실패했으면 다음 provider 로 보낸다
+            next_type = candidates[len(futures)]
+            print(f"Hedging request to {next_type} after {timeout:.1f}s")
+            # 바로 끝난 요청도 다음 wait 에서 결과를 꺼내도록 done 여부와 상관없이 넣는다
+            pending.add(launch(next_type))
+        elif not pending:
+            raise errors[-1]
+
+
+def hedged_stream(candidates, open_stream):
+    """hedged_call 의 스트리밍 버전. candidates[0] 의 스트림을 먼저 열고, 첫 토큰이 늦거나 실패하면 다음 provider 로 연다.
+
+    open_stream(ai_type, cancel) 은 delta 를 내는 iterator 를 돌려준다. 스트림마다 스레드 하나가 읽어서 queue 로 넘기고,
+    가장 먼저 토큰을 낸(또는 빈 응답으로 끝난) 스트림으로 정해서 나머지는 취소한다. 정한 뒤의 에러는 그대로 올린다.
+    스트림은 응답이 끝날 때까지 스레드를 잡고 있으므로 _hedge_executor 가 아닌 스트림마다의 스레드에서 읽는다.
+    """
+    events = queue.Queue()
+    cancels = {}
+
+    def pump(ai_type, cancel):
+        stream = iter(open_stream(ai_type, cancel))
+        try:
+            for delta in stream:
+                if cancel.is_set():
+                    return
+                events.put((ai_type, 'delta', delta))
+        except Exception as e:
+            events.put((ai_type, 'error', e))
+            return
+        finally:
+            close = getattr(stream, 'close', None)
+            if close is not None:
+                close()
+        events.put((ai_type, 'end', None))
+
+    def launch(ai_type):
+        cancels[ai_type] = threading.Event()
+        threading.Thread(target=tracing.wrap(pump), args=(ai_type, cancels[ai_type]),
+                         name=f'llm-hedge-{ai_type}', daemon=True).start()
+
+    launch(candidates[0])
+    running = 1
+    winner = None
+    errors = []
+    try:
+        while True:
+            timeout = None
+            if winner is None and len(cancels) < len(candidates):
+                timeout = provider_health.first_token_percentile(candidates[len(cancels) - 1], HEDGE_PERCENTILE)
+                if timeout is None:
+                    timeout = HEDGE_DEFAULT_DELAY
+            try:
+                ai_type, kind, value = events.get(timeout=timeout)
+            except queue.Empty:
+                next_type = candidates[len(cancels)]
+                print(f"Hedging stream to {next_type} after {timeout:.1f}s without a token")
+                launch(next_type)
+                running += 1
+                continue
+
+            if winner is None and kind != 'error':
+                winner = ai_type
+                for other, cancel in cancels.items():
+                    if other != winner:
+                        cancel.set()
+            if winner is not None:
+                if ai_type != winner:
+                    continue
+                if kind == 'delta':
+                    yield value
+                elif kind == 'end':
+                    return
+                else:
+                    raise value
+                continue
+
+            # 토큰을 내기 전에 실패했으면 기다리지 않고 다음 provider 로 보낸다
+            errors.append(value)
+            running -= 1
+            if len(cancels) < len(candidates):
+                next_type = candidates[len(cancels)]
+                print(f"Hedging stream to {next_type} after {type(value).__name__}")
+                launch(next_type)
+                running += 1
+            elif running == 0:
+                raise errors[-1]
+    finally:
+        # 끝났거나 호출자가 스트림을 닫았으면 아직 읽고 있는 스트림을 모두 멈춘다
+        for cancel in cancels.values():
+            cancel.set()
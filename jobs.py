@@ -0,0 +1,318 @@
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+import uuid
+import tracing
+
+
+class JobStatus:
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+class FileStatus:
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+FINISHED_STATUSES = (JobStatus.DONE, JobStatus.FAILED)
+
+# 끝난 작업의 스트리밍 출력은 이 시간(초)이 지나면 메모리에서 지운다
+OUTPUT_RETENTION = 600
+# 작업 하나가 메모리에 들고 있는 최대 출력 수. 넘으면 오래된 출력부터 버린다
+OUTPUT_MAX_ITEMS = 20000
+# 끝난 작업의 기록(메모리와 jobs/{job_id}.json)을 남겨두는 시간(초)과 최대 개수. 넘으면 오래된 것부터 지운다
+JOB_RETENTION = float(os.environ.get('JOB_RETENTION') or 7 * 24 * 3600)
+JOB_MAX_FINISHED = int(os.environ.get('JOB_MAX_FINISHED') or 1000)
+# 다른 프로세스가 남긴 작업 파일까지 정리하는 간격(초)
+JOB_PRUNE_INTERVAL = 3600
+
+
+def file_key(path, fname):
+    return f"{path}/{fname}" if path else fname
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobStore:
+    """생성 작업 상태를 메모리에 두고 jobs/{job_id}.json 으로 같이 기록한다.
+
+    여러 프로세스(gunicorn worker)가 같은 root 를 쓰면 다른 프로세스가 만든 작업은 파일에서 읽는다.
+    토큰 단위 출력은 작업을 실행하는 프로세스의 메모리에만 있으므로 다른 프로세스에서는 상태 변화만 볼 수 있다.
+    메모리에는 이 프로세스가 만든 작업만 두고, 끝난 작업은 JOB_RETENTION / JOB_MAX_FINISHED 를 넘으면 파일과 함께 지운다.
+    """
+
+    def __init__(self, root='jobs'):
+        self._root = root
+        self._pid = os.getpid()
+        self._jobs = {}
+        self._outputs = {}
+        self._output_base = {}  # job_id -> 앞에서 버린 출력 수 (offset 은 처음부터 센 위치)
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._pruned_at = time.monotonic()
+        os.makedirs(self._root, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        # 프로세스가 재시작되면 진행 중이던 작업은 이어서 실행할 수 없으므로 실패로 기록
+        # 이전 프로세스의 작업은 이 프로세스에서 실행하지 않으므로 메모리에 올리지 않는다 (get 은 파일에서 읽는다)
+        finished = []
+        for name in os.listdir(self._root):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self._root, name), 'r', encoding='utf-8') as f:
+                    job = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"Failed to load job {name}: {e}")
+                continue
+            if job.get('status') in (JobStatus.PENDING, JobStatus.RUNNING):
+                pid = job.get('pid')
+                if pid and pid != self._pid and _pid_alive(pid):
+                    # 같은 호스트의 다른 worker 프로세스가 실행 중인 작업
+                    continue
+                job['status'] = JobStatus.FAILED
+                job['error'] = '서버가 재시작되어 작업이 중단되었습니다.'
+                self._write(job)
+            finished.append(job)
+        self._remove_old_files(finished, time.time())
+
+    def _prune_files(self, now):
+        """다른 프로세스가 남긴 것까지 포함해서 오래된 끝난 작업 파일을 지운다."""
+        finished = []
+        for name in os.listdir(self._root):
+            if name.endswith('.json'):
+                job = self._read(name[:-5])
+                if job is not None and job.get('status') in FINISHED_STATUSES:
+                    finished.append(job)
+        self._remove_old_files(finished, now)
+
+    def _remove_old_files(self, finished, now):
+        finished.sort(key=lambda job: job.get('updated_at', 0), reverse=True)
+        for index, job in enumerate(finished):
+            if index >= JOB_MAX_FINISHED or now - job.get('updated_at', 0) > JOB_RETENTION:
+                self._remove_file(job['job_id'])
+
+    def _remove_file(self, job_id):
+        try:
+            os.remove(os.path.join(self._root, f'{job_id}.json'))
+        except OSError:
+            pass
+
+    def _write(self, job):
+        path = os.path.join(self._root, f"{job['job_id']}.json")
+        tmp_path = f'{path}.{self._pid}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(job, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, path)
+
+    def create(self, kind, account_guid, project_guid):
+        now = time.time()
+        job = {
+            'job_id': uuid.uuid4().hex,
+            'kind': kind,
+            'account_guid': account_guid,
+            'project_guid': project_guid,
+            'status': JobStatus.PENDING,
+            'stage': '',
+            'files': {},
+            'result': None,
+            'error': None,
+            'pid': self._pid,
+            # 작업을 만든 요청의 trace. /trace/<trace_id> 로 단계별 시간을 볼 수 있다
+            'trace_id': tracing.current_trace_id(),
+            'created_at': now,
+            'updated_at': now,
+        }
+        with self._lock:
+            self._purge_outputs(now)
+            self._purge_jobs(now)
+            self._jobs[job['job_id']] = job
+            self._outputs[job['job_id']] = []
+            self._write(job)
+            prune = time.monotonic() - self._pruned_at > JOB_PRUNE_INTERVAL
+            if prune:
+                self._pruned_at = time.monotonic()
+        if prune:
+            # 파일을 모두 읽으므로 락 밖에서 한다
+            self._prune_files(now)
+        return json.loads(json.dumps(job))
+
+    def _purge_outputs(self, now):
+        for job_id in list(self._outputs):
+            job = self._jobs[job_id]
+            if job['status'] in FINISHED_STATUSES and now - job['updated_at'] > OUTPUT_RETENTION:
+                del self._outputs[job_id]
+                self._output_base.pop(job_id, None)
+
+    def _purge_jobs(self, now):
+        # 락을 잡고 부른다. 이 프로세스의 끝난 작업을 메모리와 파일에서 지운다
+        finished = sorted((job for job in self._jobs.values() if job['status'] in FINISHED_STATUSES),
+                          key=lambda job: job['updated_at'], reverse=True)
+        for index, job in enumerate(finished):
+            if index >= JOB_MAX_FINISHED or now - job['updated_at'] > JOB_RETENTION:
+                job_id = job['job_id']
+                del self._jobs[job_id]
+                self._outputs.pop(job_id, None)
+                self._output_base.pop(job_id, None)
+                self._remove_file(job_id)
+
+    def _is_local(self, job_id):
+        job = self._jobs.get(job_id)
+        return job is not None and job.get('pid') == self._pid
+
+    def _read(self, job_id):
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(os.path.join(self._root, f'{job_id}.json'), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def get(self, job_id):
+        with self._lock:
+            if self._is_local(job_id):
+                return json.loads(json.dumps(self._jobs[job_id]))
+        return self._read(job_id)
+
+    def status_counts(self):
+        """이 프로세스가 실행하는 작업의 상태별 개수."""
+        counts = {status: 0 for status in (JobStatus.PENDING, JobStatus.RUNNING, JobStatus.DONE, JobStatus.FAILED)}
+        with self._lock:
+            for job in self._jobs.values():
+                if job.get('pid') == self._pid:
+                    counts[job['status']] += 1
+        return counts
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(fields)
+            job['updated_at'] = time.time()
+            self._write(job)
+            self._cond.notify_all()
+
+    def set_files(self, job_id, files):
+        with self._lock:
+            job = self._jobs[job_id]
+            # 설계를 스트리밍하면서 먼저 시작한 파일은 지금 상태를 유지한다
+            previous = job['files']
+            job['files'] = {}
+            for f in files:
+                key = file_key(f.get('path', ''), f.get('fname', ''))
+                job['files'][key] = previous.get(key) or {
+                    'path': f.get('path', ''),
+                    'fname': f.get('fname', ''),
+                    'status': FileStatus.PENDING,
+                    'error': None,
+                }
+            job['updated_at'] = time.time()
+            self._write(job)
+
+    def set_file_status(self, job_id, path, fname, status, error=None):
+        with self._lock:
+            job = self._jobs[job_id]
+            entry = job['files'].setdefault(file_key(path, fname), {'path': path, 'fname': fname})
+            entry['status'] = status
+            entry['error'] = error
+            job['updated_at'] = time.time()
+            self._write(job)
+            self._append(job_id, {'type': 'file', 'file': file_key(path, fname), 'status': status, 'error': error})
+
+    def _append(self, job_id, item):
+        output = self._outputs.setdefault(job_id, [])
+        output.append(item)
+        if len(output) > OUTPUT_MAX_ITEMS:
+            # 매번 앞에서 지우지 않도록 한 번에 1/4 을 버린다
+            drop = len(output) - OUTPUT_MAX_ITEMS * 3 // 4
+            del output[:drop]
+            self._output_base[job_id] = self._output_base.get(job_id, 0) + drop
+        self._cond.notify_all()
+
+    def append_output(self, job_id, path, fname, delta):
+        with self._lock:
+            self._append(job_id, {'type': 'token', 'file': file_key(path, fname), 'delta': delta})
+
+    def wait_output(self, job_id, offset, timeout=15):
+        """offset 이후에 쌓인 출력을 (시작 위치, 출력, 작업 종료 여부) 로 돌려준다. 새 출력이 없으면 timeout 초까지 기다린다.
+
+        offset 의 출력이 이미 버려졌으면 남아 있는 가장 오래된 출력부터 돌려주므로 시작 위치가 offset 보다 크다.
+        """
+        offset = max(0, offset)
+        with self._lock:
+            local = self._is_local(job_id)
+        if not local:
+            # 다른 프로세스의 작업은 출력을 볼 수 없으므로 파일의 상태만 확인
+            time.sleep(min(timeout, 1))
+            job = self._read(job_id)
+            return offset, [], job is None or job['status'] in FINISHED_STATUSES
+        with self._cond:
+            def end():
+                return self._output_base.get(job_id, 0) + len(self._outputs.get(job_id, []))
+
+            def finished():
+                # 기다리는 사이에 지워진 작업은 끝난 것으로 본다
+                job = self._jobs.get(job_id)
+                return job is None or job['status'] in FINISHED_STATUSES
+
+            self._cond.wait_for(lambda: end() > offset or finished(), timeout)
+            base = self._output_base.get(job_id, 0)
+            start = max(offset, base)
+            output = self._outputs.get(job_id, [])[start - base:]
+            return start, output, finished()
+
+
+class JobQueue:
+    """HTTP 요청과 무관하게 작업을 처리하는 백그라운드 워커 스레드 묶음."""
+
+    def __init__(self, store, num_workers=2):
+        self._store = store
+        self._queue = queue.Queue()
+        self._workers = []
+        for i in range(num_workers):
+            t = threading.Thread(target=self._run, name=f'job-worker-{i}', daemon=True)
+            t.start()
+            self._workers.append(t)
+
+    def submit(self, job_id, target, *args):
+        # 제출한 요청의 trace 를 워커 스레드에서 이어간다
+        self._queue.put((tracing.wrap(self._execute), job_id, target, args))
+
+    def qsize(self):
+        """워커를 기다리는 작업 수."""
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            execute, job_id, target, args = self._queue.get()
+            try:
+                execute(job_id, target, args)
+            finally:
+                self._queue.task_done()
+
+    def _execute(self, job_id, target, args):
+        self._store.update(job_id, status=JobStatus.RUNNING)
+        try:
+            with tracing.span('job', job_id=job_id):
+                result = target(job_id, *args)
+            self._store.update(job_id, status=JobStatus.DONE, stage='', result=result)
+        except Exception as e:
+            traceback.print_exc()
+            self._store.update(job_id, status=JobStatus.FAILED, error=str(e))
@@ -0,0 +1,211 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def make_cache_key(provider, model, messages, temperature, max_tokens, response_format=None):
+    params = {
+        'provider': provider,
+        'model': model,
+        'messages': messages,
+        'temperature': temperature,
+        'max_tokens': max_tokens,
+    }
+    if response_format:
+        # 기존 캐시 키가 바뀌지 않도록 설정했을 때만 넣는다
+        params['response_format'] = response_format
+    payload = json.dumps(params, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class LlmCache:
+    """LLM 응답 캐시. 메모리 LRU 와 디스크 두 단계로 구성된다.
+
+    디스크 항목은 {root}/{key[:2]}/{key}.json 에 저장되고, ttl 이 지나면 읽을 때 버린다.
+    디스크 사용량이 max_disk_bytes 를 넘으면 가장 오래 쓰이지 않은 파일부터 지운다.
+    락은 인덱스를 고칠 때만 잡고, 디스크 읽기/쓰기는 락 밖에서 한다.
+    """
+
+    def __init__(self, root='llm_cache', max_memory_entries=256, max_disk_bytes=256 * 1024 * 1024,
+                 ttl=7 * 24 * 3600, enabled=True):
+        self._root = root
+        self._max_memory_entries = max_memory_entries
+        self._max_disk_bytes = max_disk_bytes
+        self._ttl = ttl
+        self.enabled = enabled
+        self._memory = OrderedDict()
+        self._disk_index = OrderedDict()  # key -> 파일 크기, 오래 쓰이지 않은 순서
+        self._disk_bytes = 0
+        self._value_keys = {}  # 메모리에 있는 항목의 값 해시 -> key (discard_value 용)
+        self._lock = threading.Lock()
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+        if self.enabled:
+            self._load_disk_index()
+
+    def _path(self, key):
+        return os.path.join(self._root, key[:2], f'{key}.json')
+
+    def _load_disk_index(self):
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self._root):
+            for name in filenames:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(dirpath, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, name[:-5], stat.st_size))
+        for mtime, key, size in sorted(entries):
+            self._disk_index[key] = size
+            self._disk_bytes += size
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._expired(entry):
+                    self._memory.move_to_end(key)
+                    self._stats['memory_hits'] += 1
+                    return entry['value']
+                # 만료된 항목은 메모리에서 바로 지운다. 디스크의 항목은 아래에서 읽으면서 만료를 확인하고 지운다
+                self._forget_memory(key)
+            on_disk = key in self._disk_index
+
+        # 디스크 읽기는 락 밖에서 한다 (다른 키의 메모리 조회가 기다리지 않도록)
+        entry = self._read_disk(key) if on_disk else None
+        with self._lock:
+            if entry is not None and key in self._disk_index:
+                self._disk_index.move_to_end(key)
+                self._remember(key, entry)
+                self._stats['disk_hits'] += 1
+                return entry['value']
+            self._stats['misses'] += 1
+            return None
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+        entry = {'created_at': time.time(), 'value': value}
+        with self._lock:
+            self._remember(key, entry)
+        self._write_disk(key, entry)
+
+    def discard_value(self, value):
+        """value 를 돌려준 캐시 항목을 지운다. 응답을 쓸 수 없다고 판단한 호출자가 부른다.
+
+        최근에 저장되었거나 읽힌(메모리에 있는) 항목만 찾을 수 있다.
+        """
+        if not self.enabled or not value:
+            return False
+        with self._lock:
+            key = self._value_keys.pop(self._digest(value), None)
+            if key is None:
+                return False
+            self._memory.pop(key, None)
+            self._disk_bytes -= self._disk_index.pop(key, 0)
+        self._remove_file(key)
+        return True
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+            stats['hit_rate'] = (stats['memory_hits'] + stats['disk_hits']) / lookups if lookups else 0.0
+            stats['memory_entries'] = len(self._memory)
+            stats['disk_entries'] = len(self._disk_index)
+            stats['disk_bytes'] = self._disk_bytes
+            return stats
+
+    def _expired(self, entry):
+        return time.time() - entry['created_at'] > self._ttl
+
+    @staticmethod
+    def _digest(value):
+        return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+    def _remember(self, key, entry):
+        # 락을 잡고 부른다
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        self._value_keys[self._digest(entry['value'])] = key
+        while len(self._memory) > self._max_memory_entries:
+            self._forget_memory(next(iter(self._memory)))
+
+    def _forget_memory(self, key):
+        # 락을 잡고 부른다
+        entry = self._memory.pop(key)
+        digest = self._digest(entry['value'])
+        if self._value_keys.get(digest) == key:
+            del self._value_keys[digest]
+
+    def _read_disk(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            self._forget_disk(key)
+            return None
+        if self._expired(entry):
+            self._forget_disk(key)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+    def _write_disk(self, key, entry):
+        # provider 호출은 이미 성공했으므로 디스크에 쓰지 못해도(디스크 부족, 권한) 에러를 올리지 않고 메모리에만 둔다
+        path = self._path(key)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        except OSError as e:
+            print(f"LLM cache write failed for {key}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+
+        evicted = []
+        with self._lock:
+            self._disk_bytes -= self._disk_index.pop(key, 0)
+            self._disk_index[key] = size
+            self._disk_bytes += size
+            while self._disk_bytes > self._max_disk_bytes and len(self._disk_index) > 1:
+                oldest = next(iter(self._disk_index))
+                self._disk_bytes -= self._disk_index.pop(oldest)
+                evicted.append(oldest)
+                self._stats['evictions'] += 1
+        for oldest in evicted:
+            self._remove_file(oldest)
+
+    def _forget_disk(self, key):
+        with self._lock:
+            self._disk_bytes -= self._disk_index.pop(key, 0)
+        self._remove_file(key)
+
+    def _remove_file(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+
+llm_cache = LlmCache(
+    root=os.environ.get('LLM_CACHE_DIR') or 'llm_cache',
+    max_memory_entries=int(os.environ.get('LLM_CACHE_MEMORY_ENTRIES') or 256),
+    max_disk_bytes=int(os.environ.get('LLM_CACHE_DISK_BYTES') or 256 * 1024 * 1024),
+    ttl=int(os.environ.get('LLM_CACHE_TTL') or 7 * 24 * 3600),
+    enabled=os.environ.get('LLM_CACHE_ENABLED', '1') != '0',
+)
@@ -0,0 +1,250 @@
+import bisect
+import json
+import math
+import os
+import threading
+import time
+from contextlib import ContextDecorator
+import tracing
+
+# Prometheus text format 으로 내보내는 프로세스 내 지표. 외부 라이브러리 없이 counter / gauge / histogram 만 구현한다.
+#
+# 기록하는 쪽의 비용은 lock 한 번과 dict 조회(histogram 은 bisect 추가) 정도라 LLM 호출이나 파일 쓰기에 비하면 무시할 수 있다.
+# 작업 수, 캐시 적중률처럼 이미 다른 곳에서 세고 있는 값은 collector 로 등록해서 /metrics 를 읽을 때만 계산한다.
+# gunicorn worker 마다 따로 세므로 여러 worker 를 띄우면 Prometheus 에서 instance/pid 별로 합쳐서 봐야 한다.
+
+# 초 단위 기본 구간. 빠른 단계(파싱, 디스크 쓰기)부터 긴 LLM 응답까지 본다
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# 모델별 1M 토큰당 가격 (USD, 입력/출력). 비용은 추정치로만 쓴다.
+# LLM_PRICES='{"gpt-4o": [2.5, 10]}' 처럼 덮어쓸 수 있고, 가격을 모르는 모델은 비용을 세지 않는다.
+DEFAULT_PRICES = {
+    'gpt-4o': (5.0, 15.0),
+    'claude-3-opus-20240229': (15.0, 75.0),
+}
+
+
+def load_prices_from_env():
+    prices = dict(DEFAULT_PRICES)
+    value = os.environ.get('LLM_PRICES')
+    if value:
+        prices.update({model: tuple(price) for model, price in json.loads(value).items()})
+    return prices
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}' for key, value in values]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # 구간별 개수 (마지막은 +Inf), 합, 개수
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+        lines = []
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {count}')
+        return lines
+
+
+class _Collector(_Metric):
+    """/metrics 를 읽을 때 fn() 을 불러서 값을 만든다. fn 은 (label 값 tuple, 값) 목록을 돌려준다."""
+
+    def __init__(self, name, documentation, kind, labels, fn):
+        super().__init__(name, documentation, labels)
+        self.kind = kind
+        self._fn = fn
+
+    def samples(self):
+        try:
+            values = list(self._fn())
+        except Exception as e:
+            print(f"Metrics collector {self.name} failed: {e}")
+            return []
+        return [f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}' for key, value in values]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'이미 등록된 지표입니다: {metric.name}')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self._register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def collector(self, name, documentation, kind, labels, fn):
+        return self._register(_Collector(name, documentation, kind, labels, fn))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines += metric.header()
+            lines += metric.samples()
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+llm_requests = metrics.counter(
+    'llm_requests_total', 'provider 호출 수 (캐시 적중 제외, 재시도는 각각 셈)', ('provider', 'model', 'status'))
+llm_duration = metrics.histogram(
+    'llm_request_duration_seconds', 'provider 호출 한 번의 전체 시간', ('provider', 'model'))
+llm_ttft = metrics.histogram(
+    'llm_time_to_first_token_seconds', '스트리밍 호출의 첫 토큰까지 시간', ('provider', 'model'))
+llm_tokens = metrics.counter(
+    'llm_tokens_total', 'provider 가 알려준 입력/출력 토큰 수', ('provider', 'model', 'direction'))
+llm_cost = metrics.counter(
+    'llm_cost_usd_total', '토큰 수와 모델 가격으로 추정한 비용', ('provider', 'model'))
+llm_retries = metrics.counter(
+    'llm_retries_total', '일시적인 에러로 다시 시도한 횟수', ('provider', 'error'))
+llm_rate_limit_wait = metrics.histogram(
+    'llm_rate_limit_wait_seconds', 'rate limiter 에서 차례를 기다린 시간 (기다린 경우만)', ('provider',))
+llm_rate_limited = metrics.counter(
+    'llm_rate_limited_total', 'provider 가 429 로 거절한 횟수', ('provider',))
+llm_in_flight = metrics.gauge(
+    'llm_in_flight_requests', '동시 호출 수 제한을 통과해서 진행 중인 provider 호출 수 (sync 경로)', ('provider',))
+http_duration = metrics.histogram(
+    'http_request_duration_seconds', '경로별 응답 시간 (스트리밍 응답은 헤더를 보낼 때까지)', ('method', 'route', 'status'))
+stage_duration = metrics.histogram(
+    'stage_duration_seconds', '처리 단계별 시간 (prompt_build, llm, parse, disk_write)', ('stage',))
+
+_prices = load_prices_from_env()
+
+
+def record_llm_call(ai_type, model, seconds, ok):
+    llm_requests.inc(ai_type, model, 'ok' if ok else 'error')
+    llm_duration.observe(seconds, ai_type, model)
+
+
+def record_llm_usage(ai_type, model, input_tokens, output_tokens):
+    """provider 응답의 usage 를 기록한다. provider 가 알려주지 않은 값(None)은 건너뛴다."""
+    if input_tokens:
+        llm_tokens.inc(ai_type, model, 'input', amount=input_tokens)
+    if output_tokens:
+        llm_tokens.inc(ai_type, model, 'output', amount=output_tokens)
+    tracing.current_span().set(input_tokens=input_tokens, output_tokens=output_tokens)
+    price = _prices.get(model)
+    if price:
+        llm_cost.inc(ai_type, model, amount=((input_tokens or 0) * price[0] + (output_tokens or 0) * price[1]) / 1e6)
+
+
+class stage(ContextDecorator):
+    """with stage('parse'): ... 또는 @stage('prompt_build') 로 단계 시간을 잰다.
+
+    요청이 추적 중이면 같은 이름의 span 도 남긴다. attributes 는 span 에만 붙는다.
+    """
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def _recreate_cm(self):
+        # 데코레이터로 여러 스레드/coroutine 에서 동시에 불려도 시작 시각이 섞이지 않도록 호출마다 새로 만든다
+        return stage(self.name, **self.attributes)
+
+    def __enter__(self):
+        self._span = tracing.span(self.name, **self.attributes)
+        self._span.__enter__()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        stage_duration.observe(time.perf_counter() - self._started, self.name)
+        self._span.__exit__(*exc)
+        return False
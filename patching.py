@@ -0,0 +1,174 @@
+import difflib
+import re
+
+# search 블록을 찾지 못했을 때 비슷한 줄 묶음을 받아들이는 최소 유사도
+FUZZY_THRESHOLD = 0.85
+
+PATCH_PROMPT = """
+파일 전체를 다시 쓰지 말고 바뀌는 부분만 search/replace 블록으로 답해줘.
+search 에는 기존 파일에 있는 그대로의 연속된 줄을 충분히(앞뒤 2~3줄 포함) 넣어서 한 곳만 가리키도록 하고,
+replace 에는 그 부분을 바꾼 결과를 넣어줘. 새로 만드는 파일만 content 에 전체 내용을 넣어줘.
+답변은 json으로만 해줘. 파싱하기 위함이라 다른걸로 하면 안돼.
+
+{
+    "파일이름": {"patches": [{"search": "기존 코드", "replace": "바뀐 코드"}]},
+    "새파일이름": {"content": "전체 내용"}
+}
+"""
+
+_HUNK_HEADER_RE = re.compile(r'^@@ .* @@')
+
+
+class PatchResult:
+    def __init__(self):
+        self.applied = []
+        self.rejected = []
+
+    @property
+    def ok(self):
+        return not self.rejected
+
+    def to_dict(self):
+        return {'applied': self.applied, 'rejected': self.rejected}
+
+
+def _find_exact(lines, search_lines):
+    """search_lines 가 한 곳에서만 나오면 그 시작 줄. 없거나 여러 곳이면 None."""
+    size = len(search_lines)
+    found = None
+    for start in range(len(lines) - size + 1):
+        if lines[start:start + size] == search_lines:
+            if found is not None:
+                return None
+            found = start
+    return found
+
+
+def _find_normalized(lines, search_lines, normalize):
+    normalized = [normalize(line) for line in lines]
+    return _find_exact(normalized, [normalize(line) for line in search_lines])
+
+
+def _find_fuzzy(lines, search_lines):
+    size = len(search_lines)
+    target = '\n'.join(line.strip() for line in search_lines)
+    best, best_ratio, tied = None, FUZZY_THRESHOLD, False
+    for start in range(len(lines) - size + 1):
+        window = '\n'.join(line.strip() for line in lines[start:start + size])
+        matcher = difflib.SequenceMatcher(None, window, target, autojunk=False)
+        if matcher.quick_ratio() < best_ratio:
+            continue
+        ratio = matcher.ratio()
+        if ratio > best_ratio or (ratio == best_ratio and best is None):
+            best, best_ratio, tied = start, ratio, False
+        elif ratio == best_ratio:
+            tied = True
+    # 똑같이 비슷한 곳이 여러 군데면 어느 쪽인지 알 수 없다
+    return None if tied else best
+
+
+def _indent(line):
+    return line[:len(line) - len(line.lstrip())]
+
+
+def _reindent(replace_lines, search_lines, matched_lines):
+    # 모델이 들여쓰기를 다르게 줬으면 search 와 실제 파일의 줄별 들여쓰기 대응을 replace 에도 적용한다
+    mapping = {}
+    for search_line, matched_line in zip(search_lines, matched_lines):
+        if search_line.strip():
+            mapping.setdefault(_indent(search_line), _indent(matched_line))
+    if all(old == new for old, new in mapping.items()):
+        return replace_lines
+
+    result = []
+    for line in replace_lines:
+        indent = _indent(line)
+        prefixes = [old for old in mapping if indent.startswith(old)]
+        if not line.strip() or not prefixes:
+            result.append(line)
+            continue
+        old = max(prefixes, key=len)
+        result.append(mapping[old] + indent[len(old):] + line.lstrip())
+    return result
+
+
+def is_ambiguous(content, search):
+    """search 가 그대로 여러 곳에 있으면 어디를 바꿀지 알 수 없으므로 적용하지 않는다."""
+    return content.count(search) > 1
+
+
+def apply_hunk(content, search, replace):
+    """content 에서 search 를 찾아 replace 로 바꾼다. 반환값은 (새 내용, 찾은 방법 또는 None).
+
+    search 가 여러 곳과 맞으면 (그대로든 공백을 무시해서든) 적용하지 않는다.
+    """
+    if not search.strip() or is_ambiguous(content, search):
+        return content, None
+    if content.count(search) == 1:
+        return content.replace(search, replace, 1), 'exact'
+
+    lines = content.split('\n')
+    search_lines = search.strip('\n').split('\n')
+    replace_lines = replace.strip('\n').split('\n') if replace.strip('\n') else []
+    for method, find in (
+        ('trailing_whitespace', lambda: _find_normalized(lines, search_lines, str.rstrip)),
+        ('indentation', lambda: _find_normalized(lines, search_lines, str.strip)),
+        ('fuzzy', lambda: _find_fuzzy(lines, search_lines)),
+    ):
+        start = find()
+        if start is not None:
+            end = start + len(search_lines)
+            if method != 'trailing_whitespace':
+                replace_lines = _reindent(replace_lines, search_lines, lines[start:end])
+            return '\n'.join(lines[:start] + replace_lines + lines[end:]), method
+    return content, None
+
+
+def unified_diff_to_hunks(diff):
+    """unified diff 를 search/replace 목록으로 바꾼다. 줄 번호는 믿지 않고 문맥으로만 위치를 찾는다."""
+    hunks = []
+    search, replace = [], []
+
+    def flush():
+        if search or replace:
+            hunks.append({'search': '\n'.join(search), 'replace': '\n'.join(replace)})
+        search.clear()
+        replace.clear()
+
+    for line in diff.splitlines():
+        if line.startswith('---') or line.startswith('+++'):
+            continue
+        if _HUNK_HEADER_RE.match(line):
+            flush()
+        elif line.startswith('-'):
+            search.append(line[1:])
+        elif line.startswith('+'):
+            replace.append(line[1:])
+        elif line.startswith(' ') or line == '':
+            search.append(line[1:])
+            replace.append(line[1:])
+    flush()
+    return hunks
+
+
+def apply_patch(content, change):
+    """change 는 {'patches': [{'search', 'replace'}]} 또는 {'diff': unified diff}.
+
+    적용할 수 있는 블록은 모두 적용하고, 결과와 블록별 적용/거절 내역을 돌려준다.
+    """
+    hunks = list(change.get('patches') or [])
+    if change.get('diff'):
+        hunks += unified_diff_to_hunks(change['diff'])
+    result = PatchResult()
+    for index, hunk in enumerate(hunks):
+        content, method = apply_hunk(content, hunk.get('search', ''), hunk.get('replace', ''))
+        if method:
+            result.applied.append({'hunk': index, 'method': method})
+        else:
+            reason = 'ambiguous' if is_ambiguous(content, hunk.get('search', '')) else 'not_found'
+            result.rejected.append({'hunk': index, 'reason': reason, 'search': hunk.get('search', '')[:200]})
+    return content, result
+
+
+def is_patch(change):
+    return isinstance(change, dict) and ('patches' in change or 'diff' in change)
@@ -0,0 +1,81 @@
+import json
+
+
+class PlanStreamParser:
+    """스트리밍으로 받는 설계(code_structure) 응답에서 Files 배열의 항목을 완성되는 대로 꺼낸다.
+
+    응답 전체가 유효한 JSON 이 되기를 기다리지 않고, 문자열/괄호 깊이만 추적해서 최상위 객체의
+    "Files" 배열 안에서 닫힌 {...} 를 하나씩 json.loads 한다. ```json 코드 블록이나 앞뒤의 설명 문장은
+    괄호가 없으므로 무시된다. 항목 하나를 파싱하지 못하면 건너뛰고, 최종 결과는 전체 응답을
+    parse_code_structure 로 다시 파싱해서 정한다.
+    """
+
+    FILES_KEY = 'Files'
+
+    def __init__(self):
+        self.files = []
+        self._text = ''
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_string = None
+        self._key = None
+        # Files 배열 안쪽의 깊이. 배열이 끝나면 -1
+        self._files_depth = None
+        self._item_start = None
+
+    def feed(self, delta):
+        """받은 조각을 이어 붙이고, 이번에 완성된 Files 항목 목록을 돌려준다."""
+        self._text += delta
+        completed = []
+        text = self._text
+        for i in range(self._pos, len(text)):
+            c = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == '\\':
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    self._last_string = text[self._string_start + 1:i]
+                continue
+
+            if c == '"':
+                self._in_string = True
+                self._string_start = i
+            elif c == ':' and self._depth == 1:
+                self._key = self._last_string
+            elif c == ',' and self._depth == 1:
+                self._key = None
+            elif c in '{[':
+                if c == '[' and self._depth == 1 and self._key == self.FILES_KEY and self._files_depth is None:
+                    self._files_depth = self._depth + 1
+                elif c == '{' and self._depth == self._files_depth:
+                    self._item_start = i
+                self._depth += 1
+            elif c in '}]':
+                self._depth -= 1
+                if c == '}' and self._depth == self._files_depth and self._item_start is not None:
+                    file_info = self._parse_item(text[self._item_start:i + 1])
+                    self._item_start = None
+                    if file_info is not None:
+                        self.files.append(file_info)
+                        completed.append(file_info)
+                elif c == ']' and self._files_depth is not None and self._depth == self._files_depth - 1:
+                    self._files_depth = -1
+        self._pos = len(text)
+        return completed
+
+    @staticmethod
+    def _parse_item(source):
+        try:
+            file_info = json.loads(source)
+        except json.JSONDecodeError as e:
+            print(f"Skipping unparsable plan item: {e}")
+            return None
+        if not isinstance(file_info, dict) or not file_info.get('fname'):
+            return None
+        return file_info
@@ -0,0 +1,28 @@
+from collections import namedtuple
+
+
+class ProjectContextError(ValueError):
+    pass
+
+
+class ProjectContext(namedtuple('ProjectContext', ['account_guid', 'project_guid'])):
+    """요청이나 작업 하나가 다루는 프로젝트.
+
+    모듈 전역 변수 대신 helper 함수와 백그라운드 스레드에 인자로 넘겨서
+    동시에 들어온 요청들이 서로의 프로젝트에 쓰지 않도록 한다.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_request(cls, data):
+        """요청 JSON 에서 만든다. account_guid / project_guid 가 없거나 잘못되면 ProjectContextError."""
+        account_guid = (data or {}).get('account_guid')
+        project_guid = (data or {}).get('project_guid')
+        if not account_guid or not project_guid:
+            raise ProjectContextError('account_guid 와 project_guid 가 필요합니다.')
+        # 경로로 쓰이므로 디렉터리를 벗어나는 값은 받지 않는다
+        for value in (account_guid, project_guid):
+            if not isinstance(value, str) or '/' in value or '\\' in value or value in ('.', '..'):
+                raise ProjectContextError('잘못된 account_guid 또는 project_guid 입니다.')
+        return cls(account_guid, project_guid)
@@ -0,0 +1,128 @@
+import itertools
+import os
+import threading
+import anthropic
+import httpx
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+
+POOL_SIZE = int(os.environ.get('LLM_POOL_SIZE') or 20)
+TIMEOUT = float(os.environ.get('LLM_TIMEOUT') or 300)
+CONNECT_TIMEOUT = float(os.environ.get('LLM_CONNECT_TIMEOUT') or 10)
+# 설정하면 provider 대신 이 주소로 요청한다 (예: fake_provider.py 로 부하 테스트)
+# OpenaiBaseUrl=http://127.0.0.1:8900/v1  Anthropic3BaseUrl=http://127.0.0.1:8900  (ClovaX 는 CloverHost)
+OPENAI_BASE_URL = os.environ.get('OpenaiBaseUrl') or None
+ANTHROPIC_BASE_URL = os.environ.get('Anthropic3BaseUrl') or None
+
+
+def split_keys(value):
+    # 여러 키는 쉼표로 구분해서 설정한다: OpenaiAPI=key1,key2
+    if not value:
+        return [None]
+    return [key.strip() for key in value.split(',') if key.strip()] or [None]
+
+
+class ProviderConfigError(ValueError):
+    pass
+
+
+def pair_keys(value, other, names):
+    """쉼표로 구분한 두 키 목록을 같은 순서끼리 짝짓는다. 개수가 다르면 키가 빠지지 않도록 ProviderConfigError."""
+    keys, others = split_keys(value), split_keys(other)
+    if len(keys) != len(others):
+        raise ProviderConfigError(
+            f'{names[0]} 와 {names[1]} 의 키 개수가 다릅니다 ({len(keys)}개, {len(others)}개).')
+    return list(zip(keys, others))
+
+
+class ClientPool:
+    """provider 별 클라이언트를 키마다 한 번만 만들고 라운드 로빈으로 돌려준다.
+
+    클라이언트는 프로세스가 살아있는 동안 재사용되므로 TLS 세션과 keep-alive 연결이
+    요청마다 새로 만들어지지 않는다.
+    """
+
+    def __init__(self, keys, factory):
+        self._keys = list(keys)
+        self._factory = factory
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._cycle = itertools.cycle(range(len(self._keys)))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def key_ids(self):
+        return list(range(len(self._keys)))
+
+    def key(self, key_id):
+        return self._keys[key_id]
+
+    def get(self, key_id):
+        with self._lock:
+            client = self._clients.get(key_id)
+            if client is None:
+                client = self._factory(self._keys[key_id])
+                self._clients[key_id] = client
+            return client
+
+    def next(self):
+        """다음 순서의 (key_id, client) 를 반환한다."""
+        with self._lock:
+            key_id = next(self._cycle)
+        return key_id, self.get(key_id)
+
+
+# SDK 클라이언트는 내부에 keep-alive 연결 풀을 가지고 있으므로 클라이언트를 재사용하는 것만으로
+# 연결이 유지된다. 동시 연결 수는 ai_models 의 provider 별 동시 호출 수(LLM_CONCURRENCY_*)로 제한된다.
+# 재시도는 rate_limiter.call_with_retry 가 맡으므로 SDK 자체 재시도는 끈다 (재시도가 겹치지 않고 지표에도 남도록)
+# SDK 가 만드는 기본 httpx 클라이언트는 연결 수 한도가 POOL_SIZE 와 다르므로 한도를 바꾼 클라이언트를 넘긴다.
+# SDK 버전에 따라 httpx 대신 다른 http 패키지를 쓰기도 하므로 Limits 와 클라이언트는 SDK 가 내보내는 타입으로 만든다
+def _pool_limits(limits_type=httpx.Limits):
+    return limits_type(max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE)
+
+
+def _sdk_http_client(sdk):
+    return sdk.DefaultHttpxClient(limits=_pool_limits(type(sdk.DEFAULT_CONNECTION_LIMITS)))
+
+
+def _sdk_async_http_client(sdk):
+    return sdk.DefaultAsyncHttpxClient(limits=_pool_limits(type(sdk.DEFAULT_CONNECTION_LIMITS)))
+
+
+def make_openai_client(api_key):
+    return openai.OpenAI(api_key=api_key, base_url=OPENAI_BASE_URL,
+                         timeout=openai.Timeout(TIMEOUT, connect=CONNECT_TIMEOUT), max_retries=0,
+                         http_client=_sdk_http_client(openai))
+
+
+def make_anthropic_client(api_key):
+    return anthropic.Anthropic(api_key=api_key, base_url=ANTHROPIC_BASE_URL,
+                               timeout=anthropic.Timeout(TIMEOUT, connect=CONNECT_TIMEOUT), max_retries=0,
+                               http_client=_sdk_http_client(anthropic))
+
+
+def make_requests_session(api_key):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# async 클라이언트는 처음 사용한 event loop 에 묶이므로 ASGI 서버처럼 loop 하나가 계속 도는 프로세스에서만 쓴다
+def make_async_openai_client(api_key):
+    return openai.AsyncOpenAI(api_key=api_key, base_url=OPENAI_BASE_URL,
+                              timeout=openai.Timeout(TIMEOUT, connect=CONNECT_TIMEOUT), max_retries=0,
+                              http_client=_sdk_async_http_client(openai))
+
+
+def make_async_anthropic_client(api_key):
+    return anthropic.AsyncAnthropic(api_key=api_key, base_url=ANTHROPIC_BASE_URL,
+                                    timeout=anthropic.Timeout(TIMEOUT, connect=CONNECT_TIMEOUT), max_retries=0,
+                                    http_client=_sdk_async_http_client(anthropic))
+
+
+def make_httpx_client(api_key):
+    return httpx.AsyncClient(timeout=httpx.Timeout(TIMEOUT, connect=CONNECT_TIMEOUT), limits=_pool_limits())
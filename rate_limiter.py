@@ -0,0 +1,377 @@
+import asyncio
+import contextvars
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager
+from datetime import datetime, timezone
+import anthropic
+import httpx
+import openai
+import requests
+from ai_types import AiType
+from metrics import llm_rate_limit_wait, llm_rate_limited, llm_retries
+import tracing
+
+# 분당 요청 수(rpm)와 분당 토큰 수(tpm). None 이면 제한하지 않는다.
+# 응답 헤더에 한도가 오면 그 값으로 갱신된다.
+# 한도는 API 키(계정) 단위지만 limiter 는 프로세스마다 따로 세므로, gunicorn worker 가 여럿이면 합쳐서 worker 수만큼
+# 넘게 보낸다. 그래서 설정값과 헤더의 한도를 RATE_LIMIT_PROCESSES 로 나눠서 프로세스마다 제 몫만 쓴다.
+# gunicorn.conf.py 가 worker 수로 채우고, 다른 방식으로 여러 프로세스를 띄우면 직접 설정한다.
+PROCESS_COUNT = max(1, int(os.environ.get('RATE_LIMIT_PROCESSES') or 1))
+
+DEFAULT_LIMITS = {
+    AiType.GPT: {'rpm': 500, 'tpm': 300000},
+    AiType.ANTHROPIC: {'rpm': 50, 'tpm': 40000},
+    AiType.CLOVARX: {'rpm': 60, 'tpm': None},
+}
+
+TRANSIENT_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+
+
+def load_limits_from_env(processes=PROCESS_COUNT):
+    # RATE_LIMIT_GPT_RPM=1000, RATE_LIMIT_GPT_TPM=0 (0 은 제한 없음). 계정 전체의 한도로 적고, 프로세스 몫으로 나눈다
+    limits = {ai_type: dict(values) for ai_type, values in DEFAULT_LIMITS.items()}
+    for ai_type, values in limits.items():
+        for name in ('rpm', 'tpm'):
+            value = os.environ.get(f'RATE_LIMIT_{ai_type.upper()}_{name.upper()}')
+            if value is not None and value != '':
+                values[name] = int(value) or None
+            values[name] = _share(values[name], processes)
+    return limits
+
+
+def _share(value, processes):
+    if value is None:
+        return None
+    return max(1, value // processes)
+
+
+def estimate_tokens(messages, max_tokens):
+    # 정확한 토크나이저 없이 대략 3글자당 1토큰으로 계산하고, 출력 한도까지 미리 예약한다
+    chars = sum(len(m.get('content') or '') for m in messages)
+    return chars // 3 + max_tokens
+
+
+class TokenBucket:
+    """분당 per_minute 만큼 채워지는 토큰 버킷.
+
+    reserve() 는 잔량이 모자라도 먼저 차감하고 기다려야 할 시간을 돌려준다.
+    그래서 대기 중인 호출들은 한꺼번에 깨어나지 않고 예약한 순서대로 하나씩 풀려난다.
+    """
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self._tokens = float(per_minute)
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        rate = self.per_minute / 60.0
+        self._tokens = min(float(self.per_minute), self._tokens + (now - self._updated) * rate)
+        self._updated = now
+
+    def reserve(self, amount, now):
+        self._refill(now)
+        self._tokens -= amount
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens / (self.per_minute / 60.0)
+
+    def sync(self, limit, remaining, now):
+        self._refill(now)
+        if limit:
+            self.per_minute = limit
+        if remaining is not None:
+            self._tokens = min(self._tokens, float(remaining))
+
+    def pause(self, seconds, now):
+        # seconds 동안은 새 예약이 통과하지 못하도록 잔량을 음수로 만든다
+        self._refill(now)
+        self._tokens = min(self._tokens, -seconds * self.per_minute / 60.0)
+
+
+class RateLimiter:
+    """provider 와 API 키 하나에 대한 요청 수 / 토큰 수 제한.
+
+    rpm / tpm 은 이 프로세스의 몫이다. 응답 헤더의 한도와 잔량은 계정 전체의 값이라 processes 로 나눠서 반영한다.
+    """
+
+    def __init__(self, rpm=None, tpm=None, processes=PROCESS_COUNT):
+        self._requests = TokenBucket(rpm) if rpm else None
+        self._tokens = TokenBucket(tpm) if tpm else None
+        self._processes = processes
+        self._lock = threading.Lock()
+        self.total_wait = 0.0
+        self.waits = 0
+
+    def _buckets(self):
+        return [b for b in (self._requests, self._tokens) if b is not None]
+
+    def acquire(self, tokens=0):
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def reserve(self, tokens=0):
+        """차례를 예약하고 기다려야 할 시간(초)을 돌려준다. 직접 기다리지는 않는다 (async 호출용)."""
+        with self._lock:
+            now = time.monotonic()
+            wait = 0.0
+            if self._requests:
+                wait = max(wait, self._requests.reserve(1, now))
+            if self._tokens:
+                wait = max(wait, self._tokens.reserve(tokens, now))
+            if wait > 0:
+                self.total_wait += wait
+                self.waits += 1
+        return wait
+
+    def pause(self, seconds):
+        with self._lock:
+            now = time.monotonic()
+            for bucket in self._buckets():
+                bucket.pause(seconds, now)
+
+    def _share_headers(self, limit, remaining):
+        if remaining is not None:
+            remaining //= self._processes
+        return _share(limit, self._processes), remaining
+
+    def update_from_headers(self, headers):
+        if not headers:
+            return
+        request_limit, request_remaining = self._share_headers(*_parse_limit_headers(headers, 'requests'))
+        token_limit, token_remaining = self._share_headers(*_parse_limit_headers(headers, 'tokens'))
+        with self._lock:
+            now = time.monotonic()
+            if self._requests and (request_limit or request_remaining is not None):
+                self._requests.sync(request_limit, request_remaining, now)
+            if self._tokens and (token_limit or token_remaining is not None):
+                self._tokens.sync(token_limit, token_remaining, now)
+
+
+def _header_int(headers, name):
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return int(float(value))
+    except ValueError:
+        return None
+
+
+def _parse_limit_headers(headers, kind):
+    # OpenAI: x-ratelimit-limit-requests / x-ratelimit-remaining-requests
+    # Anthropic: anthropic-ratelimit-requests-limit / anthropic-ratelimit-requests-remaining
+    limit = _header_int(headers, f'x-ratelimit-limit-{kind}')
+    remaining = _header_int(headers, f'x-ratelimit-remaining-{kind}')
+    if limit is None and remaining is None:
+        limit = _header_int(headers, f'anthropic-ratelimit-{kind}-limit')
+        remaining = _header_int(headers, f'anthropic-ratelimit-{kind}-remaining')
+    return limit, remaining
+
+
+def _parse_duration(value):
+    # "1s", "6m0s", "20ms" 형식 (OpenAI reset 헤더)
+    total = 0.0
+    for number, unit in re.findall(r'(\d+(?:\.\d+)?)(ms|s|m|h)', value):
+        total += float(number) * {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}[unit]
+    return total
+
+
+def retry_after_seconds(error):
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    value = headers.get('retry-after-ms')
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    value = headers.get('x-ratelimit-reset-requests') or headers.get('x-ratelimit-reset-tokens')
+    if value:
+        return _parse_duration(value)
+    value = headers.get('anthropic-ratelimit-requests-reset') or headers.get('anthropic-ratelimit-tokens-reset')
+    if value:
+        try:
+            reset = datetime.fromisoformat(value.replace('Z', '+00:00'))
+            return max(0.0, (reset - datetime.now(timezone.utc)).total_seconds())
+        except ValueError:
+            pass
+    return None
+
+
+def is_transient_error(error):
+    if isinstance(error, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError,
+                          openai.InternalServerError)):
+        return True
+    if isinstance(error, (anthropic.RateLimitError, anthropic.APITimeoutError, anthropic.APIConnectionError,
+                          anthropic.InternalServerError)):
+        return True
+    if isinstance(error, (openai.APIStatusError, anthropic.APIStatusError)):
+        return error.status_code in TRANSIENT_STATUS_CODES
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code in TRANSIENT_STATUS_CODES
+    if isinstance(error, httpx.TransportError):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in TRANSIENT_STATUS_CODES
+    return False
+
+
+def is_rate_limit_error(error):
+    if isinstance(error, (openai.RateLimitError, anthropic.RateLimitError)):
+        return True
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None) == 429
+
+
+def backoff_delay(attempt):
+    # exponential backoff + full jitter
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+
+
+class RateLimiterRegistry:
+    def __init__(self, limits=None):
+        self._limits = limits or load_limits_from_env()
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def get(self, ai_type, key_id=0):
+        with self._lock:
+            limiter = self._limiters.get((ai_type, key_id))
+            if limiter is None:
+                limits = self._limits[ai_type]
+                limiter = RateLimiter(limits['rpm'], limits['tpm'])
+                self._limiters[(ai_type, key_id)] = limiter
+            return limiter
+
+    def stats(self):
+        with self._lock:
+            return {
+                f'{ai_type}:{key_id}': {'waits': limiter.waits, 'total_wait': limiter.total_wait}
+                for (ai_type, key_id), limiter in self._limiters.items()
+            }
+
+
+rate_limiters = RateLimiterRegistry()
+
+
+class RequestCancelled(Exception):
+    """hedging 에서 다른 provider 가 먼저 응답해서 더 이상 필요 없어진 요청."""
+
+
+# 지금 스레드에서 진행 중인 요청의 cancel 이벤트. limiter 대기와 재시도 대기 중에도 취소를 확인한다.
+_cancel_event = contextvars.ContextVar('llm_cancel_event', default=None)
+
+
+@contextmanager
+def cancellable(cancel):
+    """이 안에서 하는 limited / call_with_retry 는 cancel 이 설정되면 RequestCancelled 로 멈춘다."""
+    token = _cancel_event.set(cancel)
+    try:
+        yield
+    finally:
+        _cancel_event.reset(token)
+
+
+def raise_if_cancelled():
+    cancel = _cancel_event.get()
+    if cancel is not None and cancel.is_set():
+        raise RequestCancelled()
+
+
+def cancellable_sleep(seconds):
+    """seconds 동안 기다린다. cancellable() 안에서 cancel 이 설정되면 바로 RequestCancelled."""
+    cancel = _cancel_event.get()
+    if cancel is None:
+        time.sleep(seconds)
+    elif cancel.wait(seconds):
+        raise RequestCancelled()
+
+
+@contextmanager
+def limited(ai_type, key_id, tokens):
+    """호출 전에 limiter 에서 차례를 기다리고, rate limit 에러가 나면 해당 키의 limiter 를 잠시 멈춘다."""
+    raise_if_cancelled()
+    limiter = rate_limiters.get(ai_type, key_id)
+    wait = limiter.reserve(tokens)
+    if wait > 0:
+        llm_rate_limit_wait.observe(wait, ai_type)
+        tracing.add_event('rate_limit_wait', provider=ai_type, seconds=wait)
+        cancellable_sleep(wait)
+    raise_if_cancelled()
+    try:
+        yield limiter
+    except Exception as e:
+        if is_rate_limit_error(e):
+            llm_rate_limited.inc(ai_type)
+            limiter.pause(retry_after_seconds(e) or BACKOFF_BASE)
+        raise
+
+
+def call_with_retry(fn, max_retries=5, ai_type=None):
+    """ai_type 은 재시도 지표의 provider label 로만 쓴다. cancellable 안에서는 취소된 뒤에 재시도하지 않는다."""
+    for attempt in range(max_retries):
+        raise_if_cancelled()
+        try:
+            return fn()
+        except Exception as e:
+            if not is_transient_error(e) or attempt == max_retries - 1:
+                raise
+            raise_if_cancelled()
+            # rate limit 대기는 limiter 가 맡고, 여기서는 재시도가 몰리지 않도록 짧게 흩어준다
+            delay = backoff_delay(attempt)
+            llm_retries.inc(ai_type or '', type(e).__name__)
+            tracing.add_event('retry', provider=ai_type, attempt=attempt + 1, error=type(e).__name__, delay=delay)
+            print(f"Transient error ({type(e).__name__}: {e}). Retrying in {delay:.1f} seconds...")
+            cancellable_sleep(delay)
+
+
+@asynccontextmanager
+async def limited_async(ai_type, key_id, tokens):
+    """limited 의 async 버전. 차례를 기다리는 동안 event loop 를 막지 않는다."""
+    limiter = rate_limiters.get(ai_type, key_id)
+    wait = limiter.reserve(tokens)
+    if wait > 0:
+        llm_rate_limit_wait.observe(wait, ai_type)
+        tracing.add_event('rate_limit_wait', provider=ai_type, seconds=wait)
+        await asyncio.sleep(wait)
+    try:
+        yield limiter
+    except Exception as e:
+        if is_rate_limit_error(e):
+            llm_rate_limited.inc(ai_type)
+            limiter.pause(retry_after_seconds(e) or BACKOFF_BASE)
+        raise
+
+
+async def call_with_retry_async(fn, max_retries=5, ai_type=None):
+    """fn 은 coroutine 을 돌려주는 함수. 재시도 규칙은 call_with_retry 와 같다."""
+    for attempt in range(max_retries):
+        try:
+            return await fn()
+        except Exception as e:
+            if not is_transient_error(e) or attempt == max_retries - 1:
+                raise
+            delay = backoff_delay(attempt)
+            llm_retries.inc(ai_type or '', type(e).__name__)
+            tracing.add_event('retry', provider=ai_type, attempt=attempt + 1, error=type(e).__name__, delay=delay)
+            print(f"Transient error ({type(e).__name__}: {e}). Retrying in {delay:.1f} seconds...")
+            await asyncio.sleep(delay)
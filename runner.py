@@ -0,0 +1,354 @@
+import atexit
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+import requests
+from app_logs import LogBuffer, SpillFile, spill_path, start_pump
+
+# 생성된 앱에 나눠줄 포트 범위. RUNNER_PORTS=6001-6100
+PORT_RANGE = tuple(int(p) for p in (os.environ.get('RUNNER_PORTS') or '6001-6100').split('-', 1))
+# 동시에 띄워두는 앱 수. 넘으면 가장 오래 쓰지 않은 앱을 내린다
+MAX_APPS = int(os.environ.get('RUNNER_MAX_APPS') or 8)
+# 이 시간(초) 동안 실행 요청도 로그 출력도 없으면 내린다. flask run 은 요청마다 로그를 남기므로
+# 브라우저에서 앱을 쓰고 있는 동안에는 내려가지 않는다
+IDLE_TIMEOUT = float(os.environ.get('RUNNER_IDLE_TIMEOUT') or 600)
+# 앱이 포트를 열 때까지 기다리는 최대 시간(초)
+READY_TIMEOUT = float(os.environ.get('RUNNER_READY_TIMEOUT') or 30)
+# 설정하면 포트가 열린 뒤 이 경로가 500 미만으로 응답할 때까지 기다린다 (예: /)
+HEALTH_PATH = os.environ.get('RUNNER_HEALTH_PATH') or ''
+# 1 이면 프로젝트 생성이 끝났을 때 앱을 미리 띄워둬서 첫 실행 요청이 바로 응답한다
+PREWARM_ENABLED = os.environ.get('RUNNER_PREWARM', '0') == '1'
+# 브라우저에 돌려줄 URL 의 호스트
+PUBLIC_HOST = os.environ.get('RUNNER_PUBLIC_HOST') or 'localhost'
+
+READY_POLL_INTERVAL = 0.1
+REAP_INTERVAL = 30
+STOP_TIMEOUT = 5
+# 다른 프로세스가 먼저 포트를 잡아서 실패하면 다른 포트로 다시 띄운다
+START_ATTEMPTS = 3
+# 실행에 실패했을 때 응답에 넣는 마지막 로그 줄 수
+ERROR_LOG_LINES = 200
+
+
+class RunnerError(Exception):
+    def __init__(self, message, logs=None):
+        super().__init__(message)
+        self.logs = logs or []
+
+
+class RunningApp:
+    def __init__(self, key, process, port, fingerprint, python, logs):
+        self.key = key
+        self.process = process
+        self.port = port
+        self.fingerprint = fingerprint
+        self.python = python
+        self.logs = logs
+        self.pump = start_pump(process.stdout, logs, name=f'app-log-{port}')
+        self.started_at = time.time()
+        self.last_used = time.monotonic()
+
+    @property
+    def url(self):
+        return f'http://{PUBLIC_HOST}:{self.port}/'
+
+    def last_active(self):
+        """마지막 실행 요청과 마지막 로그 출력 중 늦은 시각 (time.monotonic)."""
+        return max(self.last_used, self.logs.last_append)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def to_dict(self):
+        return {
+            'account_guid': self.key[0],
+            'project_guid': self.key[1],
+            'port': self.port,
+            'pid': self.process.pid,
+            'url': self.url,
+            'started_at': self.started_at,
+            'idle_seconds': time.monotonic() - self.last_active(),
+        }
+
+
+def _port_free(port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind(('0.0.0.0', port))
+        except OSError:
+            return False
+    return True
+
+
+def _port_open(port):
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=READY_POLL_INTERVAL):
+            return True
+    except OSError:
+        return False
+
+
+def _healthy(port):
+    try:
+        return requests.get(f'http://127.0.0.1:{port}{HEALTH_PATH}', timeout=2).status_code < 500
+    except requests.RequestException:
+        return False
+
+
+def _terminate(process):
+    # flask 가 만든 자식 프로세스까지 같이 내리도록 프로세스 그룹 단위로 보낸다
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    try:
+        process.wait(STOP_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.wait()
+
+
+class RunnerPool:
+    """프로젝트별로 실행 중인 생성 앱과 포트를 관리한다.
+
+    - 포트는 PORT_RANGE 에서 비어 있는 것을 골라서 주고, 다른 프로세스를 죽이지 않는다
+    - 코드가 바뀌지 않았으면(fingerprint 가 같으면) 실행 중인 앱을 그대로 돌려준다
+    - 고정 시간 sleep 대신 포트가 열리는지(HEALTH_PATH 가 있으면 응답하는지) 확인해서 준비 여부를 판단한다
+    - MAX_APPS 를 넘으면 가장 오래 쓰지 않은 앱을, IDLE_TIMEOUT 동안 쓰지 않은 앱은 reaper 스레드가 내린다.
+      시작 중인 앱도 MAX_APPS 에 세고, 쓰는지는 실행 요청과 앱의 로그 출력으로 판단한다
+    프로세스마다 따로 관리하므로 gunicorn worker 끼리는 실행 중인 앱을 공유하지 않는다.
+    """
+
+    def __init__(self, port_range=PORT_RANGE, max_apps=MAX_APPS, idle_timeout=IDLE_TIMEOUT):
+        self._ports = range(port_range[0], port_range[1] + 1)
+        self._next_port = 0
+        self._max_apps = max_apps
+        self._idle_timeout = idle_timeout
+        self._apps = {}
+        # 프로젝트별 마지막 실행의 로그. 앱이 내려간 뒤에도 볼 수 있도록 최근 max_apps * 2 개까지 남긴다
+        self._logs = OrderedDict()
+        # 실행 중이라 아직 _apps 에 없는 앱이 받은 포트
+        self._reserved = set()
+        # 앱을 시작하는 중이라 아직 _apps 에 없는 프로젝트
+        self._starting = set()
+        # 다른 요청이 내리기로 고른 앱
+        self._evicting = set()
+        # 프로젝트마다 실행/중지가 겹치지 않도록 잠근다. 다른 프로젝트의 실행은 기다리지 않는다
+        self._project_locks = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def _project_lock(self, key):
+        with self._lock:
+            return self._project_locks.setdefault(key, threading.Lock())
+
+    def _start_reaper(self):
+        with self._lock:
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._reap_loop, name='runner-reaper', daemon=True)
+                self._reaper.start()
+
+    def _allocate_port(self):
+        with self._lock:
+            used = {app.port for app in self._apps.values()} | self._reserved
+            for _ in range(len(self._ports)):
+                port = self._ports[self._next_port % len(self._ports)]
+                self._next_port += 1
+                if port not in used and _port_free(port):
+                    self._reserved.add(port)
+                    return port
+        raise RunnerError('사용할 수 있는 포트가 없습니다.')
+
+    def _evict_for_new_app(self, key):
+        """key 의 앱을 더해도 MAX_APPS 를 넘지 않도록 오래 쓰지 않은 다른 앱을 내린다.
+
+        동시에 시작 중인 다른 프로젝트의 앱도 센다. 시작 중인 앱은 내릴 수 없으므로 시작이 끝난 뒤에도 한 번 더 부른다.
+        key 의 앱이 _apps 에 있어도 others 에서 빼고 한 자리로 센다.
+        두 요청이 같은 앱을 골라서 하나만 내려가지 않도록 고른 앱은 _evicting 에 넣어둔다.
+        """
+        with self._lock:
+            others = sorted((app for k, app in self._apps.items() if k != key and k not in self._evicting),
+                            key=lambda app: app.last_active())
+            excess = len(others) + len(self._starting | {key}) - self._max_apps
+            victims = others[:max(0, excess)]
+            self._evicting.update(victim.key for victim in victims)
+        for victim in victims:
+            print(f"Evicting app {victim.key} on port {victim.port} (max {self._max_apps} apps)")
+            try:
+                self.stop(*victim.key)
+            finally:
+                with self._lock:
+                    self._evicting.discard(victim.key)
+
+    def run(self, account_guid, project_guid, project_path, fingerprint=None, python=None, lease=None):
+        """앱을 실행하고 (RunningApp, 재사용 여부) 를 돌려준다. 실행에 실패하면 RunnerError.
+
+        python 은 앱을 실행할 인터프리터 (env_cache 의 virtualenv). 없으면 서버의 python.
+        lease 는 env_cache 의 잠금 파일로, 앱 프로세스가 물려받아서 살아 있는 동안 env 가 지워지지 않는다.
+        닫는 것은 호출자가 한다.
+        """
+        key = (account_guid, project_guid)
+        python = python or sys.executable
+        self._start_reaper()
+        with self._project_lock(key):
+            with self._lock:
+                app = self._apps.get(key)
+            if app is not None:
+                if (app.alive() and fingerprint is not None and app.fingerprint == fingerprint
+                        and app.python == python):
+                    app.last_used = time.monotonic()
+                    return app, True
+                self._stop(key)
+
+            with self._lock:
+                self._starting.add(key)
+            try:
+                self._evict_for_new_app(key)
+                app = self._start_ready(key, project_path, fingerprint, python, lease)
+            finally:
+                with self._lock:
+                    self._starting.discard(key)
+        # 같이 시작한 앱들 때문에 MAX_APPS 를 넘었으면 정리한다. 서로의 프로젝트 잠금을 기다리지 않도록 잠금 밖에서 한다
+        self._evict_for_new_app(key)
+        return app, False
+
+    def _start_ready(self, key, project_path, fingerprint, python, lease):
+        for attempt in range(START_ATTEMPTS):
+            app = self._start(key, project_path, fingerprint, python, lease)
+            try:
+                self._wait_ready(app)
+            except RunnerError as e:
+                if 'Address already in use' in '\n'.join(e.logs) and attempt < START_ATTEMPTS - 1:
+                    continue
+                raise
+            finally:
+                with self._lock:
+                    self._reserved.discard(app.port)
+            with self._lock:
+                self._apps[key] = app
+            return app
+
+    def prewarm(self, account_guid, project_guid, project_path, fingerprint=None, python=None):
+        """백그라운드 스레드에서 앱을 띄워둔다. 실패해도 다음 run() 에서 다시 시도하므로 로그만 남긴다.
+
+        python 은 인터프리터 경로이거나, env 를 만드는 동안 요청을 붙잡지 않도록 (python, lease) 를 돌려주는 함수.
+        """
+        def warm():
+            lease = None
+            try:
+                interpreter, lease = python() if callable(python) else (python, None)
+                self.run(account_guid, project_guid, project_path, fingerprint, interpreter, lease)
+            except Exception as e:
+                print(f"Prewarm failed for {account_guid}/{project_guid}: {e}")
+            finally:
+                if lease is not None:
+                    lease.close()
+        threading.Thread(target=warm, name='runner-prewarm', daemon=True).start()
+
+    def _start(self, key, project_path, fingerprint, python, lease=None):
+        port = self._allocate_port()
+        try:
+            process = subprocess.Popen(
+                [python, '-m', 'flask', 'run', '--host=0.0.0.0', f'--port={port}'],
+                cwd=project_path,  # Flask 앱의 경로
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                bufsize=1,
+                encoding='utf-8',
+                errors='replace',
+                start_new_session=True,
+                pass_fds=(lease.fileno(),) if lease is not None else (),
+            )
+        except Exception:
+            with self._lock:
+                self._reserved.discard(port)
+            raise
+        print(f"Started app {key} on port {port} (pid {process.pid})")
+        path = spill_path(*key)
+        logs = LogBuffer(spill=SpillFile(path) if path else None)
+        with self._lock:
+            self._logs[key] = logs
+            self._logs.move_to_end(key)
+            while len(self._logs) > self._max_apps * 2:
+                self._logs.popitem(last=False)
+        return RunningApp(key, process, port, fingerprint, python, logs)
+
+    def _wait_ready(self, app):
+        deadline = time.monotonic() + READY_TIMEOUT
+        while time.monotonic() < deadline:
+            if not app.alive():
+                # 남은 출력을 pump 가 다 읽을 때까지 잠깐 기다린다
+                app.pump.join(1)
+                raise RunnerError('Flask 서버 실행에 실패했습니다.', app.logs.read(-ERROR_LOG_LINES)['lines'])
+            if _port_open(app.port) and (not HEALTH_PATH or _healthy(app.port)):
+                return
+            time.sleep(READY_POLL_INTERVAL)
+        _terminate(app.process)
+        raise RunnerError('Flask 서버 실행 시간이 초과되었습니다.')
+
+    def _stop(self, key):
+        with self._lock:
+            app = self._apps.pop(key, None)
+        if app is not None:
+            _terminate(app.process)
+            print(f"Stopped app {key} on port {app.port}")
+        return app is not None
+
+    def stop(self, account_guid, project_guid):
+        key = (account_guid, project_guid)
+        with self._project_lock(key):
+            return self._stop(key)
+
+    def get(self, account_guid, project_guid):
+        with self._lock:
+            app = self._apps.get((account_guid, project_guid))
+        return app if app is not None and app.alive() else None
+
+    def logs(self, account_guid, project_guid):
+        """마지막으로 실행한 앱의 LogBuffer. 실행한 적이 없으면 None."""
+        with self._lock:
+            return self._logs.get((account_guid, project_guid))
+
+    def pythons(self):
+        with self._lock:
+            return [app.python for app in self._apps.values()]
+
+    def list(self):
+        with self._lock:
+            return [app.to_dict() for app in self._apps.values() if app.alive()]
+
+    def reap(self):
+        """죽은 앱과 IDLE_TIMEOUT 동안 실행 요청도 로그 출력도 없던 앱을 정리한다."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, app in self._apps.items()
+                       if not app.alive() or now - app.last_active() > self._idle_timeout]
+        for key in expired:
+            self.stop(*key)
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(REAP_INTERVAL)
+            try:
+                self.reap()
+            except Exception as e:
+                print(f"Runner reap failed: {e}")
+
+    def stop_all(self):
+        with self._lock:
+            keys = list(self._apps)
+        for key in keys:
+            self.stop(*key)
+
+
+runner_pool = RunnerPool()
+atexit.register(runner_pool.stop_all)
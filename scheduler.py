@@ -0,0 +1,322 @@
+import ast
+import asyncio
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from jobs import file_key
+
+ENTRY_FILES = {'app.py'}
+TEMPLATE_EXTENSIONS = {'.html', '.js'}
+# 파일별 명세 fingerprint 를 저장하는 프로젝트 메타 파일
+FINGERPRINT_FILE = 'file_fingerprints.json'
+
+
+def _key(file_info):
+    return file_key(file_info.get('path', ''), file_info.get('fname', ''))
+
+
+def _module_names(file_info):
+    names = set()
+    base, ext = os.path.splitext(file_info.get('fname', ''))
+    if ext == '.py':
+        names.add(base)
+    object_name = file_info.get('objectName')
+    if object_name and object_name != 'NoneObject':
+        names.add(object_name)
+    return names
+
+
+def build_dependency_graph(files):
+    """code_structure 의 Files 목록에서 파일 간 의존 관계를 만든다. {key: set(의존하는 key)}
+
+    - 파이썬 파일은 functionList 에 다른 파이썬 파일의 모듈 이름이나 objectName 이 나오면 그 파일에 의존
+    - app.py 같은 진입 파일은 다른 모든 파이썬 파일에 의존 (import 해서 라우트를 만든다)
+    - html/js 템플릿은 진입 파일의 라우트를 호출하므로 진입 파일에 의존
+    - requirements.txt 는 모든 파이썬 파일의 import 를 보고 만들도록 파이썬 파일에 의존
+    """
+    graph = {_key(f): set() for f in files}
+    python_files = [f for f in files if f.get('fname', '').endswith('.py')]
+    entry_keys = {_key(f) for f in python_files if f.get('fname') in ENTRY_FILES}
+
+    for f in files:
+        key = _key(f)
+        fname = f.get('fname', '')
+        ext = os.path.splitext(fname)[1]
+        if fname in ENTRY_FILES:
+            graph[key] |= {_key(other) for other in python_files if _key(other) != key}
+        elif ext == '.py':
+            references = json.dumps(f.get('functionList', []), ensure_ascii=False)
+            for other in python_files:
+                other_key = _key(other)
+                if other_key == key or other_key in entry_keys:
+                    continue
+                if any(re.search(rf'\b{re.escape(name)}\b', references) for name in _module_names(other)):
+                    graph[key].add(other_key)
+        elif ext in TEMPLATE_EXTENSIONS:
+            graph[key] |= entry_keys
+        elif fname == 'requirements.txt':
+            graph[key] |= {_key(other) for other in python_files}
+    return graph
+
+
+def _toposort(graph):
+    """(layers, 순환을 끊으려고 지운 의존 {key: set(deps)}). graph 는 바꾸지 않는다.
+
+    남은 파일이 모두 무언가를 기다리면(순환) 남은 의존이 가장 적은 파일의 의존을 끊고 진행한다.
+    """
+    remaining = {key: set(deps) for key, deps in graph.items()}
+    layers = []
+    removed = {}
+    while remaining:
+        ready = sorted(key for key, deps in remaining.items() if not deps)
+        if not ready:
+            key = min(remaining, key=lambda k: (len(remaining[k]), k))
+            removed[key] = remaining[key]
+            ready = [key]
+        layers.append(ready)
+        for key in ready:
+            del remaining[key]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+    return layers, removed
+
+
+def break_cycles(graph):
+    """순환 의존을 끊은 새 graph 를 돌려준다. 끊는 간선은 dependency_layers 가 고르는 것과 같다."""
+    _, removed = _toposort(graph)
+    return {key: deps - removed.get(key, set()) for key, deps in graph.items()}
+
+
+def dependency_layers(graph):
+    """위상 정렬 결과를 병렬로 만들 수 있는 묶음(layer) 단위로 돌려준다. graph 는 바꾸지 않는다.
+
+    순환 의존이 있으면 남은 의존이 가장 적은 파일의 의존을 끊고 진행한다. 그 간선까지 지운 graph 가
+    필요하면 break_cycles 를 쓴다.
+    """
+    return _toposort(graph)[0]
+
+
+def extract_signatures(fname, content):
+    """생성된 파일에서 다른 파일이 참조할 시그니처(import, 라우트, 함수, 클래스, 모듈 변수)만 뽑는다."""
+    if not fname.endswith('.py') or not content:
+        return ''
+    try:
+        tree = ast.parse(content)
+    except SyntaxError:
+        return '\n'.join(line for line in content.splitlines()
+                         if re.match(r'\s*(@|def |class |async def |import |from )', line))
+
+    lines = []
+
+    def add_function(node, indent=''):
+        for decorator in node.decorator_list:
+            lines.append(f"{indent}@{ast.unparse(decorator)}")
+        prefix = 'async def' if isinstance(node, ast.AsyncFunctionDef) else 'def'
+        returns = f" -> {ast.unparse(node.returns)}" if node.returns else ''
+        lines.append(f"{indent}{prefix} {node.name}({ast.unparse(node.args)}){returns}: ...")
+
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            lines.append(ast.unparse(node))
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            add_function(node)
+        elif isinstance(node, ast.ClassDef):
+            bases = ', '.join(ast.unparse(b) for b in node.bases)
+            lines.append(f"class {node.name}({bases}):" if bases else f"class {node.name}:")
+            for item in node.body:
+                if isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    add_function(item, '    ')
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            source = ast.unparse(node)
+            if len(source) <= 120:
+                lines.append(source)
+    return '\n'.join(lines)
+
+
+def _planned_names(file_info):
+    names = _module_names(file_info)
+    for item in file_info.get('functionList', []):
+        match = re.match(r'\s*([A-Za-z_][A-Za-z0-9_]*)', str(item))
+        if match:
+            names.add(match.group(1))
+    return names
+
+
+def chart_section(function_call_chart, file_info):
+    """함수 호출표에서 이 파일의 모듈/함수 이름이 나오는 줄만 모은다."""
+    names = _planned_names(file_info) | {file_info.get('fname', '')}
+    names.discard('')
+    lines = []
+    for line in (function_call_chart or '').splitlines():
+        if any(re.search(rf'(?<![A-Za-z0-9_]){re.escape(name)}(?![A-Za-z0-9_])', line) for name in names):
+            lines.append(line.strip())
+    return '\n'.join(lines)
+
+
+def spec_fingerprints(files, function_call_chart):
+    """파일마다 명세 fingerprint 를 계산한다. {key: sha256}
+
+    code_structure 항목, 함수 호출표에서 관련된 줄, 의존하는 파일들의 fingerprint 를 합쳐서 해시하므로
+    의존 파일의 명세가 바뀌면 그 파일을 쓰는 파일의 fingerprint 도 바뀐다.
+    """
+    files_by_key = {_key(f): f for f in files}
+    graph = break_cycles(build_dependency_graph(files))
+    fingerprints = {}
+    for layer in dependency_layers(graph):
+        for key in layer:
+            file_info = files_by_key[key]
+            spec = {
+                'file': file_info,
+                'chart': chart_section(function_call_chart, file_info),
+                'dependencies': sorted(fingerprints[dep] for dep in graph[key]),
+            }
+            data = json.dumps(spec, ensure_ascii=False, sort_keys=True)
+            fingerprints[key] = hashlib.sha256(data.encode('utf-8')).hexdigest()
+    return fingerprints
+
+
+def completed_future(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class _DependencyRun:
+    """DependencyScheduler 의 진행 상태.
+
+    complete 가 False 인 동안(설계가 아직 스트리밍되는 중)에는 파일 목록이 늘어날 수 있으므로, 지금까지 받은
+    파일만으로 그래프를 만들고 진입 파일/템플릿/requirements.txt 처럼 전체 목록이 있어야 의존 관계가 정해지는
+    파일은 시작하지 않는다. 먼저 시작한 파일이 나중에 도착한 파일에 의존하면 그 시그니처 없이 만들어진다.
+    """
+
+    def __init__(self, files=(), complete=True):
+        self.files_by_key = {_key(f): f for f in files}
+        self.complete = False
+        self.started = set()
+        self.results = {}
+        self.signatures = {}
+        if complete:
+            self.close(files)
+        else:
+            self._rebuild()
+
+    def _rebuild(self):
+        # 순환 의존이 있으면 서로 기다리기만 하므로 먼저 끊는다
+        self.graph = break_cycles(build_dependency_graph(list(self.files_by_key.values())))
+        self.waiting = {key: deps - set(self.results)
+                        for key, deps in self.graph.items() if key not in self.started}
+
+    def add(self, file_info):
+        key = _key(file_info)
+        if self.complete or key in self.files_by_key:
+            return
+        self.files_by_key[key] = file_info
+        self._rebuild()
+
+    def close(self, files):
+        """전체 파일 목록이 정해졌다. 아직 시작하지 않은 파일은 이 목록을 따른다."""
+        final = {_key(f): f for f in files}
+        for key in list(self.files_by_key):
+            if key not in final and key not in self.started:
+                del self.files_by_key[key]
+        for key, file_info in final.items():
+            if key not in self.started:
+                self.files_by_key[key] = file_info
+        self.complete = True
+        self._rebuild()
+
+    def _can_start_early(self, key):
+        fname = self.files_by_key[key].get('fname', '')
+        return not (fname in ENTRY_FILES or fname == 'requirements.txt'
+                    or os.path.splitext(fname)[1] in TEMPLATE_EXTENSIONS)
+
+    def ready(self):
+        """이제 실행할 수 있는 (key, file_info, dependency_context) 목록."""
+        launch = []
+        for key in [k for k, deps in self.waiting.items() if not deps]:
+            if not self.complete and not self._can_start_early(key):
+                continue
+            del self.waiting[key]
+            self.started.add(key)
+            context = ''
+            for dep in sorted(self.graph[key]):
+                if self.signatures.get(dep):
+                    context += f"\n# {dep}\n{self.signatures[dep]}\n"
+            launch.append((key, self.files_by_key[key], context))
+        return launch
+
+    def finish(self, key, content):
+        self.results[key] = content
+        if content:
+            self.signatures[key] = extract_signatures(self.files_by_key[key].get('fname', ''), content)
+        # 실패한 파일이 있어도 이를 의존하는 파일은 시그니처 없이 진행한다
+        for deps in self.waiting.values():
+            deps.discard(key)
+
+
+class DependencyScheduler:
+    """의존하는 파일이 모두 만들어진 파일부터 바로 submit 한다.
+
+    submit(file_info, dependency_context) 는 생성된 파일 내용(실패 시 None)을 결과로 갖는 Future
+    (asyncio 에서는 Task) 를 돌려준다. dependency_context 에는 이미 생성된 의존 파일들의 시그니처만 들어간다.
+    files 없이 만들면 설계를 스트리밍하면서 add() 로 파일을 하나씩 넘기고, 설계가 끝나면 close(files) 한다.
+    """
+
+    def __init__(self, submit, files=None):
+        self._submit = submit
+        self._run = _DependencyRun(files or (), complete=files is not None)
+        self._running = {}
+        self._launch_ready()
+
+    @property
+    def results(self):
+        return self._run.results
+
+    def _launch_ready(self):
+        for key, file_info, context in self._run.ready():
+            self._running[self._submit(file_info, context)] = key
+
+    def _finish(self, done):
+        for future in done:
+            self._run.finish(self._running.pop(future), future.result())
+
+    def poll(self):
+        """끝난 파일을 반영하고 새로 준비된 파일을 시작한다. 기다리지 않는다."""
+        self._finish([future for future in self._running if future.done()])
+        self._launch_ready()
+
+    def add(self, file_info):
+        self._run.add(file_info)
+        self.poll()
+
+    def close(self, files):
+        self._run.close(files)
+        self.poll()
+
+    def join(self):
+        """실행 중인 파일이 모두 끝날 때까지 기다린다. 반환값은 {key: 생성된 내용}."""
+        while self._running:
+            done, _ = wait(list(self._running), return_when=FIRST_COMPLETED)
+            self._finish(done)
+            self._launch_ready()
+        return self.results
+
+    async def ajoin(self):
+        while self._running:
+            done, _ = await asyncio.wait(list(self._running), return_when=asyncio.FIRST_COMPLETED)
+            self._finish(done)
+            self._launch_ready()
+        return self.results
+
+
+def run_dependency_ordered(files, submit):
+    """files 를 의존 순서대로 실행하고 {key: 생성된 내용} 을 돌려준다. submit 은 DependencyScheduler 와 같다."""
+    return DependencyScheduler(submit, files).join()
+
+
+async def arun_dependency_ordered(files, submit):
+    """run_dependency_ordered 의 asyncio 버전. submit 은 생성된 내용을 돌려주는 coroutine 을 만든다."""
+    return await DependencyScheduler(lambda file_info, context: asyncio.ensure_future(submit(file_info, context)),
+                                     files).ajoin()
@@ -0,0 +1,105 @@
+import json
+from collections import namedtuple
+from flask import Response
+
+SseEvent = namedtuple('SseEvent', ['event', 'data', 'id'])
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',  # nginx 가 이벤트를 모아서 보내지 않도록
+}
+
+
+def format_sse(data, event=None, event_id=None):
+    if not isinstance(data, str):
+        data = json.dumps(data, ensure_ascii=False)
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    if event:
+        lines.append(f'event: {event}')
+    for line in data.split('\n'):
+        lines.append(f'data: {line}')
+    return '\n'.join(lines) + '\n\n'
+
+
+def resume_offset(last_event_id, offset=None, default=0):
+    """EventSource 가 다시 연결할 때 이어서 보낼 위치. Last-Event-ID, offset 순서로 보고 숫자가 아니면 default."""
+    for value in (last_event_id, offset):
+        if value is None or value == '':
+            continue
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            continue
+    return default
+
+
+def sse_response(events):
+    return Response(events, mimetype='text/event-stream', headers=SSE_HEADERS)
+
+
+class _SseParser:
+    """줄을 하나씩 받아서 빈 줄(이벤트 경계)을 만나면 완성된 SseEvent 를 돌려준다."""
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self.event = None
+        self.data = []
+        self.event_id = None
+
+    def feed(self, line):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line:
+            return self.flush()
+        if line.startswith(':'):
+            return None
+        field, _, value = line.partition(':')
+        if value.startswith(' '):
+            value = value[1:]
+        if field == 'event':
+            self.event = value
+        elif field == 'data':
+            self.data.append(value)
+        elif field == 'id':
+            self.event_id = value
+        return None
+
+    def flush(self):
+        event = None
+        if self.data:
+            event = SseEvent(self.event or 'message', '\n'.join(self.data), self.event_id)
+        self._reset()
+        return event
+
+
+def iter_sse_events(lines):
+    """text/event-stream 줄 단위 입력을 받아 이벤트가 완성될 때마다 SseEvent 로 돌려준다.
+
+    lines 는 requests 의 iter_lines() 처럼 줄바꿈이 제거된 bytes 또는 str 이다.
+    전체 응답을 모으지 않고 빈 줄(이벤트 경계)을 만날 때마다 바로 내보낸다.
+    """
+    parser = _SseParser()
+    for line in lines:
+        event = parser.feed(line)
+        if event:
+            yield event
+    # 마지막 빈 줄 없이 스트림이 끝난 경우
+    event = parser.flush()
+    if event:
+        yield event
+
+
+async def aiter_sse_events(lines):
+    """iter_sse_events 의 async 버전. lines 는 httpx 의 aiter_lines() 같은 async iterator."""
+    parser = _SseParser()
+    async for line in lines:
+        event = parser.feed(line)
+        if event:
+            yield event
+    event = parser.flush()
+    if event:
+        yield event
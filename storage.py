@@ -0,0 +1,356 @@
+import argparse
+import contextvars
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from file_index import file_index
+from metrics import stage
+
+# 이 이름으로 끝나는 파일은 쓰기 도중의 임시 파일이라 목록/마이그레이션에서 제외한다
+TMP_SUFFIX = '.tmp'
+
+
+def _normalize(rel_path):
+    return os.path.normpath(rel_path).lstrip(os.sep)
+
+
+def _sha256(content):
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class _Batch:
+    """transaction() 안에서 쓴 파일들. 여러 worker 스레드가 같은 batch 에 쓸 수 있다."""
+
+    def __init__(self):
+        self.files = {}
+        self.closed = False
+        self.lock = threading.Lock()
+
+
+# 지금 context 에서 열려 있는 transaction. {(storage, account_guid, project_guid): _Batch}
+# contextvar 라서 transaction 을 연 스레드/coroutine 과, 그 context 를 물려받은 worker(worker_pool, asyncio task)만
+# batch 에 쓴다. 같은 프로젝트라도 다른 요청의 쓰기는 batch 와 상관없이 바로 저장된다.
+_open_batches = contextvars.ContextVar('storage_batches', default={})
+
+
+class ProjectStorage:
+    """프로젝트 파일 저장소의 공통 부분.
+
+    transaction(account_guid, project_guid) 안에서의 write 는 모아두었다가 블록이 정상적으로 끝날 때
+    _write_many 로 한 번에 쓰고, 예외가 나면 버린다. 진행 중에도 read 는 모아둔 내용을 먼저 본다.
+    batch 는 transaction 을 연 context 에만 보이므로, 그동안 다른 요청이 같은 프로젝트에 쓰거나 읽으면 디스크를 바로 본다.
+    쓰기가 끝나면 add_listener 로 등록한 함수들이 (account_guid, project_guid, rel_path, content) 로 불린다.
+    modified_at 은 프로젝트 파일이 바뀌었는지 싸게 확인하는 값으로, 파일이 바뀌면 달라진다.
+    """
+
+    name = None
+    # transaction 의 쓰기가 여러 파일에 걸쳐 원자적인지. 아니면 transaction 은 쓰기를 끝까지 미루기만 한다
+    atomic = False
+
+    def __init__(self):
+        self._listeners = []
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def _notify(self, account_guid, project_guid, files):
+        for rel_path, content in files.items():
+            for listener in self._listeners:
+                listener(account_guid, project_guid, rel_path, content)
+
+    def _batch(self, account_guid, project_guid):
+        batch = _open_batches.get().get((self, account_guid, project_guid))
+        # 끝난 transaction 의 context 를 물려받은 worker 가 늦게 쓰면 바로 저장한다
+        return batch if batch is not None and not batch.closed else None
+
+    @contextmanager
+    def transaction(self, account_guid, project_guid):
+        if self._batch(account_guid, project_guid) is not None:
+            # 이미 같은 프로젝트의 transaction 안이면 바깥 transaction 에 합친다
+            yield self._batch(account_guid, project_guid)
+            return
+        key = (self, account_guid, project_guid)
+        batch = _Batch()
+        token = _open_batches.set({**_open_batches.get(), key: batch})
+        try:
+            yield batch
+        except BaseException:
+            self._end_batch(account_guid, project_guid, batch, commit=False)
+            raise
+        finally:
+            _open_batches.reset(token)
+        self._end_batch(account_guid, project_guid, batch, commit=True)
+
+    @contextmanager
+    def job_transaction(self, account_guid, project_guid):
+        """생성 작업처럼 오래 걸리는 쓰기용 transaction. atomic 한 backend 에서만 모아서 쓰고, 아니면 파일마다 바로 쓴다.
+
+        원자적이지 않은 backend 에서 모아두면 작업이 끝날 때까지 결과가 보이지 않고, 중간에 실패하면 다 만든 파일까지 버려진다.
+        """
+        if not self.atomic:
+            yield None
+            return
+        with self.transaction(account_guid, project_guid) as batch:
+            yield batch
+
+    def _end_batch(self, account_guid, project_guid, batch, commit):
+        with batch.lock:
+            batch.closed = True
+            files = dict(batch.files)
+        if commit and files:
+            with stage('disk_write'):
+                self._write_many(account_guid, project_guid, files)
+            self._notify(account_guid, project_guid, files)
+
+    def write(self, account_guid, project_guid, rel_path, content):
+        rel_path = _normalize(rel_path)
+        batch = self._batch(account_guid, project_guid)
+        if batch is not None:
+            with batch.lock:
+                if not batch.closed:
+                    batch.files[rel_path] = content
+                    return
+        with stage('disk_write'):
+            self._write_many(account_guid, project_guid, {rel_path: content})
+        self._notify(account_guid, project_guid, {rel_path: content})
+
+    def read(self, account_guid, project_guid, rel_path):
+        """파일 내용. 없으면 None."""
+        rel_path = _normalize(rel_path)
+        batch = self._batch(account_guid, project_guid)
+        if batch is not None:
+            with batch.lock:
+                if rel_path in batch.files:
+                    return batch.files[rel_path]
+        return self._read(account_guid, project_guid, rel_path)
+
+    def exists(self, account_guid, project_guid, rel_path):
+        return self.read(account_guid, project_guid, rel_path) is not None
+
+
+class FileSystemStorage(ProjectStorage):
+    """지금까지의 code/{account_guid}/{project_guid}/... 디렉터리 구조.
+
+    파일마다 임시 파일에 쓴 뒤 os.replace 로 바꿔서 쓰는 도중에 읽어도 잘린 파일이 보이지 않는다.
+    transaction 은 쓰기를 끝까지 미뤘다가 한꺼번에 할 뿐 여러 파일에 걸쳐 원자적이지는 않다.
+    파일을 차례로 바꾸는 도중에 프로세스가 죽으면 일부 파일만 바뀐 채로 남는다.
+    읽기는 file_index 를 거친다.
+    """
+
+    name = 'fs'
+
+    def __init__(self, base_dir='code'):
+        super().__init__()
+        self.base_dir = base_dir
+
+    def project_dir(self, account_guid, project_guid):
+        return os.path.join(self.base_dir, account_guid, project_guid)
+
+    def _read(self, account_guid, project_guid, rel_path):
+        return file_index.read(account_guid, project_guid, rel_path)
+
+    def _write_many(self, account_guid, project_guid, files):
+        root = self.project_dir(account_guid, project_guid)
+        for rel_path, content in files.items():
+            path = os.path.join(root, rel_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{threading.get_ident()}{TMP_SUFFIX}'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+            file_index.notify_write(account_guid, project_guid, rel_path, content)
+
+    def list_files(self, account_guid, project_guid):
+        return [path for path in file_index.list_files(account_guid, project_guid)
+                if not path.endswith(TMP_SUFFIX)]
+
+    def describe(self, account_guid, project_guid, rel_path):
+        return file_index.get(account_guid, project_guid).describe(rel_path)
+
+    def modified_at(self, account_guid, project_guid):
+        return file_index.get(account_guid, project_guid).modified_at()
+
+    def export(self, account_guid, project_guid):
+        """실행할 수 있도록 디스크에 있는 프로젝트 디렉터리 경로를 돌려준다."""
+        return self.project_dir(account_guid, project_guid)
+
+    def projects(self):
+        if not os.path.isdir(self.base_dir):
+            return
+        for account_guid in sorted(os.listdir(self.base_dir)):
+            account_dir = os.path.join(self.base_dir, account_guid)
+            if not os.path.isdir(account_dir):
+                continue
+            for project_guid in sorted(os.listdir(account_dir)):
+                if os.path.isdir(os.path.join(account_dir, project_guid)):
+                    yield account_guid, project_guid
+
+
+class SqliteStorage(ProjectStorage):
+    """WAL 모드 SQLite 하나에 모든 프로젝트 파일을 저장한다.
+
+    (account_guid, project_guid, path) 가 기본 키라서 프로젝트별 조회는 인덱스만 탄다.
+    transaction 의 쓰기는 한 번의 SQLite 트랜잭션으로 들어가므로 생성 도중 죽어도 반쯤 쓴 상태가 남지 않는다.
+    """
+
+    name = 'sqlite'
+    atomic = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS project_files (
+            account_guid TEXT NOT NULL,
+            project_guid TEXT NOT NULL,
+            path TEXT NOT NULL,
+            content TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (account_guid, project_guid, path)
+        ) WITHOUT ROWID
+    """
+
+    def __init__(self, db_path, export_dir='code'):
+        super().__init__()
+        self.db_path = db_path
+        self.export_dir = export_dir
+        self._local = threading.local()
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(self.SCHEMA)
+
+    def _connection(self):
+        # sqlite3 연결은 스레드마다 하나씩 만든다
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._local.conn = conn
+        return conn
+
+    def _read(self, account_guid, project_guid, rel_path):
+        row = self._connection().execute(
+            'SELECT content FROM project_files WHERE account_guid = ? AND project_guid = ? AND path = ?',
+            (account_guid, project_guid, rel_path)).fetchone()
+        return row[0] if row else None
+
+    def _write_many(self, account_guid, project_guid, files):
+        now = time.time()
+        rows = [(account_guid, project_guid, rel_path, content, len(content.encode('utf-8')), _sha256(content), now)
+                for rel_path, content in files.items()]
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                """INSERT INTO project_files (account_guid, project_guid, path, content, size, sha256, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (account_guid, project_guid, path) DO UPDATE SET
+                       content = excluded.content, size = excluded.size,
+                       sha256 = excluded.sha256, updated_at = excluded.updated_at""",
+                rows)
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def list_files(self, account_guid, project_guid):
+        rows = self._connection().execute(
+            'SELECT path FROM project_files WHERE account_guid = ? AND project_guid = ? ORDER BY path',
+            (account_guid, project_guid)).fetchall()
+        return [row[0] for row in rows]
+
+    def describe(self, account_guid, project_guid, rel_path):
+        rel_path = _normalize(rel_path)
+        row = self._connection().execute(
+            'SELECT size, sha256 FROM project_files WHERE account_guid = ? AND project_guid = ? AND path = ?',
+            (account_guid, project_guid, rel_path)).fetchone()
+        if row is None:
+            return None
+        return {'path': rel_path, 'size': row[0], 'sha256': row[1]}
+
+    def modified_at(self, account_guid, project_guid):
+        row = self._connection().execute(
+            'SELECT MAX(updated_at), COUNT(*) FROM project_files WHERE account_guid = ? AND project_guid = ?',
+            (account_guid, project_guid)).fetchone()
+        return row[0] or 0.0, row[1]
+
+    def export(self, account_guid, project_guid):
+        """프로젝트를 실행할 수 있도록 export_dir 아래에 파일로 풀어놓고 그 경로를 돌려준다. 바뀐 파일만 쓴다."""
+        root = os.path.join(self.export_dir, account_guid, project_guid)
+        rows = self._connection().execute(
+            'SELECT path, content, sha256 FROM project_files WHERE account_guid = ? AND project_guid = ?',
+            (account_guid, project_guid)).fetchall()
+        for rel_path, content, sha256 in rows:
+            path = os.path.join(root, rel_path)
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    if _sha256(f.read()) == sha256:
+                        continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(content)
+        return root
+
+    def projects(self):
+        rows = self._connection().execute(
+            'SELECT DISTINCT account_guid, project_guid FROM project_files ORDER BY account_guid, project_guid')
+        yield from rows
+
+
+def create_storage(backend, base_dir='code', db_path='project_state.db'):
+    if backend == FileSystemStorage.name:
+        return FileSystemStorage(base_dir)
+    if backend == SqliteStorage.name:
+        return SqliteStorage(db_path, export_dir=base_dir)
+    raise ValueError(f'알 수 없는 저장소 종류입니다: {backend}')
+
+
+def migrate(source, destination):
+    """source 의 모든 프로젝트를 destination 으로 복사한다. 프로젝트마다 한 트랜잭션. 반환값은 (프로젝트 수, 파일 수)."""
+    projects = 0
+    files = 0
+    for account_guid, project_guid in source.projects():
+        with destination.transaction(account_guid, project_guid):
+            for rel_path in source.list_files(account_guid, project_guid):
+                try:
+                    content = source.read(account_guid, project_guid, rel_path)
+                except UnicodeDecodeError:
+                    print(f"Skipping binary file {account_guid}/{project_guid}/{rel_path}")
+                    continue
+                if content is not None:
+                    destination.write(account_guid, project_guid, rel_path, content)
+                    files += 1
+        projects += 1
+    return projects, files
+
+
+storage = create_storage(
+    os.environ.get('STORAGE_BACKEND') or 'fs',
+    base_dir=os.environ.get('STORAGE_BASE_DIR') or 'code',
+    db_path=os.environ.get('STORAGE_SQLITE_PATH') or 'project_state.db',
+)
+
+
+if __name__ == '__main__':
+    # python storage.py --source fs --destination sqlite --db project_state.db
+    parser = argparse.ArgumentParser(description='프로젝트 저장소를 다른 backend 로 옮깁니다.')
+    parser.add_argument('--source', default='fs', choices=['fs', 'sqlite'])
+    parser.add_argument('--destination', default='sqlite', choices=['fs', 'sqlite'])
+    parser.add_argument('--base-dir', default='code')
+    parser.add_argument('--db', default='project_state.db')
+    args = parser.parse_args()
+    if args.source == args.destination:
+        parser.error('source 와 destination 이 같습니다.')
+
+    started = time.time()
+    migrated_projects, migrated_files = migrate(
+        create_storage(args.source, args.base_dir, args.db),
+        create_storage(args.destination, args.base_dir, args.db),
+    )
+    print(f"Migrated {migrated_projects} projects, {migrated_files} files in {time.time() - started:.1f}s")
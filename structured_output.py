@@ -0,0 +1,395 @@
+import json
+import re
+import threading
+from ai_models import gpt_request_with_retry
+from llm_cache import llm_cache
+from metrics import stage
+
+# LLM 이 돌려준 JSON 을 읽는 곳은 모두 여기를 쓴다.
+# 1) 응답에서 JSON 부분만 꺼내서 그대로 파싱하고
+# 2) 안 되면 주석(// 다른 함수들...), ..., 끝의 쉼표, 따옴표 없는 키, 잘린 응답 등을 로컬에서 고쳐본 뒤
+# 3) 그래도 안 되거나 스키마에 맞지 않을 때만 "이 JSON 을 고쳐줘" 요청을 한 번 더 보낸다.
+
+# 함수 호출표 {"1": {"title", "functions": [{"name", "parameters": [{"name", "type"}], "description"}]}}
+CALL_CHART_SCHEMA = {
+    'name': 'call_chart',
+    'type': 'object',
+    'minProperties': 1,
+    'additionalProperties': {
+        'type': 'object',
+        'required': ['title', 'functions'],
+        'properties': {
+            'title': {'type': 'string'},
+            'functions': {
+                'type': 'array',
+                'items': {
+                    'type': 'object',
+                    'required': ['name'],
+                    'properties': {
+                        'name': {'type': 'string'},
+                        'parameters': {
+                            'type': 'array',
+                            'items': {'type': 'object', 'required': ['name']},
+                        },
+                        'description': {'type': 'string'},
+                    },
+                },
+            },
+        },
+    },
+}
+
+# 설계 {"plan", "Files": [{"path", "fname", "objectName", "functionList"}]}
+CODE_STRUCTURE_SCHEMA = {
+    'name': 'code_structure',
+    'type': 'object',
+    'required': ['Files'],
+    'properties': {
+        'Files': {
+            'type': 'array',
+            'minItems': 1,
+            'items': {
+                'type': 'object',
+                'required': ['path', 'fname'],
+                'properties': {
+                    'path': {'type': 'string'},
+                    'fname': {'type': 'string'},
+                    'objectName': {'type': 'string'},
+                    'functionList': {'type': 'array'},
+                },
+            },
+        },
+    },
+}
+
+# 파일 수정 {"파일이름": "전체 내용" | {"content"} | {"patches": [...]} | {"diff"}}
+# 잘린 응답을 닫아서 읽으면 파일 끝이 잘린 코드로 사용자 파일을 덮어쓰게 되므로 받아들이지 않는다 (rejectTruncated)
+FILE_EDITS_SCHEMA = {
+    'name': 'file_edits',
+    'rejectTruncated': True,
+    'type': 'object',
+    'additionalProperties': {
+        'anyOf': [
+            {'type': 'string'},
+            {'type': 'object', 'required': ['content'], 'properties': {'content': {'type': 'string'}}},
+            {'type': 'object', 'required': ['patches'], 'properties': {'patches': {'type': 'array'}}},
+            {'type': 'object', 'required': ['diff'], 'properties': {'diff': {'type': 'string'}}},
+        ],
+    },
+}
+
+FIX_PROMPT = """
+아래 JSON 은 파싱하지 못했거나 형식이 맞지 않아. 내용은 바꾸지 말고 올바른 JSON 으로만 고쳐서 다시 줘.
+답변은 json으로만 해줘. 파싱하기 위함이라 다른걸로 하면 안돼.
+
+오류:
+{errors}
+
+형식(JSON Schema):
+{schema}
+
+JSON:
+{text}
+"""
+
+_TYPES = {
+    'object': dict,
+    'array': list,
+    'string': str,
+    'integer': int,
+    'number': (int, float),
+    'boolean': bool,
+}
+_ESCAPES = set('"\\/bfnrtu')
+_NUMBER_RE = re.compile(r'-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?')
+_WORD_RE = re.compile(r'[A-Za-z_$][\w$.-]*')
+_LITERALS = {'true': 'true', 'false': 'false', 'null': 'null', 'none': 'null'}
+
+
+class StructuredOutputError(Exception):
+    def __init__(self, message, details=None):
+        super().__init__(message)
+        self.details = details or []
+
+
+class TruncatedOutputError(StructuredOutputError):
+    """응답이 중간에 잘려서(max_tokens 등) 내용이 빠진 경우. 고쳐달라는 요청으로는 빠진 내용을 되살릴 수 없다."""
+
+
+class _Stats:
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, schema_name, outcome):
+        with self._lock:
+            counts = self._counts.setdefault(schema_name, {'parsed': 0, 'repaired': 0, 'retried': 0, 'failed': 0})
+            counts[outcome] += 1
+
+    def snapshot(self):
+        """스키마별 {parsed, repaired, retried, failed, total, repair_rate, retry_rate}."""
+        with self._lock:
+            result = {}
+            for name, counts in self._counts.items():
+                total = counts['parsed'] + counts['repaired'] + counts['retried'] + counts['failed']
+                result[name] = dict(counts, total=total,
+                                    repair_rate=counts['repaired'] / total if total else 0.0,
+                                    retry_rate=counts['retried'] / total if total else 0.0)
+            return result
+
+
+stats = _Stats()
+
+
+def extract_json_text(response, opening='{'):
+    """응답에서 JSON 이 시작하는 부분부터의 텍스트. ```json 블록이 있으면 그 안에서 찾는다."""
+    text = (response or '').strip()
+    fence = re.search(r'```[A-Za-z]*[ \t]*\n', text)
+    start = fence.end() if fence and fence.start() < text.find(opening) else 0
+    index = text.find(opening, start)
+    if index < 0:
+        return ''
+    return text[index:]
+
+
+def _read_string(text, i):
+    """i 의 따옴표(" 또는 ')로 시작하는 문자열을 JSON 문자열 토큰으로 바꾼다. 반환값은 (토큰, 다음 위치)."""
+    quote = text[i]
+    chars = []
+    j = i + 1
+    while j < len(text):
+        c = text[j]
+        if c == '\\':
+            if j + 1 >= len(text):
+                j += 1
+                break
+            following = text[j + 1]
+            if quote == "'" and following == "'":
+                chars.append("'")
+            elif following == 'u' and not re.match(r'[0-9a-fA-F]{4}', text[j + 2:j + 6]):
+                chars.append('\\\\u')
+            elif following in _ESCAPES:
+                chars.append(c + following)
+            else:
+                # 정규식의 \d 처럼 JSON 에 없는 escape 는 역슬래시를 살린다
+                chars.append('\\\\' + following)
+            j += 2
+            continue
+        if c == quote:
+            return '"' + ''.join(chars) + '"', j + 1
+        chars.append('\\"' if c == '"' else c)
+        j += 1
+    # 응답이 문자열 중간에서 잘렸다. 호출한 쪽은 다음 위치가 len(text) 를 넘는 것으로 안다
+    return '"' + ''.join(chars) + '"', len(text) + 1
+
+
+def repair_json(text):
+    """흔히 어긋나는 LLM JSON 을 고친 문자열. 모든 경우를 고치지는 못하므로 결과도 json.loads 로 확인해야 한다.
+
+    - // 와 /* */ 와 # 주석, 값 자리의 ... 생략 표시를 지운다
+    - 끝의 쉼표를 지우고, 빠진 쉼표를 넣는다
+    - 따옴표 없는 키와 작은따옴표 문자열, True/False/None 을 JSON 으로 바꾼다
+    - 잘린 응답은 열린 문자열과 괄호를 닫는다 (값 없이 끝난 키는 버린다)
+    """
+    return _repair(text)[0]
+
+
+def _repair(text):
+    """repair_json 과 같고, 잘린 응답을 닫았는지도 함께 돌려준다. 반환값은 (고친 문자열, 잘렸는지)."""
+    tokens = []
+    truncated = False
+    # 열린 괄호마다 [종류, 다음에 올 것] - 객체는 key/colon/value/after, 배열은 value/after
+    stack = []
+    i = 0
+
+    def before_value():
+        if not stack:
+            return
+        frame = stack[-1]
+        if frame[1] == 'after':
+            tokens.append(',')
+            frame[1] = 'key' if frame[0] == '{' else 'value'
+        if frame[0] == '{' and frame[1] == 'colon':
+            tokens.append(':')
+        frame[1] = 'after'
+
+    def close():
+        kind, state = stack.pop()
+        # 값 없이 끝난 키("key" 또는 "key":)와 끝의 쉼표를 버린다
+        if kind == '{' and state == 'value':
+            tokens.pop()
+        if kind == '{' and state in ('colon', 'value'):
+            tokens.pop()
+        if tokens and tokens[-1] == ',':
+            tokens.pop()
+        tokens.append('}' if kind == '{' else ']')
+
+    while i < len(text):
+        c = text[i]
+        if c.isspace():
+            i += 1
+        elif c in '"\'':
+            token, i = _read_string(text, i)
+            if stack and stack[-1][0] == '{' and stack[-1][1] in ('key', 'after'):
+                if stack[-1][1] == 'after':
+                    tokens.append(',')
+                tokens.append(token)
+                stack[-1][1] = 'colon'
+            else:
+                before_value()
+                tokens.append(token)
+        elif text.startswith('//', i) or c == '#':
+            end = text.find('\n', i)
+            i = len(text) if end < 0 else end
+        elif text.startswith('/*', i):
+            end = text.find('*/', i + 2)
+            i = len(text) if end < 0 else end + 2
+        elif text.startswith('...', i) or c == '…':
+            i += 3 if c == '.' else 1
+        elif c in '{[':
+            before_value()
+            tokens.append(c)
+            stack.append([c, 'key' if c == '{' else 'value'])
+            i += 1
+        elif c in '}]':
+            i += 1
+            if stack:
+                close()
+            if not stack:
+                break
+        elif c == ',':
+            if stack and stack[-1][1] == 'after':
+                tokens.append(',')
+                stack[-1][1] = 'key' if stack[-1][0] == '{' else 'value'
+            i += 1
+        elif c == ':':
+            if stack and stack[-1][0] == '{' and stack[-1][1] == 'colon':
+                tokens.append(':')
+                stack[-1][1] = 'value'
+            i += 1
+        else:
+            match = _NUMBER_RE.match(text, i) or _WORD_RE.match(text, i)
+            if not match:
+                i += 1
+                continue
+            word = match.group(0)
+            i = match.end()
+            if stack and stack[-1][0] == '{' and stack[-1][1] in ('key', 'after'):
+                # 따옴표 없는 키
+                if stack[-1][1] == 'after':
+                    tokens.append(',')
+                tokens.append(json.dumps(word))
+                stack[-1][1] = 'colon'
+                continue
+            before_value()
+            if _NUMBER_RE.fullmatch(word):
+                tokens.append(word)
+            else:
+                tokens.append(_LITERALS.get(word.lower(), json.dumps(word, ensure_ascii=False)))
+    if i > len(text) or stack:
+        truncated = True
+    while stack:
+        close()
+    return ''.join(tokens), truncated
+
+
+def validate(value, schema, path='$'):
+    """schema(JSON Schema 의 일부: type/required/properties/additionalProperties/items/anyOf/minItems/minProperties)
+    에 맞지 않는 곳의 목록. 비어 있으면 맞는 것이다."""
+    if 'anyOf' in schema:
+        options = [validate(value, option, path) for option in schema['anyOf']]
+        if all(options):
+            return [f"{path}: 허용된 형식 중 어느 것과도 맞지 않습니다 ({options[0][0]})"]
+        return []
+    expected = schema.get('type')
+    if expected:
+        types = _TYPES[expected]
+        if not isinstance(value, types) or (expected in ('integer', 'number') and isinstance(value, bool)):
+            return [f"{path}: {expected} 이어야 합니다"]
+    errors = []
+    if isinstance(value, dict):
+        for key in schema.get('required', []):
+            if key not in value:
+                errors.append(f"{path}: '{key}' 가 없습니다")
+        if len(value) < schema.get('minProperties', 0):
+            errors.append(f"{path}: 항목이 비어 있습니다")
+        properties = schema.get('properties', {})
+        additional = schema.get('additionalProperties')
+        for key, item in value.items():
+            if key in properties:
+                errors += validate(item, properties[key], f'{path}.{key}')
+            elif isinstance(additional, dict):
+                errors += validate(item, additional, f'{path}.{key}')
+    elif isinstance(value, list):
+        if len(value) < schema.get('minItems', 0):
+            errors.append(f"{path}: 항목이 비어 있습니다")
+        if 'items' in schema:
+            for index, item in enumerate(value):
+                errors += validate(item, schema['items'], f'{path}[{index}]')
+    return errors
+
+
+@stage('parse')
+def _parse(response, schema):
+    """(값, 고쳤는지) 를 돌려준다. 고쳐도 안 되면 StructuredOutputError."""
+    opening = '[' if schema.get('type') == 'array' else '{'
+    text = extract_json_text(response, opening)
+    if not text:
+        raise StructuredOutputError('빈 JSON 응답입니다.' if not (response or '').strip()
+                                    else '응답에서 JSON 을 찾지 못했습니다.')
+    decoder = json.JSONDecoder(strict=False)
+    repaired = False
+    try:
+        # 코드 내용에 들어 있는 줄바꿈/탭 같은 제어 문자는 그대로 허용하고, JSON 뒤의 설명 문장은 무시한다
+        value, _ = decoder.raw_decode(text)
+    except json.JSONDecodeError as e:
+        repaired_text, truncated = _repair(text)
+        if truncated and schema.get('rejectTruncated'):
+            raise TruncatedOutputError('응답이 중간에 잘렸습니다. 잘린 내용은 저장하지 않습니다.', [str(e)])
+        try:
+            value = decoder.decode(repaired_text)
+        except json.JSONDecodeError:
+            raise StructuredOutputError('응답을 JSON으로 파싱하는데 실패했습니다.', [str(e)])
+        repaired = True
+    errors = validate(value, schema)
+    if errors:
+        raise StructuredOutputError('응답이 요청한 JSON 형식과 맞지 않습니다.', errors[:20])
+    return value, repaired
+
+
+def parse_structured(response, schema, use_cache=True, fix=True):
+    """LLM 응답에서 schema 에 맞는 JSON 값을 꺼낸다.
+
+    로컬에서 고쳐도 안 되면 fix 일 때 고쳐달라는 요청을 한 번 보낸다. 실패하면 StructuredOutputError.
+    파싱하지 못한 응답은 LLM 캐시에서 지워서 다음 요청이 같은 응답을 다시 받지 않게 한다.
+    """
+    name = schema.get('name', 'json')
+    try:
+        value, repaired = _parse(response, schema)
+    except StructuredOutputError as e:
+        llm_cache.discard_value(response)
+        # 잘린 응답은 JSON 만 고쳐서는 빠진 내용이 돌아오지 않으므로 바로 실패로 돌려준다
+        if not fix or not (response or '').strip() or isinstance(e, TruncatedOutputError):
+            stats.add(name, 'failed')
+            raise
+        print(f"Structured output ({name}) invalid, asking for a fix: {e} {e.details[:3]}")
+        prompt = FIX_PROMPT.format(errors='\n'.join([str(e)] + e.details),
+                                   schema=json.dumps(schema, ensure_ascii=False), text=response)
+        fixed = None
+        try:
+            fixed = gpt_request_with_retry(prompt, use_cache=use_cache, json_mode=True)
+            value, _ = _parse(fixed, schema)
+        except Exception:
+            llm_cache.discard_value(fixed)
+            stats.add(name, 'failed')
+            raise
+        stats.add(name, 'retried')
+        return value
+    stats.add(name, 'repaired' if repaired else 'parsed')
+    return value
+
+
+def request_structured(prompt, schema, use_cache=True):
+    """JSON mode 로 요청하고 parse_structured 로 읽은 값을 돌려준다."""
+    response = gpt_request_with_retry(prompt, use_cache=use_cache, json_mode=True)
+    return parse_structured(response, schema, use_cache)
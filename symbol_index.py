@@ -0,0 +1,285 @@
+import ast
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from scheduler import FINGERPRINT_FILE
+from storage import storage
+
+PROJECT_META_FILES = {'function_call_chart.txt', 'code_structure.json', 'project_data.json', FINGERPRINT_FILE}
+
+_IDENTIFIER_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+_JS_FUNCTION_RES = [
+    re.compile(r'\bfunction\s+([A-Za-z_$][\w$]*)\s*\('),
+    re.compile(r'\b(?:const|let|var)\s+([A-Za-z_$][\w$]*)\s*=\s*(?:async\s+)?(?:function\b|\([^)]*\)\s*=>|[A-Za-z_$][\w$]*\s*=>)'),
+]
+_JS_ROUTE_RE = re.compile(r'''\bfetch\(\s*['"`]([^'"`]+)['"`]''')
+_PLANNED_NAME_RE = re.compile(r'([A-Za-z_][A-Za-z0-9_]*)\s*\(')
+
+
+def _symbol(name, kind, line, **extra):
+    symbol = {'name': name, 'kind': kind, 'line': line}
+    symbol.update(extra)
+    return symbol
+
+
+def _route_of(decorator):
+    # @app.route('/x') / @bp.get('/x') 형태의 라우트 경로
+    if isinstance(decorator, ast.Call) and isinstance(decorator.func, ast.Attribute):
+        if decorator.func.attr in ('route', 'get', 'post', 'put', 'delete', 'patch') and decorator.args:
+            first = decorator.args[0]
+            if isinstance(first, ast.Constant) and isinstance(first.value, str):
+                return first.value
+    return None
+
+
+def scan_python(content):
+    """파이썬 파일의 함수/클래스/메서드/라우트/모듈 변수와 import 한 모듈 이름을 돌려준다."""
+    tree = ast.parse(content)
+    symbols = []
+    imports = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            imports.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            imports.add(node.module)
+
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            symbols.append(_symbol(node.name, 'function', node.lineno))
+            for decorator in node.decorator_list:
+                route = _route_of(decorator)
+                if route:
+                    symbols.append(_symbol(route, 'route', node.lineno, handler=node.name))
+        elif isinstance(node, ast.ClassDef):
+            symbols.append(_symbol(node.name, 'class', node.lineno))
+            for item in node.body:
+                if isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    symbols.append(_symbol(f"{node.name}.{item.name}", 'method', item.lineno))
+        elif isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    symbols.append(_symbol(target.id, 'variable', node.lineno))
+        elif isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name):
+            symbols.append(_symbol(node.target.id, 'variable', node.lineno))
+    return symbols, imports
+
+
+def scan_script(content):
+    """html/js 파일에서 JS 함수 정의와 fetch 로 호출하는 라우트를 정규식으로 찾는다."""
+    symbols = []
+    for line_no, line in enumerate(content.splitlines(), 1):
+        for pattern in _JS_FUNCTION_RES:
+            for match in pattern.finditer(line):
+                symbols.append(_symbol(match.group(1), 'js_function', line_no))
+        for match in _JS_ROUTE_RE.finditer(line):
+            symbols.append(_symbol(match.group(1), 'route_call', line_no))
+    return symbols, set()
+
+
+def scan_file(rel_path, content):
+    ext = os.path.splitext(rel_path)[1]
+    try:
+        if ext == '.py':
+            symbols, imports = scan_python(content)
+        elif ext in ('.html', '.js'):
+            symbols, imports = scan_script(content)
+        else:
+            symbols, imports = [], set()
+    except SyntaxError as e:
+        print(f"Symbol scan failed for {rel_path}: {e}")
+        symbols, imports = [], set()
+    return {
+        'symbols': symbols,
+        'imports': imports,
+        'identifiers': set(_IDENTIFIER_RE.findall(content or '')),
+    }
+
+
+class ProjectSymbolIndex:
+    """프로젝트 하나의 심볼 → 파일/줄 번호 인덱스와 파일 간 import 그래프.
+
+    저장소에 쓸 때마다 update() 로 파일 하나씩 갱신하고, 그 밖의 변경은 refresh() 가
+    sha256 을 비교해서 바뀐 파일만 다시 파싱한다. storage.modified_at 이 지난 refresh 때와 같으면 훑지 않는다.
+    """
+
+    def __init__(self, account_guid, project_guid):
+        self.account_guid = account_guid
+        self.project_guid = project_guid
+        self._files = {}  # rel_path -> scan_file 결과 + 'sha256'
+        self._definitions = {}  # name -> [(rel_path, line, kind)]
+        self._refreshed_at = None  # 마지막 refresh 때의 storage.modified_at
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _normalize(rel_path):
+        return os.path.normpath(rel_path).lstrip(os.sep)
+
+    def _index_definitions(self, rel_path, entry, add=True):
+        for symbol in entry['symbols']:
+            names = {symbol['name'], symbol['name'].split('.')[-1]}
+            for name in names:
+                locations = self._definitions.setdefault(name, [])
+                location = (rel_path, symbol['line'], symbol['kind'])
+                if add:
+                    locations.append(location)
+                elif location in locations:
+                    locations.remove(location)
+                if not locations:
+                    del self._definitions[name]
+
+    def update(self, rel_path, content, sha256=None):
+        rel_path = self._normalize(rel_path)
+        entry = scan_file(rel_path, content)
+        entry['sha256'] = sha256
+        with self._lock:
+            self.remove(rel_path)
+            self._files[rel_path] = entry
+            self._index_definitions(rel_path, entry)
+
+    def remove(self, rel_path):
+        rel_path = self._normalize(rel_path)
+        with self._lock:
+            entry = self._files.pop(rel_path, None)
+            if entry:
+                self._index_definitions(rel_path, entry, add=False)
+
+    def refresh(self):
+        """저장소와 비교해서 추가/삭제/변경된 파일만 반영한다."""
+        account_guid, project_guid = self.account_guid, self.project_guid
+        modified_at = storage.modified_at(account_guid, project_guid)
+        if modified_at == self._refreshed_at:
+            return
+        current = set()
+        for rel_path in storage.list_files(account_guid, project_guid):
+            if os.path.basename(rel_path) in PROJECT_META_FILES:
+                continue
+            meta = storage.describe(account_guid, project_guid, rel_path)
+            if meta is None:
+                continue
+            current.add(rel_path)
+            with self._lock:
+                entry = self._files.get(rel_path)
+                if entry and entry['sha256'] == meta['sha256']:
+                    continue
+            content = storage.read(account_guid, project_guid, rel_path)
+            if content is not None:
+                self.update(rel_path, content, meta['sha256'])
+        with self._lock:
+            for rel_path in set(self._files) - current:
+                self.remove(rel_path)
+            self._refreshed_at = modified_at
+
+    def find(self, name):
+        """name 을 정의한 위치 목록 [{'path', 'line', 'kind'}]."""
+        with self._lock:
+            return [{'path': path, 'line': line, 'kind': kind}
+                    for path, line, kind in self._definitions.get(name, [])]
+
+    def files_touching(self, name):
+        """name 을 정의하거나 참조하는 파일들."""
+        with self._lock:
+            defining = {path for path, _, _ in self._definitions.get(name, [])}
+            referencing = {path for path, entry in self._files.items() if name in entry['identifiers']}
+            return sorted(defining | referencing)
+
+    def _module_paths(self):
+        modules = {}
+        for rel_path in self._files:
+            if rel_path.endswith('.py'):
+                modules.setdefault(os.path.splitext(os.path.basename(rel_path))[0], rel_path)
+        return modules
+
+    def import_graph(self):
+        """{파일: [프로젝트 안에서 import 하는 파일]}. 외부 패키지 import 는 제외한다."""
+        with self._lock:
+            modules = self._module_paths()
+            graph = {}
+            for rel_path, entry in self._files.items():
+                targets = set()
+                for module in entry['imports']:
+                    target = modules.get(module.split('.')[-1]) or modules.get(module.split('.')[0])
+                    if target and target != rel_path:
+                        targets.add(target)
+                graph[rel_path] = sorted(targets)
+            return graph
+
+    def symbols(self, rel_path):
+        with self._lock:
+            entry = self._files.get(self._normalize(rel_path))
+            return list(entry['symbols']) if entry else []
+
+    def mismatch_report(self, code_structure):
+        """code_structure.json 의 계획과 실제 코드의 차이.
+
+        - missing_files: 계획에는 있지만 디스크에 없는 파일
+        - unplanned_files: 디스크에는 있지만 계획에 없는 파일
+        - missing_functions: functionList 에 있지만 파일에 정의되지 않은 함수
+        - unplanned_functions: 파일에 정의되어 있지만 functionList 에 없는 최상위 함수
+        """
+        report = {'missing_files': [], 'unplanned_files': [], 'missing_functions': {}, 'unplanned_functions': {}}
+        with self._lock:
+            planned_paths = set()
+            for file_info in code_structure.get('Files', []):
+                rel_path = self._normalize(f"{file_info.get('path', '')}/{file_info.get('fname', '')}")
+                planned_paths.add(rel_path)
+                entry = self._files.get(rel_path)
+                if entry is None:
+                    report['missing_files'].append(rel_path)
+                    continue
+                if not rel_path.endswith('.py'):
+                    continue
+                planned = set()
+                for item in file_info.get('functionList', []):
+                    match = _PLANNED_NAME_RE.search(str(item))
+                    if match:
+                        planned.add(match.group(1))
+                defined = {s['name'].split('.')[-1] for s in entry['symbols']
+                           if s['kind'] in ('function', 'method', 'class')}
+                top_level = {s['name'] for s in entry['symbols'] if s['kind'] == 'function'}
+                missing = sorted(planned - defined)
+                unplanned = sorted(top_level - planned)
+                if missing:
+                    report['missing_functions'][rel_path] = missing
+                if unplanned and planned:
+                    report['unplanned_functions'][rel_path] = unplanned
+            report['unplanned_files'] = sorted(set(self._files) - planned_paths)
+        return report
+
+
+class SymbolIndexRegistry:
+    """프로젝트별 ProjectSymbolIndex 를 관리한다. max_projects 를 넘으면 가장 오래 쓰이지 않은 프로젝트부터 버린다."""
+
+    def __init__(self, max_projects=256):
+        self.max_projects = max_projects
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, account_guid, project_guid, refresh=True):
+        key = (account_guid, project_guid)
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is None:
+                index = self._indexes[key] = ProjectSymbolIndex(account_guid, project_guid)
+            self._indexes.move_to_end(key)
+            while len(self._indexes) > self.max_projects:
+                self._indexes.popitem(last=False)
+        if refresh:
+            index.refresh()
+        return index
+
+    def notify_write(self, account_guid, project_guid, rel_path, content):
+        # 아직 인덱스를 만들지 않았거나 버린 프로젝트는 처음 조회할 때 한 번에 훑는다
+        with self._lock:
+            index = self._indexes.get((account_guid, project_guid))
+        if index is not None and os.path.basename(rel_path) not in PROJECT_META_FILES:
+            index.update(rel_path, content, hashlib.sha256(content.encode('utf-8')).hexdigest())
+
+    def stats(self):
+        with self._lock:
+            return {'projects': len(self._indexes), 'max_projects': self.max_projects}
+
+
+symbol_index = SymbolIndexRegistry(max_projects=int(os.environ.get('SYMBOL_INDEX_MAX_PROJECTS') or 256))
+storage.add_listener(symbol_index.notify_write)
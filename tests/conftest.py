@@ -0,0 +1,20 @@
+import os
+import sys
+import tempfile
+
+# 모듈들이 import 할 때 환경 변수로 경로와 키를 읽으므로 먼저 테스트용 값을 넣는다
+_root = tempfile.mkdtemp(prefix='auto-code-tool-tests-')
+for name, value in {
+    'OpenaiAPI': 'test-key',
+    'Anthropic3API': 'test-key',
+    'STORAGE_BASE_DIR': os.path.join(_root, 'code'),
+    'STORAGE_SQLITE_PATH': os.path.join(_root, 'project_state.db'),
+    'JOB_STORE_DIR': os.path.join(_root, 'jobs'),
+    'LLM_CACHE_DIR': os.path.join(_root, 'llm_cache'),
+    'ENV_CACHE_DIR': os.path.join(_root, 'envs'),
+    'RUNNER_LOG_DIR': os.path.join(_root, 'applogs'),
+    'TRACE_DIR': os.path.join(_root, 'traces'),
+}.items():
+    os.environ.setdefault(name, value)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,69 @@
+import io
+from app_logs import LogBuffer, SpillFile, start_pump
+
+
+def test_read_from_offset():
+    logs = LogBuffer(max_lines=10)
+    for i in range(3):
+        logs.append(f'line {i}\n')
+    result = logs.read(1)
+    assert result['lines'] == ['line 1', 'line 2']
+    assert (result['offset'], result['next_offset'], result['dropped']) == (1, 3, 0)
+    assert logs.read(1, limit=1)['next_offset'] == 2
+
+
+def test_dropped_lines_are_reported():
+    logs = LogBuffer(max_lines=3)
+    for i in range(5):
+        logs.append(str(i))
+    result = logs.read(0)
+    assert result['lines'] == ['2', '3', '4']
+    assert (result['offset'], result['dropped'], result['next_offset']) == (2, 2, 5)
+    # 음수 offset 은 마지막 줄들
+    assert logs.read(-2)['lines'] == ['3', '4']
+    assert logs.read(-10)['offset'] == 2
+
+
+def test_wait_returns_when_closed():
+    logs = LogBuffer()
+    logs.close()
+    result = logs.wait(0, timeout=5)
+    assert result['closed'] and result['lines'] == []
+
+
+def test_long_lines_are_truncated():
+    logs = LogBuffer(max_line_chars=5)
+    logs.append('x' * 20)
+    assert logs.read(0)['lines'] == ['xxxxx...(생략)']
+
+
+def test_pump_reads_bounded_lines():
+    logs = LogBuffer(max_line_chars=5)
+    stream = io.StringIO('short\n' + 'y' * 100 + '\nafter\nlast')
+    start_pump(stream, logs, max_line_chars=5).join(5)
+    assert logs.read(0)['lines'] == ['short', 'yyyyy...(생략)', 'after', 'last']
+    assert logs.closed
+
+
+def test_spill_file_rotates(tmp_path):
+    path = str(tmp_path / 'app.log')
+    spill = SpillFile(path, max_bytes=10, backups=2)
+    for i in range(5):
+        spill.write(f'line-{i}')
+    spill.close()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['app.log', 'app.log.1', 'app.log.2']
+
+
+def test_project_logs_validates_offset_and_limit(monkeypatch):
+    import app as app_module
+    logs = LogBuffer(max_lines=10000)
+    for i in range(6000):
+        logs.append(f'line {i}')
+    monkeypatch.setitem(app_module.runner_pool._logs, ('acct', 'proj'), logs)
+    client = app_module.app.test_client()
+    ctx = {'account_guid': 'acct', 'project_guid': 'proj'}
+
+    for bad in ({'offset': 'abc'}, {'limit': 'ten'}, {'offset': None}):
+        assert client.post('/project_logs', json={**ctx, **bad}).status_code == 400
+    result = client.post('/project_logs', json={**ctx, 'offset': 0, 'limit': 10 ** 9}).get_json()
+    assert len(result['lines']) == app_module.PROJECT_LOG_MAX_BATCH
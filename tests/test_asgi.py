@@ -0,0 +1,58 @@
+import asyncio
+import re
+
+import pytest
+
+import asgi
+from test_concurrency import fake_llm, make_project
+from storage import storage
+
+
+async def afake_llm(prompt, *args, **kwargs):
+    return fake_llm(prompt)
+
+
+async def afake_stream(prompt, *args, **kwargs):
+    response = fake_llm(prompt)
+    for i in range(0, len(response), 7):
+        yield response[i:i + 7]
+
+
+@pytest.fixture(autouse=True)
+def fake_models(monkeypatch):
+    monkeypatch.setattr(asgi, 'agpt_request_with_retry', afake_llm)
+    monkeypatch.setattr(asgi, 'agpt_request_stream_with_retry', afake_stream)
+
+
+async def read_job_stream(job_id, query_string):
+    scope = {'path': f'/job_stream/{job_id}', 'headers': [], 'query_string': query_string}
+    sent = []
+
+    async def receive():
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi.job_stream(scope, receive, send, b'')
+    return b''.join(message.get('body', b'') for message in sent).decode('utf-8')
+
+
+@pytest.mark.parametrize('pipeline', [True, False])
+def test_generate_project_code_job_runs_on_event_loop(monkeypatch, pipeline):
+    monkeypatch.setitem(asgi.flask_app.config, 'PIPELINE_PLAN', pipeline)
+    ctx, marker = make_project()
+    job = asgi.job_store.create('generate_project_code', *ctx)
+
+    async def run():
+        await asgi.run_job(job['job_id'], asgi.arun_generate_project_code, ctx, False, False)
+        return await read_job_stream(job['job_id'], b'x=1&offset=2&offset=9')
+
+    body = asyncio.run(run())
+
+    finished = asgi.job_store.get(job['job_id'])
+    assert finished['status'] == 'done', finished['error']
+    assert marker in storage.read(*ctx, 'app/util.py')
+    # offset 은 처음 값(2)을 쓰므로 세 번째 출력부터 받는다
+    assert re.findall(r'^id: (\d+)$', body, re.M)[0] == '3'
+    assert 'event: done' in body
@@ -0,0 +1,131 @@
+import json
+import re
+import threading
+import time
+import uuid
+import pytest
+import app as app_module
+from project_context import ProjectContext, ProjectContextError
+from storage import storage
+
+PLAN_MARKER = '설계파일 리스트'
+
+
+def fake_llm(prompt, *args, **kwargs):
+    """설계 요청에는 프로젝트 설명(marker)을 plan 과 각 파일에 담은 설계를, 파일 구현 요청에는 그 marker 를 담은 코드를 돌려준다."""
+    if PLAN_MARKER in prompt:
+        marker = re.search(r'marker-[0-9a-f]+', prompt).group(0)
+        return json.dumps({'plan': marker, 'Files': [
+            {'path': 'app', 'fname': 'app.py', 'functionList': ['index()', marker]},
+            {'path': 'app', 'fname': 'util.py', 'functionList': ['helper()', marker]},
+            {'path': 'app', 'fname': 'requirements.txt', 'functionList': [marker]},
+        ]})
+    marker = re.search(r'marker-[0-9a-f]+', prompt).group(0)
+    # 다른 작업과 겹치도록 잠깐 쉰다
+    time.sleep(0.01)
+    return f'```python\n# {marker}\n```'
+
+
+def fake_stream(prompt, *args, **kwargs):
+    response = fake_llm(prompt)
+    for i in range(0, len(response), 7):
+        yield response[i:i + 7]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app_module, 'gpt_request_with_retry', fake_llm)
+    monkeypatch.setattr(app_module, 'gpt_request_stream_with_retry', fake_stream)
+    return app_module.app.test_client()
+
+
+def make_project():
+    ctx = ProjectContext(f'acct-{uuid.uuid4().hex[:8]}', f'proj-{uuid.uuid4().hex[:8]}')
+    marker = f'marker-{uuid.uuid4().hex}'
+    storage.write(*ctx, 'project_data.json', json.dumps(
+        {'project_description': marker, 'flowchart': 'flow', 'gpt_request': 'chart'}))
+    storage.write(*ctx, 'function_call_chart.txt', '1. index\n')
+    return ctx, marker
+
+
+def wait_job(client, job_id, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = client.get(f'/job_status/{job_id}').get_json()
+        if job['status'] in ('done', 'failed'):
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f'job {job_id} did not finish')
+
+
+@pytest.mark.parametrize('pipeline', [True, False])
+def test_concurrent_jobs_write_only_their_own_project(client, monkeypatch, pipeline):
+    monkeypatch.setitem(app_module.app.config, 'PIPELINE_PLAN', pipeline)
+    projects = [make_project() for _ in range(6)]
+    job_ids = [None] * len(projects)
+
+    def start(index):
+        ctx, _ = projects[index]
+        response = client.post('/generate_project_code', json={
+            'account_guid': ctx.account_guid, 'project_guid': ctx.project_guid, 'bypass_cache': True})
+        assert response.status_code == 202
+        job_ids[index] = response.get_json()['job_id']
+
+    threads = [threading.Thread(target=start, args=(i,)) for i in range(len(projects))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for (ctx, marker), job_id in zip(projects, job_ids):
+        job = wait_job(client, job_id)
+        assert job['status'] == 'done', job['error']
+        assert job['project_guid'] == ctx.project_guid
+        for fname in ('app.py', 'util.py', 'requirements.txt'):
+            assert storage.read(*ctx, f'app/{fname}') == f'# {marker}'
+        assert json.loads(storage.read(*ctx, 'code_structure.json'))['plan'] == marker
+
+
+def test_save_during_generation_is_not_deferred(client, monkeypatch):
+    # 생성 작업이 transaction 을 열어둔 동안 같은 프로젝트에 저장한 파일은 바로 보이고, 작업이 실패해도 남는다
+    ctx, marker = make_project()
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocking_llm(prompt, *args, **kwargs):
+        if PLAN_MARKER in prompt:
+            started.set()
+            release.wait(10)
+            raise RuntimeError('plan failed')
+        return fake_llm(prompt)
+    monkeypatch.setattr(app_module, 'gpt_request_with_retry', blocking_llm)
+    monkeypatch.setitem(app_module.app.config, 'PIPELINE_PLAN', False)
+
+    data = {'account_guid': ctx.account_guid, 'project_guid': ctx.project_guid}
+    job_id = client.post('/generate_project_code', json=data).get_json()['job_id']
+    assert started.wait(10)
+    response = client.post('/save_file_code', json=dict(data, path='app', fname='notes.txt', code='memo'))
+    assert response.status_code == 200
+    assert storage.read(*ctx, 'app/notes.txt') == 'memo'
+    release.set()
+    assert wait_job(client, job_id)['status'] == 'failed'
+    assert storage.read(*ctx, 'app/notes.txt') == 'memo'
+
+
+@pytest.mark.parametrize('data', [
+    None,
+    {},
+    {'account_guid': 'a'},
+    {'account_guid': 'a', 'project_guid': '../b'},
+    {'account_guid': '..', 'project_guid': 'b'},
+    {'account_guid': 'a', 'project_guid': 'x\\y'},
+    {'account_guid': 1, 'project_guid': 'b'},
+])
+def test_invalid_project_context(data):
+    with pytest.raises(ProjectContextError):
+        ProjectContext.from_request(data)
+
+
+def test_invalid_project_context_is_400(client):
+    response = client.post('/generate_project_code', json={'account_guid': 'a', 'project_guid': '..'})
+    assert response.status_code == 400
@@ -0,0 +1,47 @@
+import pytest
+from ai_types import AiType
+from context_builder import build_file_context, context_key, merge_files, ContextBudgetError
+
+FILES = [{'path': '', 'fname': 'app.py'}, {'path': 'app', 'fname': 'models.py'}, {'path': 'app', 'fname': 'views.py'}]
+CONTENTS = {
+    'app.py': 'def main():\n    run()\n' * 50,
+    'app/models.py': 'class User:\n    def save(self):\n        pass\n' * 200,
+    'app/views.py': 'def index():\n    return render()\n' * 200,
+    'app/extra.py': 'def extra():\n    pass\n',
+}
+
+
+def read_file(file_info):
+    return CONTENTS.get(context_key(file_info.get('path', ''), file_info['fname']))
+
+
+def test_everything_fits():
+    _, section, full = build_file_context(FILES, read_file, query='user', header='설명')
+    assert full == {'app.py', 'app/models.py', 'app/views.py'}
+    assert '요약' not in section
+
+
+def test_root_file_selected_with_dot_path_is_pinned(monkeypatch):
+    monkeypatch.setenv('LLM_CONTEXT_BUDGET_GPT', '1500')
+    _, section, full = build_file_context(FILES, read_file, query='index views', pinned=[{'path': '.', 'fname': 'app.py'}])
+    assert 'app.py' in full
+    assert section.startswith('파일: app.py 내용:')
+    assert full != {'app.py', 'app/models.py', 'app/views.py'}
+    assert '전체 내용을 다시 쓰지 마' in section
+
+
+def test_selected_file_missing_from_plan_is_included():
+    _, section, full = build_file_context(FILES, read_file, query='x', pinned=[{'path': 'app', 'fname': 'extra.py'}])
+    assert 'app/extra.py' in full
+    assert 'def extra()' in section
+
+
+def test_pinned_file_over_budget_fails(monkeypatch):
+    monkeypatch.setenv('LLM_CONTEXT_BUDGET_GPT', '300')
+    with pytest.raises(ContextBudgetError):
+        build_file_context(FILES, read_file, query='x', ai_type=AiType.GPT, pinned=[{'path': 'app', 'fname': 'models.py'}])
+
+
+def test_merge_files_normalises_keys():
+    merged = merge_files(FILES, [{'path': '.', 'fname': 'app.py'}, {'path': 'app', 'fname': 'extra.py'}])
+    assert merged == FILES + [{'path': 'app', 'fname': 'extra.py'}]
@@ -0,0 +1,73 @@
+import os
+import subprocess
+import pytest
+import env_cache as env_cache_module
+from env_cache import READY_FILE, EnvCache, normalize_requirements, requirements_key
+
+
+def fake_build(env_dir, requirements):
+    os.makedirs(env_dir, exist_ok=True)
+    with open(os.path.join(env_dir, 'payload'), 'w') as f:
+        f.write('x' * 1000)
+    with open(os.path.join(env_dir, READY_FILE), 'w') as f:
+        f.write('\n'.join(requirements))
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = EnvCache(root=str(tmp_path / 'envs'), wheelhouse=str(tmp_path / 'wheels'), max_envs=1)
+    monkeypatch.setattr(cache, '_build', fake_build)
+    return cache
+
+
+def test_normalize_requirements():
+    assert normalize_requirements('Flask_Login==1.0  # auth\n\nrequests\n-r base.txt\nflask-login == 1.0') == [
+        'flask-login==1.0', 'requests']
+    assert requirements_key(['a']) != requirements_key(['b'])
+
+
+def test_leased_env_is_not_evicted(cache):
+    first, first_lease = cache.ensure(['flask'])
+    # 두 번째 env 를 만들면 max_envs=1 을 넘지만 첫 env 는 lease 가 있어서 남는다
+    second, second_lease = cache.ensure(['flask', 'requests'])
+    assert os.path.exists(os.path.join(first, READY_FILE))
+    first_lease.close()
+    second_lease.close()
+    assert cache.evict() == [os.path.basename(first)]
+    assert not os.path.exists(first)
+    assert os.path.exists(second)
+
+
+def test_lease_inherited_by_app_process(cache):
+    env_dir, lease = cache.ensure(['flask'])
+    process = subprocess.Popen(['sleep', '30'], pass_fds=(lease.fileno(),))
+    lease.close()
+    try:
+        other, other_lease = cache.ensure(['requests'])
+        other_lease.close()
+        assert os.path.exists(env_dir)
+        assert cache.evict(in_use=[other]) == []
+    finally:
+        process.kill()
+        process.wait()
+    assert cache.evict(in_use=[other]) == [os.path.basename(env_dir)]
+
+
+def test_evicted_env_is_rebuilt(cache):
+    env_dir, lease = cache.ensure(['flask'])
+    lease.close()
+    cache.ensure(['requests'])[1].close()
+    assert not os.path.exists(env_dir)
+    env_dir, lease = cache.ensure(['flask'])
+    lease.close()
+    assert os.path.exists(os.path.join(env_dir, READY_FILE))
+
+
+def test_sizes_are_cached(cache, monkeypatch):
+    calls = []
+    original = env_cache_module._dir_size
+    monkeypatch.setattr(env_cache_module, '_dir_size', lambda path: calls.append(path) or original(path))
+    cache.ensure(['flask'])[1].close()
+    assert cache.stats()['size'] >= 1000
+    assert cache.stats()['envs'] == 1
+    assert len(calls) == 1
@@ -0,0 +1,70 @@
+import uuid
+import pytest
+import app as app_module
+from project_context import ProjectContext
+from storage import storage
+
+STRUCTURE = {'Files': [{'path': 'app', 'fname': 'app.py'}, {'path': 'app', 'fname': 'new.py'}]}
+
+
+@pytest.fixture
+def ctx():
+    ctx = ProjectContext('tests', uuid.uuid4().hex)
+    storage.write(*ctx, 'app/app.py', 'x = 1\nprint(x)\nx = 1\n')
+    return ctx
+
+
+def test_patch_for_missing_file_requests_full_content(ctx, monkeypatch):
+    requests = []
+
+    def fake_request(prompt, schema, use_cache=True):
+        requests.append(prompt)
+        return {'new.py': 'print("new")\n'}
+    monkeypatch.setattr(app_module, 'request_structured', fake_request)
+
+    report = app_module.save_file_changes(
+        ctx, {'new.py': {'patches': [{'search': 'a', 'replace': 'b'}]}}, STRUCTURE, 'prompt')
+    assert len(requests) == 1
+    assert report['new.py']['fallback'] == 'full_file'
+    assert storage.read(*ctx, 'app/new.py') == 'print("new")\n'
+
+
+def test_failed_fallback_is_partial(ctx, monkeypatch):
+    monkeypatch.setattr(app_module, 'request_structured', lambda prompt, schema, use_cache=True: {})
+    response_json = {'app.py': {'patches': [{'search': 'x = 1', 'replace': 'x = 2'}]},
+                     'new.py': {'patches': [{'search': 'a', 'replace': 'b'}]}}
+
+    report = app_module.save_file_changes(ctx, response_json, STRUCTURE, 'prompt')
+    # 여러 곳과 맞는 search 는 첫 번째에 적용하지 않고, 없는 파일은 빈 파일로 만들지 않는다
+    assert report['app.py']['rejected'][0]['reason'] == 'ambiguous'
+    assert storage.read(*ctx, 'app/app.py') == 'x = 1\nprint(x)\nx = 1\n'
+    assert storage.read(*ctx, 'app/new.py') is None
+
+    result = app_module.file_changes_result(response_json, report, patch_mode=True)
+    assert result['status'] == 'partial'
+    assert sorted(result['failed_files']) == ['app.py', 'new.py']
+
+
+def test_full_content_is_success(ctx):
+    report = app_module.save_file_changes(ctx, {'app.py': 'y = 2\n'}, STRUCTURE, 'prompt')
+    assert storage.read(*ctx, 'app/app.py') == 'y = 2\n'
+    assert app_module.file_changes_result({'app.py': 'y = 2\n'}, report, patch_mode=False) == {
+        'status': 'success', 'files': {'app.py': 'y = 2\n'}}
+
+
+def test_fallback_does_not_rewrite_summarized_file(ctx, monkeypatch):
+    requests = []
+
+    def fake_request(prompt, schema, use_cache=True):
+        requests.append(prompt)
+        return {'app.py': 'rewritten from summary\n', 'new.py': 'print("new")\n'}
+    monkeypatch.setattr(app_module, 'request_structured', fake_request)
+    response_json = {'app.py': {'patches': [{'search': 'missing', 'replace': 'y'}]},
+                     'new.py': {'patches': [{'search': 'a', 'replace': 'b'}]}}
+
+    # app.py 는 요약만 프롬프트에 넣었다
+    report = app_module.save_file_changes(ctx, response_json, STRUCTURE, 'prompt', full_files=set())
+    assert 'app.py' not in requests[0].split('patch 를 적용하지 못했어')[1]
+    assert storage.read(*ctx, 'app/app.py') == 'x = 1\nprint(x)\nx = 1\n'
+    assert report['app.py']['fallback'] == 'failed'
+    assert report['new.py']['fallback'] == 'full_file'
@@ -0,0 +1,176 @@
+import threading
+import time
+import pytest
+import requests
+import hedging
+import rate_limiter
+from ai_types import AiType
+from hedging import choose_providers, hedged_call, hedged_stream
+from rate_limiter import RateLimiterRegistry, RequestCancelled, call_with_retry, cancellable, limited
+
+
+def test_small_output_providers_are_not_fallbacks():
+    configured = [AiType.GPT, AiType.ANTHROPIC, AiType.CLOVARX]
+    max_tokens = {AiType.GPT: 4096, AiType.ANTHROPIC: 4096, AiType.CLOVARX: 762}
+    assert choose_providers(AiType.GPT, configured, max_tokens) == [AiType.GPT, AiType.ANTHROPIC]
+    # 직접 고른 provider 는 한도가 작아도 쓴다
+    assert choose_providers(AiType.CLOVARX, configured, max_tokens) == [AiType.CLOVARX, AiType.GPT, AiType.ANTHROPIC]
+
+
+def test_hedged_call_cancels_loser(monkeypatch):
+    monkeypatch.setattr(hedging, 'HEDGE_DEFAULT_DELAY', 0.01)
+    cancels = {}
+
+    def call(ai_type, cancel):
+        cancels[ai_type] = cancel
+        if ai_type == AiType.GPT:
+            cancel.wait(5)
+            return None
+        return 'fast'
+
+    assert hedged_call([AiType.GPT, AiType.ANTHROPIC], call) == 'fast'
+    assert cancels[AiType.GPT].wait(1)
+    assert not cancels[AiType.ANTHROPIC].is_set()
+
+
+def test_retry_stops_when_cancelled(monkeypatch):
+    monkeypatch.setattr(rate_limiter, 'backoff_delay', lambda attempt: 10)
+    cancel = threading.Event()
+    calls = []
+
+    def fail():
+        calls.append(1)
+        threading.Timer(0.05, cancel.set).start()
+        raise requests.ConnectionError('reset')
+
+    started = time.monotonic()
+    with cancellable(cancel), pytest.raises(RequestCancelled):
+        call_with_retry(fail, max_retries=5)
+    assert time.monotonic() - started < 5
+    assert len(calls) == 1
+
+
+def test_limiter_wait_stops_when_cancelled(monkeypatch):
+    monkeypatch.setattr(rate_limiter, 'rate_limiters', RateLimiterRegistry(
+        {AiType.GPT: {'rpm': 1, 'tpm': None}}))
+    with limited(AiType.GPT, 0, 0):
+        pass
+    cancel = threading.Event()
+    threading.Timer(0.05, cancel.set).start()
+    started = time.monotonic()
+    with cancellable(cancel), pytest.raises(RequestCancelled):
+        with limited(AiType.GPT, 0, 0):
+            pytest.fail('cancelled request must not be sent')
+    assert time.monotonic() - started < 5
+
+
+def test_cancelled_request_is_not_sent():
+    cancel = threading.Event()
+    cancel.set()
+    with cancellable(cancel), pytest.raises(RequestCancelled):
+        call_with_retry(lambda: pytest.fail('must not be called'))
+
+
+def test_hedged_stream_commits_to_first_token(monkeypatch):
+    monkeypatch.setattr(hedging, 'HEDGE_DEFAULT_DELAY', 0.01)
+    cancels = {}
+
+    def open_stream(ai_type, cancel):
+        cancels[ai_type] = cancel
+        if ai_type == AiType.GPT:
+            # 첫 토큰이 늦는 provider
+            cancel.wait(5)
+            yield 'slow'
+            return
+        yield 'fa'
+        yield 'st'
+
+    assert ''.join(hedged_stream([AiType.GPT, AiType.ANTHROPIC], open_stream)) == 'fast'
+    assert cancels[AiType.GPT].wait(1)
+
+
+def test_hedged_stream_fails_over_before_first_token():
+    def open_stream(ai_type, cancel):
+        if ai_type == AiType.GPT:
+            raise requests.ConnectionError('reset')
+        yield 'ok'
+
+    assert list(hedged_stream([AiType.GPT, AiType.ANTHROPIC], open_stream)) == ['ok']
+
+    def broken(ai_type, cancel):
+        raise requests.ConnectionError(ai_type)
+        yield
+
+    with pytest.raises(requests.ConnectionError):
+        list(hedged_stream([AiType.GPT, AiType.ANTHROPIC], broken))
+
+
+def test_hedged_stream_raises_winner_error_after_first_token():
+    def open_stream(ai_type, cancel):
+        yield 'partial'
+        raise requests.ConnectionError('reset')
+
+    stream = hedged_stream([AiType.GPT, AiType.ANTHROPIC], open_stream)
+    assert next(stream) == 'partial'
+    with pytest.raises(requests.ConnectionError):
+        next(stream)
+
+
+def test_closing_hedged_stream_cancels_reader():
+    cancels = {}
+
+    def open_stream(ai_type, cancel):
+        cancels[ai_type] = cancel
+        while not cancel.is_set():
+            yield 'x'
+            time.sleep(0.01)
+
+    stream = hedged_stream([AiType.GPT], open_stream)
+    assert next(stream) == 'x'
+    stream.close()
+    assert cancels[AiType.GPT].is_set()
+
+
+def test_stream_with_retry_hedges_across_providers(monkeypatch):
+    import ai_models
+    monkeypatch.setattr(hedging, 'HEDGE_DEFAULT_DELAY', 0.01)
+    monkeypatch.setattr(ai_models, 'configured_providers', lambda: [AiType.GPT, AiType.ANTHROPIC])
+
+    def fake_stream(prompt, ai_type, use_cache=True, json_mode=False):
+        if ai_type == AiType.GPT:
+            time.sleep(1)
+        yield ai_type
+
+    monkeypatch.setattr(ai_models, 'gpt_request_stream', fake_stream)
+    assert list(ai_models.gpt_request_stream_with_retry('p', hedge=True)) == [AiType.ANTHROPIC]
+
+
+def test_provider_slot_caps_calls_to_the_provider_actually_used(monkeypatch):
+    import ai_models
+    monkeypatch.setitem(ai_models._semaphores, AiType.ANTHROPIC, threading.BoundedSemaphore(1))
+    active = []
+    peak = []
+
+    def fake_request(messages, json_mode=False):
+        active.append(1)
+        peak.append(len(active))
+        time.sleep(0.05)
+        active.pop()
+        return 'ok'
+
+    monkeypatch.setattr(ai_models.anthropic3, 'request', fake_request)
+    threads = [threading.Thread(target=ai_models.gpt_request, args=('p', AiType.ANTHROPIC, False))
+               for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert max(peak) == 1
+
+    # 자리를 기다리는 중에 hedge 가 취소되면 기다리지 않고 멈춘다
+    with ai_models.provider_slot(AiType.ANTHROPIC):
+        cancel = threading.Event()
+        cancel.set()
+        with cancellable(cancel), pytest.raises(RequestCancelled):
+            with ai_models.provider_slot(AiType.ANTHROPIC):
+                pytest.fail('slot must not be acquired')
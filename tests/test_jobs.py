@@ -0,0 +1,86 @@
+import pytest
+import app as app_module
+import jobs
+from jobs import JobStatus, JobStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path))
+
+
+def test_wait_output_from_offset(store):
+    job = store.create('generate', 'a', 'p')
+    for delta in 'abc':
+        store.append_output(job['job_id'], 'app', 'app.py', delta)
+    start, output, finished = store.wait_output(job['job_id'], 1, timeout=0)
+    assert start == 1
+    assert [item['delta'] for item in output] == ['b', 'c']
+    assert not finished
+
+
+def test_output_is_capped_and_offsets_stay_absolute(store, monkeypatch):
+    monkeypatch.setattr(jobs, 'OUTPUT_MAX_ITEMS', 8)
+    job_id = store.create('generate', 'a', 'p')['job_id']
+    for i in range(20):
+        store.append_output(job_id, 'app', 'app.py', str(i))
+    start, output, _ = store.wait_output(job_id, 0, timeout=0)
+    assert len(output) <= 8
+    assert start == 20 - len(output)
+    assert [item['delta'] for item in output] == [str(i) for i in range(start, 20)]
+    # 아직 남아 있는 위치부터 다시 읽으면 그대로 이어진다
+    assert store.wait_output(job_id, 18, timeout=0)[:2] == (18, output[-2:])
+
+
+def test_finished_job_output(store):
+    job_id = store.create('generate', 'a', 'p')['job_id']
+    store.update(job_id, status=JobStatus.DONE)
+    assert store.wait_output(job_id, 0, timeout=0) == (0, [], True)
+
+
+@pytest.mark.parametrize('headers, query', [
+    ({'Last-Event-ID': 'abc'}, ''),
+    ({}, '?offset=abc'),
+    ({'Last-Event-ID': '-5'}, ''),
+])
+def test_job_stream_ignores_invalid_offset(headers, query):
+    job_id = app_module.job_store.create('generate', 'a', 'p')['job_id']
+    app_module.job_store.update(job_id, status=JobStatus.DONE)
+    response = app_module.app.test_client().get(f'/job_stream/{job_id}{query}', headers=headers)
+    assert response.status_code == 200
+    assert 'event: done' in response.get_data(as_text=True)
+
+
+def test_finished_jobs_are_evicted_with_their_files(store, monkeypatch, tmp_path):
+    monkeypatch.setattr(jobs, 'JOB_MAX_FINISHED', 2)
+    job_ids = []
+    for _ in range(4):
+        job_id = store.create('generate', 'a', 'p')['job_id']
+        store.update(job_id, status=JobStatus.DONE)
+        job_ids.append(job_id)
+    running = store.create('generate', 'a', 'p')['job_id']
+
+    # 가장 최근에 끝난 JOB_MAX_FINISHED 개와 진행 중인 작업만 남는다
+    assert store.get(job_ids[0]) is None and store.get(job_ids[1]) is None
+    assert not (tmp_path / f'{job_ids[0]}.json').exists()
+    assert store.get(job_ids[3])['status'] == JobStatus.DONE
+    assert store.get(running)['status'] == JobStatus.PENDING
+
+
+def test_expired_job_files_are_removed_on_startup(tmp_path, monkeypatch):
+    store = JobStore(str(tmp_path))
+    old = store.create('generate', 'a', 'p')['job_id']
+    store.update(old, status=JobStatus.DONE)
+    recent = store.create('generate', 'a', 'p')['job_id']
+    store.update(recent, status=JobStatus.DONE)
+    monkeypatch.setattr(jobs, 'JOB_RETENTION', 60)
+    now = store.get(recent)['updated_at'] + 30
+    monkeypatch.setattr(jobs.time, 'time', lambda: now)
+    store._jobs[old]['updated_at'] -= 120
+    store._write(store._jobs[old])
+
+    restarted = JobStore(str(tmp_path))
+    assert restarted.get(old) is None
+    assert restarted.get(recent)['status'] == JobStatus.DONE
+    # 이전 프로세스의 작업은 메모리에 올리지 않고 파일에서 읽는다
+    assert restarted._jobs == {}
@@ -0,0 +1,107 @@
+import os
+import pytest
+import llm_cache as llm_cache_module
+import structured_output
+from llm_cache import LlmCache
+from structured_output import StructuredOutputError, parse_structured
+
+
+@pytest.fixture
+def now(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(llm_cache_module.time, 'time', lambda: clock[0])
+    return clock
+
+
+def test_memory_and_disk_hits(tmp_path):
+    cache = LlmCache(root=str(tmp_path), max_memory_entries=1)
+    cache.put('aa1', 'first')
+    cache.put('bb2', 'second')
+    assert cache.get('bb2') == 'second'
+    # 메모리에서 밀려난 항목은 디스크에서 읽는다
+    assert cache.get('aa1') == 'first'
+    assert cache.get('cc3') is None
+    stats = cache.stats()
+    assert (stats['memory_hits'], stats['disk_hits'], stats['misses']) == (1, 1, 1)
+    assert stats['memory_entries'] == 1
+
+
+def test_disk_index_survives_restart(tmp_path):
+    LlmCache(root=str(tmp_path)).put('aa1', 'value')
+    cache = LlmCache(root=str(tmp_path))
+    assert cache.stats()['disk_entries'] == 1
+    assert cache.get('aa1') == 'value'
+
+
+def test_ttl_expires_memory_and_disk(tmp_path, now):
+    cache = LlmCache(root=str(tmp_path), ttl=10)
+    cache.put('aa1', 'value')
+    now[0] += 11
+    assert cache.get('aa1') is None
+    assert not os.path.exists(tmp_path / 'aa' / 'aa1.json')
+    assert cache.stats()['disk_entries'] == 0
+    # 만료된 항목은 메모리에서도 지운다
+    assert cache.stats()['memory_entries'] == 0
+
+
+def test_disk_write_failure_keeps_memory_entry(tmp_path, monkeypatch):
+    cache = LlmCache(root=str(tmp_path))
+
+    def full_disk(*args, **kwargs):
+        raise OSError(28, 'No space left on device')
+    monkeypatch.setattr(llm_cache_module.os, 'replace', full_disk)
+    cache.put('aa1', 'value')
+    assert cache.get('aa1') == 'value'
+    assert cache.stats()['disk_entries'] == 0
+    assert os.listdir(tmp_path / 'aa') == []
+
+
+def test_disk_eviction_removes_least_recently_used(tmp_path):
+    cache = LlmCache(root=str(tmp_path), max_memory_entries=1, max_disk_bytes=200)
+    cache.put('aa1', 'x' * 40)
+    cache.put('bb2', 'y' * 40)
+    # aa1 을 다시 읽으면 bb2 가 가장 오래 쓰이지 않은 항목이 된다
+    assert cache.get('aa1') == 'x' * 40
+    cache.put('cc3', 'z' * 40)
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['disk_bytes'] <= 200
+    assert not os.path.exists(tmp_path / 'bb' / 'bb2.json')
+    assert cache.get('aa1') == 'x' * 40
+    assert cache.get('cc3') == 'z' * 40
+
+
+def test_discard_value(tmp_path):
+    cache = LlmCache(root=str(tmp_path))
+    cache.put('aa1', 'broken')
+    assert cache.discard_value('broken')
+    assert cache.get('aa1') is None
+    assert not os.path.exists(tmp_path / 'aa' / 'aa1.json')
+    assert not cache.discard_value('unknown')
+
+
+def test_disabled_cache_stores_nothing(tmp_path):
+    cache = LlmCache(root=str(tmp_path), enabled=False)
+    cache.put('aa1', 'value')
+    assert cache.get('aa1') is None
+    assert not os.listdir(tmp_path)
+
+
+def test_parse_failure_evicts_cached_responses(tmp_path, monkeypatch):
+    cache = LlmCache(root=str(tmp_path))
+    monkeypatch.setattr(structured_output, 'llm_cache', cache)
+    cache.put('aa1', 'not json')
+    cache.put('bb2', 'still not json')
+    monkeypatch.setattr(structured_output, 'gpt_request_with_retry', lambda *args, **kwargs: 'still not json')
+    schema = {'name': 'test', 'type': 'object'}
+    with pytest.raises(StructuredOutputError):
+        parse_structured('not json', schema)
+    assert cache.get('aa1') is None
+    assert cache.get('bb2') is None
+
+
+def test_parsed_response_stays_cached(tmp_path, monkeypatch):
+    cache = LlmCache(root=str(tmp_path))
+    monkeypatch.setattr(structured_output, 'llm_cache', cache)
+    cache.put('aa1', '{"a": 1}')
+    assert parse_structured('{"a": 1}', {'name': 'test', 'type': 'object'}) == {'a': 1}
+    assert cache.get('aa1') == '{"a": 1}'
@@ -0,0 +1,76 @@
+from patching import apply_hunk, apply_patch, unified_diff_to_hunks, is_patch
+
+CODE = """def a():
+    return 1
+
+
+def b():
+    return 2
+"""
+
+
+def test_exact_match():
+    content, method = apply_hunk(CODE, '    return 2', '    return 3')
+    assert method == 'exact'
+    assert 'return 3' in content and 'return 1' in content
+
+
+def test_trailing_whitespace_and_indentation():
+    content, method = apply_hunk(CODE, 'def b():  \n    return 2', 'def b():\n    return 20')
+    assert method == 'trailing_whitespace'
+    assert 'return 20' in content
+    content, method = apply_hunk(CODE, 'def b():\n        return 2', 'def b():\n        return 20')
+    assert method == 'indentation'
+    assert '\n    return 20' in content
+
+
+def test_fuzzy_match():
+    code = 'def total(items):\n    return sum(item.price for item in items)\n'
+    content, method = apply_hunk(code, 'def total(items):\n    return sum(item.price for item in item)',
+                                 'def total(items):\n    return sum(item.cost for item in items)')
+    assert method == 'fuzzy'
+    assert 'item.cost' in content
+
+
+def test_ambiguous_search_is_rejected():
+    code = 'x = 1\nprint(x)\nx = 1\n'
+    content, method = apply_hunk(code, 'x = 1', 'x = 2')
+    assert method is None and content == code
+    content, result = apply_patch(code, {'patches': [{'search': 'x = 1', 'replace': 'x = 2'}]})
+    assert content == code
+    assert result.rejected[0]['reason'] == 'ambiguous'
+
+
+def test_ambiguous_after_normalizing_is_rejected():
+    code = 'if a:\n    x = 1\nif b:\n        x = 1\n'
+    content, method = apply_hunk(code, 'x = 1  ', 'x = 2')
+    assert method is None
+
+
+def test_not_found_is_reported():
+    content, result = apply_patch(CODE, {'patches': [{'search': 'def zzz():', 'replace': ''},
+                                                     {'search': '    return 1', 'replace': '    return 10'}]})
+    assert not result.ok
+    assert result.applied == [{'hunk': 1, 'method': 'exact'}]
+    assert result.rejected[0]['reason'] == 'not_found'
+    assert 'return 10' in content
+
+
+def test_unified_diff():
+    diff = """--- a/app.py
++++ b/app.py
+@@ -4,2 +4,2 @@
+ def b():
+-    return 2
++    return 3
+"""
+    assert unified_diff_to_hunks(diff) == [{'search': 'def b():\n    return 2', 'replace': 'def b():\n    return 3'}]
+    content, result = apply_patch(CODE, {'diff': diff})
+    assert result.ok and 'return 3' in content
+
+
+def test_is_patch():
+    assert is_patch({'patches': []})
+    assert is_patch({'diff': ''})
+    assert not is_patch({'content': 'x'})
+    assert not is_patch('x')
@@ -0,0 +1,36 @@
+import pytest
+from ai_models import ClovarX
+from async_ai_models import AsyncClovarX
+from provider_clients import ProviderConfigError, pair_keys
+
+
+def test_pair_keys_keeps_pairs_in_order():
+    assert pair_keys('a1, a2', 'b1,b2', ('A', 'B')) == [('a1', 'b1'), ('a2', 'b2')]
+    assert pair_keys(None, '', ('A', 'B')) == [(None, None)]
+
+
+@pytest.mark.parametrize('cls', [ClovarX, AsyncClovarX])
+def test_clovar_x_rejects_mismatched_key_counts(monkeypatch, cls):
+    monkeypatch.setattr(cls, 'api_key', 'k1,k2,k3')
+    monkeypatch.setattr(cls, 'api_key_primary_val', 'p1,p2')
+    with pytest.raises(ProviderConfigError, match='CloverAPIPrimary'):
+        cls()
+
+
+@pytest.mark.parametrize('factory', ['make_openai_client', 'make_anthropic_client',
+                                     'make_async_openai_client', 'make_async_anthropic_client'])
+def test_sdk_clients_use_pool_size(monkeypatch, factory):
+    import provider_clients
+    created = []
+    pool_limits = provider_clients._pool_limits
+
+    def record(*args):
+        created.append(pool_limits(*args))
+        return created[-1]
+
+    monkeypatch.setattr(provider_clients, '_pool_limits', record)
+    client = getattr(provider_clients, factory)('key')
+    assert client.max_retries == 0
+    assert len(created) == 1
+    assert created[0].max_connections == provider_clients.POOL_SIZE
+    assert created[0].max_keepalive_connections == provider_clients.POOL_SIZE
@@ -0,0 +1,59 @@
+import time
+import pytest
+from ai_types import AiType
+from rate_limiter import RateLimiter, TokenBucket, load_limits_from_env
+
+
+def test_bucket_allows_burst_then_spaces_reservations():
+    bucket = TokenBucket(60)  # 초당 1개
+    t0 = time.monotonic()
+    assert all(bucket.reserve(1, t0) == 0 for _ in range(60))
+    # 모자라도 먼저 차감하므로 기다리는 호출은 예약한 순서대로 1초씩 늦게 풀려난다
+    assert bucket.reserve(1, t0) == pytest.approx(1.0, abs=0.01)
+    assert bucket.reserve(1, t0) == pytest.approx(2.0, abs=0.01)
+
+
+def test_bucket_refills_up_to_capacity():
+    bucket = TokenBucket(60)
+    t0 = time.monotonic()
+    bucket.reserve(60, t0)
+    assert bucket.reserve(10, t0 + 10) == 0
+    assert bucket.reserve(1, t0 + 10) == pytest.approx(1.0, abs=0.01)
+    # 오래 쉬어도 한 번에 per_minute 보다 많이 쌓이지 않는다
+    bucket = TokenBucket(60)
+    assert bucket.reserve(61, t0 + 1000) == pytest.approx(1.0, abs=0.01)
+
+
+def test_bucket_sync_and_pause():
+    bucket = TokenBucket(60)
+    t0 = time.monotonic()
+    bucket.sync(120, 0, t0)
+    assert bucket.per_minute == 120
+    assert bucket.reserve(1, t0) == pytest.approx(0.5)
+
+    bucket = TokenBucket(60)
+    bucket.pause(5, t0)
+    assert bucket.reserve(1, t0) == pytest.approx(6.0)
+
+
+def test_limiter_waits_for_slowest_bucket():
+    limiter = RateLimiter(rpm=600, tpm=60, processes=1)
+    assert limiter.reserve(60) == 0
+    assert limiter.reserve(30) == pytest.approx(30.0, abs=0.1)
+    assert limiter.waits == 1
+
+
+def test_limits_are_divided_between_processes(monkeypatch):
+    monkeypatch.setenv('RATE_LIMIT_GPT_RPM', '1000')
+    monkeypatch.setenv('RATE_LIMIT_GPT_TPM', '0')
+    limits = load_limits_from_env(processes=4)
+    assert limits[AiType.GPT] == {'rpm': 250, 'tpm': None}
+    assert limits[AiType.ANTHROPIC]['rpm'] == 12
+
+
+def test_header_limits_are_divided_between_processes():
+    limiter = RateLimiter(rpm=100, processes=2)
+    limiter.update_from_headers({'x-ratelimit-limit-requests': '1000', 'x-ratelimit-remaining-requests': '1'})
+    assert limiter._requests.per_minute == 500
+    # 계정에 1개 남았으면 이 프로세스의 몫은 0 이라 기다린다
+    assert limiter.reserve() > 0
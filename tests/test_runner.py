@@ -0,0 +1,62 @@
+import subprocess
+import threading
+import time
+
+import pytest
+
+from app_logs import LogBuffer
+from runner import RunnerPool, RunningApp
+
+
+def _sleeping_app(key, port):
+    process = subprocess.Popen(['sleep', '30'], stdout=subprocess.PIPE, text=True,
+                               start_new_session=True)
+    return RunningApp(key, process, port, 'fp', 'python', LogBuffer())
+
+
+@pytest.fixture
+def pool():
+    pool = RunnerPool(port_range=(7001, 7010), max_apps=2, idle_timeout=0.2)
+    yield pool
+    pool.stop_all()
+
+
+def test_reap_keeps_app_with_recent_log_output(pool):
+    key = ('acc', 'p1')
+    app = _sleeping_app(key, 7001)
+    pool._apps[key] = app
+    app.last_used = time.monotonic() - 60
+    app.logs.append('GET / HTTP/1.1 200')
+
+    pool.reap()
+    assert pool.get(*key) is app
+
+    app.logs.last_append = time.monotonic() - 60
+    pool.reap()
+    assert pool.get(*key) is None
+    assert not app.alive()
+
+
+def test_concurrent_starts_do_not_exceed_max_apps(pool, monkeypatch):
+    ports = iter(range(7001, 7011))
+
+    def fake_start(key, project_path, fingerprint, python, lease=None):
+        return _sleeping_app(key, next(ports))
+
+    monkeypatch.setattr(pool, '_start', fake_start)
+    monkeypatch.setattr(pool, '_wait_ready', lambda app: time.sleep(0.2))
+
+    barrier = threading.Barrier(4)
+
+    def run(i):
+        barrier.wait()
+        pool.run('acc', f'p{i}', '.', fingerprint='fp')
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(pool._apps) <= 2
+    assert not pool._starting and not pool._evicting
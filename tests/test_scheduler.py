@@ -0,0 +1,70 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from scheduler import (DependencyScheduler, break_cycles, build_dependency_graph, dependency_layers,
+                       spec_fingerprints)
+
+
+def test_layers_follow_dependencies():
+    graph = {'a': set(), 'b': {'a'}, 'c': {'a'}, 'd': {'b', 'c'}}
+    assert dependency_layers(graph) == [['a'], ['b', 'c'], ['d']]
+
+
+def test_cycle_layers_do_not_mutate_graph():
+    graph = {'a': {'b'}, 'b': {'a'}, 'c': {'a'}}
+    before = {key: set(deps) for key, deps in graph.items()}
+    assert dependency_layers(graph) == [['a'], ['b', 'c']]
+    assert graph == before
+
+
+def test_break_cycles_returns_acyclic_copy():
+    graph = {'a': {'b'}, 'b': {'c'}, 'c': {'a'}, 'd': {'c'}}
+    acyclic = break_cycles(graph)
+    assert graph['a'] == {'b'}
+    assert acyclic == {'a': set(), 'b': {'c'}, 'c': {'a'}, 'd': {'c'}}
+    assert dependency_layers(acyclic) == dependency_layers(graph)
+
+
+def test_graph_from_plan():
+    files = [
+        {'path': 'app', 'fname': 'app.py', 'functionList': ['index()']},
+        {'path': 'app', 'fname': 'models.py', 'objectName': 'Store', 'functionList': ['save()']},
+        {'path': 'app', 'fname': 'views.py', 'functionList': ['render(Store)']},
+        {'path': 'app/templates', 'fname': 'index.html'},
+        {'path': 'app', 'fname': 'requirements.txt'},
+    ]
+    graph = build_dependency_graph(files)
+    assert graph['app/views.py'] == {'app/models.py'}
+    assert graph['app/app.py'] == {'app/models.py', 'app/views.py'}
+    assert graph['app/templates/index.html'] == {'app/app.py'}
+    assert graph['app/requirements.txt'] == {'app/app.py', 'app/models.py', 'app/views.py'}
+
+
+CYCLIC_FILES = [
+    {'path': 'app', 'fname': 'a.py', 'functionList': ['run(b)']},
+    {'path': 'app', 'fname': 'b.py', 'functionList': ['run(a)']},
+]
+
+
+def test_fingerprints_with_cycle():
+    fingerprints = spec_fingerprints(CYCLIC_FILES, '')
+    assert set(fingerprints) == {'app/a.py', 'app/b.py'}
+    assert spec_fingerprints(CYCLIC_FILES, '') == fingerprints
+
+
+def test_scheduler_runs_cyclic_files_in_order():
+    order = []
+    lock = threading.Lock()
+
+    with ThreadPoolExecutor(4) as executor:
+        def submit(file_info, context):
+            def run():
+                with lock:
+                    order.append((file_info['fname'], context))
+                return f"def {file_info['fname'][:-3]}(): pass"
+            return executor.submit(run)
+
+        results = DependencyScheduler(submit, CYCLIC_FILES).join()
+    assert set(results) == {'app/a.py', 'app/b.py'}
+    # a 의 의존을 끊었으므로 a 가 먼저 만들어지고 b 는 a 의 시그니처를 받는다
+    assert order[0] == ('a.py', '')
+    assert order[1][0] == 'b.py' and 'def a()' in order[1][1]
@@ -0,0 +1,92 @@
+import os
+import threading
+import pytest
+import tracing
+from storage import FileSystemStorage, SqliteStorage
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SqliteStorage(str(tmp_path / 'state.db'), export_dir=str(tmp_path / 'export'))
+
+
+def test_transaction_writes_on_commit(store):
+    with store.transaction('a', 'p'):
+        store.write('a', 'p', 'app/app.py', 'print(1)')
+        assert store.read('a', 'p', 'app/app.py') == 'print(1)'
+        assert store.list_files('a', 'p') == []
+    assert store.read('a', 'p', 'app/app.py') == 'print(1)'
+
+
+def test_transaction_discards_on_error(store):
+    with pytest.raises(RuntimeError):
+        with store.transaction('a', 'p'):
+            store.write('a', 'p', 'app.py', 'x')
+            raise RuntimeError('boom')
+    assert store.read('a', 'p', 'app.py') is None
+
+
+def test_job_transaction_batches_only_on_atomic_backend(store, tmp_path):
+    with store.job_transaction('a', 'p'):
+        store.write('a', 'p', 'a.py', 'a')
+        assert store.list_files('a', 'p') == []
+    assert store.list_files('a', 'p') == ['a.py']
+
+    # 파일 시스템은 원자적이지 않으므로 파일마다 바로 쓰고, 작업이 실패해도 끝난 파일은 남긴다
+    fs = FileSystemStorage(str(tmp_path / 'code'))
+    with pytest.raises(RuntimeError):
+        with fs.job_transaction('a', 'p'):
+            fs.write('a', 'p', 'a.py', 'a')
+            assert os.path.exists(tmp_path / 'code' / 'a' / 'p' / 'a.py')
+            raise RuntimeError('boom')
+    assert (tmp_path / 'code' / 'a' / 'p' / 'a.py').read_text() == 'a'
+
+
+def test_nested_transaction_joins_outer(store):
+    with store.transaction('a', 'p'):
+        with store.transaction('a', 'p'):
+            store.write('a', 'p', 'a.py', 'a')
+        assert store.list_files('a', 'p') == []
+    assert store.list_files('a', 'p') == ['a.py']
+
+
+def test_other_threads_write_through(store):
+    # 생성 작업이 transaction 을 열어둔 동안 다른 요청(스레드)의 저장은 batch 에 섞이지 않고 바로 반영된다
+    started = threading.Event()
+    release = threading.Event()
+
+    def job():
+        with pytest.raises(RuntimeError):
+            with store.transaction('a', 'p'):
+                store.write('a', 'p', 'generated.py', 'gen')
+                started.set()
+                release.wait(5)
+                raise RuntimeError('job failed')
+
+    t = threading.Thread(target=job)
+    t.start()
+    started.wait(5)
+    store.write('a', 'p', 'project_data.json', '{}')
+    assert store.list_files('a', 'p') == ['project_data.json']
+    assert store.read('a', 'p', 'generated.py') is None
+    release.set()
+    t.join()
+    assert store.read('a', 'p', 'project_data.json') == '{}'
+    assert store.read('a', 'p', 'generated.py') is None
+
+
+def test_wrapped_worker_writes_into_batch(store):
+    # worker_pool 처럼 tracing.wrap 으로 넘긴 함수는 transaction 을 연 context 를 물려받는다
+    with store.transaction('a', 'p'):
+        t = threading.Thread(target=tracing.wrap(lambda: store.write('a', 'p', 'w.py', 'w')))
+        t.start()
+        t.join()
+        assert store.list_files('a', 'p') == []
+    assert store.read('a', 'p', 'w.py') == 'w'
+
+
+def test_late_write_after_commit_goes_to_disk(store):
+    with store.transaction('a', 'p'):
+        late = tracing.wrap(lambda: store.write('a', 'p', 'late.py', 'late'))
+    late()
+    assert store.read('a', 'p', 'late.py') == 'late'
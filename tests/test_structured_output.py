@@ -0,0 +1,50 @@
+import json
+import pytest
+from structured_output import (repair_json, validate, parse_structured, StructuredOutputError, TruncatedOutputError,
+                               CALL_CHART_SCHEMA, CODE_STRUCTURE_SCHEMA, FILE_EDITS_SCHEMA)
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('{"a": 1,}', {'a': 1}),
+    ("{'a': 'b'}", {'a': 'b'}),
+    ('{a: True, b: None}', {'a': True, 'b': None}),
+    ('{"a": [1, 2 3]}', {'a': [1, 2, 3]}),
+    ('{"a": 1 // 설명\n, "b": [1, ...]}', {'a': 1, 'b': [1]}),
+    ('{"a": {"b": [1, 2', {'a': {'b': [1, 2]}}),
+    ('{"a": 1, "b":', {'a': 1}),
+    ('{"re": "\\d+"}', {'re': '\\d+'}),
+])
+def test_repair_json(text, expected):
+    assert json.loads(repair_json(text)) == expected
+
+
+def test_validate_reports_paths():
+    errors = validate({'Files': [{'path': 'app'}]}, CODE_STRUCTURE_SCHEMA)
+    assert errors == ["$.Files[0]: 'fname' 가 없습니다"]
+    assert validate({'Files': [{'path': 'app', 'fname': 'app.py'}]}, CODE_STRUCTURE_SCHEMA) == []
+    assert validate({}, CALL_CHART_SCHEMA) == ['$: 항목이 비어 있습니다']
+    assert validate({'a.py': 1}, FILE_EDITS_SCHEMA)
+
+
+def test_parse_structured_repairs_locally():
+    value = parse_structured('```json\n{Files: [{path: "app", fname: "app.py",}]}\n```', CODE_STRUCTURE_SCHEMA,
+                             fix=False)
+    assert value == {'Files': [{'path': 'app', 'fname': 'app.py'}]}
+
+
+def test_truncated_file_edit_is_rejected():
+    # max_tokens 에서 잘린 파일 내용을 닫아서 저장하면 사용자 파일이 잘린 코드로 덮어써진다
+    response = '{"app/main.py": "from flask import Flask\\n\\ndef index():\\n    return rend'
+    with pytest.raises(TruncatedOutputError):
+        parse_structured(response, FILE_EDITS_SCHEMA)
+
+
+def test_truncated_plan_is_still_repaired():
+    value = parse_structured('{"Files": [{"path": "app", "fname": "app.py"}, ', CODE_STRUCTURE_SCHEMA,
+                             fix=False)
+    assert value['Files'][0] == {'path': 'app', 'fname': 'app.py'}
+
+
+def test_parse_structured_without_json():
+    with pytest.raises(StructuredOutputError):
+        parse_structured('죄송합니다', FILE_EDITS_SCHEMA, fix=False)
@@ -0,0 +1,59 @@
+import uuid
+import pytest
+import app as app_module
+import symbol_index as symbol_index_module
+from storage import storage
+from symbol_index import SymbolIndexRegistry
+
+
+def new_project():
+    return f'acct-{uuid.uuid4().hex[:8]}', f'proj-{uuid.uuid4().hex[:8]}'
+
+
+def test_lookup_finds_definitions_and_references():
+    ctx = new_project()
+    storage.write(*ctx, 'app/util.py', 'def helper():\n    return 1\n')
+    storage.write(*ctx, 'app/app.py', 'from util import helper\n\nvalue = helper()\n')
+    index = SymbolIndexRegistry().get(*ctx)
+    assert index.find('helper') == [{'path': 'app/util.py', 'line': 1, 'kind': 'function'}]
+    assert index.files_touching('helper') == ['app/app.py', 'app/util.py']
+    assert index.import_graph()['app/app.py'] == ['app/util.py']
+
+
+def test_refresh_skips_unchanged_project(monkeypatch):
+    ctx = new_project()
+    storage.write(*ctx, 'app/util.py', 'def helper():\n    pass\n')
+    registry = SymbolIndexRegistry()
+    registry.get(*ctx)
+    scans = []
+    monkeypatch.setattr(symbol_index_module.storage, 'list_files',
+                        lambda *args, original=storage.list_files: scans.append(args) or original(*args))
+    registry.get(*ctx)
+    assert scans == []
+    # 리스너를 거치지 않고 바뀐 파일도 modified_at 이 바뀌면 다시 훑는다
+    storage.write(*ctx, 'app/other.py', 'def other():\n    pass\n')
+    assert registry.get(*ctx).find('other')
+    assert scans
+
+
+def test_registry_evicts_least_recently_used():
+    registry = SymbolIndexRegistry(max_projects=2)
+    first, second, third = new_project(), new_project(), new_project()
+    first_index = registry.get(*first, refresh=False)
+    registry.get(*second, refresh=False)
+    registry.get(*first, refresh=False)
+    registry.get(*third, refresh=False)
+    assert registry.stats()['projects'] == 2
+    assert registry.get(*first, refresh=False) is first_index
+    assert registry.get(*second, refresh=False) is not None
+    assert registry.stats()['projects'] == 2
+
+
+@pytest.mark.parametrize('symbol', [None, '', 3])
+def test_symbol_lookup_requires_symbol(symbol):
+    account_guid, project_guid = new_project()
+    data = {'account_guid': account_guid, 'project_guid': project_guid}
+    if symbol is not None:
+        data['symbol'] = symbol
+    response = app_module.app.test_client().post('/symbol_lookup', json=data)
+    assert response.status_code == 400
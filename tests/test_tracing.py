@@ -0,0 +1,45 @@
+import os
+
+import tracing
+
+
+def _record(exporter, name):
+    root = tracing.Span(name, tracing._new_id(16))
+    root.end = root.start
+    exporter.export(root)
+    exporter.flush()
+    return root.trace_id
+
+
+def test_span_file_rotates_and_find_reads_backups(tmp_path):
+    exporter = tracing.SpanExporter(str(tmp_path), max_file_bytes=500, backups=2)
+    trace_ids = [_record(exporter, f'span-{i}') for i in range(6)]
+
+    names = sorted(os.listdir(tmp_path))
+    assert os.path.basename(exporter.path) + '.1' in names
+    assert len(names) <= 3
+    assert exporter.find(trace_ids[-2])
+
+
+def test_prune_removes_oldest_files_over_cap(tmp_path):
+    exporter = tracing.SpanExporter(str(tmp_path), max_dir_bytes=250)
+    old = tmp_path / 'spans-1.jsonl'
+    old.write_text('x' * 200)
+    os.utime(old, (1, 1))
+    profile = tmp_path / 'profiles' / 'a.prof'
+    profile.parent.mkdir()
+    profile.write_text('y' * 200)
+
+    exporter.prune()
+    assert not old.exists()
+    assert profile.exists()
+
+
+def test_profile_request_ignored_unless_enabled(monkeypatch):
+    import app as app_module
+
+    with app_module.app.test_request_context('/', method='POST', headers={'X-Profile': '1'}):
+        monkeypatch.setattr(tracing, 'PROFILE_ENABLED', False)
+        assert not app_module.profile_requested()
+        monkeypatch.setattr(tracing, 'PROFILE_ENABLED', True)
+        assert app_module.profile_requested()
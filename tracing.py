@@ -0,0 +1,464 @@
+import atexit
+import contextvars
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from app_logs import SpillFile
+
+# 요청 하나(와 그 요청이 만든 작업)를 trace 하나로 묶고, 단계마다 span 을 남긴다.
+#
+# 현재 span 은 contextvars 로 들고 다닌다. asyncio task 와 asyncio.to_thread 는 context 를 자동으로 복사하고,
+# 직접 만든 스레드(JobQueue, worker_pool, hedging)로 넘길 때는 wrap() 으로 감싼다.
+# trace 가 없는 곳(스크립트, GET 요청)에서는 span 을 만들어도 아무것도 기록하지 않는다.
+#
+# 끝난 span 은 TRACE_DIR/spans-{pid}.jsonl 에 모아서 쓴다. 한 줄이 OTLP/JSON ExportTraceServiceRequest 라서
+# OpenTelemetry Collector 의 otlpjsonfile receiver 로 그대로 읽을 수 있다.
+# 파일은 TRACE_FILE_BYTES 를 넘으면 SpillFile 처럼 .1, .2 ... 로 돌려쓰고, 끝난 프로세스의 파일과 프로파일까지
+# 합쳐서 TRACE_DIR_MAX_BYTES 를 넘으면 오래된 파일부터 지운다.
+
+TRACE_ENABLED = os.environ.get('TRACE_ENABLED', '1') == '1'
+# 추적할 요청 비율. traceparent 헤더로 sampled 가 넘어오거나 프로파일을 요청하면 항상 추적한다
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE') or 0.01)
+# 클라이언트가 X-Profile 헤더나 "profile": true 로 cProfile 을 요청하는 것을 받아줄지. 요청마다 느려지므로 기본은 끔
+PROFILE_ENABLED = os.environ.get('TRACE_PROFILE_ENABLED', '0') == '1'
+TRACE_DIR = os.environ.get('TRACE_DIR') or 'traces'
+TRACE_FILE_BYTES = int(os.environ.get('TRACE_FILE_BYTES') or 10 * 1024 * 1024)
+TRACE_FILE_BACKUPS = int(os.environ.get('TRACE_FILE_BACKUPS') or 3)
+TRACE_DIR_MAX_BYTES = int(os.environ.get('TRACE_DIR_MAX_BYTES') or 200 * 1024 * 1024)
+SERVICE_NAME = os.environ.get('TRACE_SERVICE_NAME') or 'auto-code-tool'
+FLUSH_INTERVAL = 1.0
+# TRACE_DIR_MAX_BYTES 를 넘었는지 확인하는 간격(초)
+PRUNE_INTERVAL = 60
+# /trace/<trace_id> 에서 보여주는 프로파일 상위 함수 수
+PROFILE_TOP = 30
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+_current_profile = contextvars.ContextVar('current_profile', default=None)
+
+
+def _new_id(nbytes):
+    return '%0*x' % (nbytes * 2, random.getrandbits(nbytes * 8))
+
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    if isinstance(value, float):
+        return {'key': key, 'value': {'doubleValue': value}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'kind', 'start', 'end', 'attributes', 'events',
+                 'status', 'message')
+
+    def __init__(self, name, trace_id, parent_id='', kind=SPAN_KIND_INTERNAL, attributes=None):
+        self.trace_id = trace_id
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start = time.time_ns()
+        self.end = None
+        self.attributes = dict(attributes or {})
+        self.events = []
+        self.status = None
+        self.message = ''
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add_event(self, name, **attributes):
+        self.events.append((time.time_ns(), name, attributes))
+
+    def record_error(self, error):
+        self.status = STATUS_ERROR
+        self.message = f'{type(error).__name__}: {error}'
+
+    def finish(self):
+        if self.end is not None:
+            return
+        self.end = time.time_ns()
+        exporter.export(self)
+
+    def to_otlp(self):
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start),
+            'endTimeUnixNano': str(self.end),
+            'attributes': [_attribute(k, v) for k, v in self.attributes.items() if v is not None],
+            'status': {'code': self.status or STATUS_OK, 'message': self.message},
+        }
+        if self.events:
+            span['events'] = [{'timeUnixNano': str(t), 'name': name,
+                               'attributes': [_attribute(k, v) for k, v in attributes.items()]}
+                              for t, name, attributes in self.events]
+        return span
+
+
+class _NoopSpan:
+    """trace 가 없을 때 돌려주는 span. 기록하지 않는다."""
+
+    trace_id = None
+    span_id = None
+
+    def set(self, **attributes):
+        pass
+
+    def add_event(self, name, **attributes):
+        pass
+
+    def record_error(self, error):
+        pass
+
+    def finish(self):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class SpanExporter:
+    """끝난 span 을 모아두었다가 FLUSH_INTERVAL 마다 파일에 한 줄로 쓴다. 쓰기 스레드는 처음 export 할 때 만든다."""
+
+    def __init__(self, directory, max_file_bytes=TRACE_FILE_BYTES, backups=TRACE_FILE_BACKUPS,
+                 max_dir_bytes=TRACE_DIR_MAX_BYTES):
+        self.directory = directory
+        self.max_file_bytes = max_file_bytes
+        self.backups = backups
+        self.max_dir_bytes = max_dir_bytes
+        self._spans = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._file = None
+        self._pruned_at = None
+
+    @property
+    def path(self):
+        # gunicorn worker 끼리 한 파일에 섞어 쓰지 않도록 프로세스마다 따로 쓴다
+        return os.path.join(self.directory, f'spans-{os.getpid()}.jsonl')
+
+    def export(self, span):
+        with self._lock:
+            self._spans.append(span)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='trace-exporter', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Trace export failed: {e}")
+
+    def flush(self):
+        with self._lock:
+            spans, self._spans = self._spans, []
+        if not spans:
+            return
+        line = json.dumps({'resourceSpans': [{
+            'resource': {'attributes': [_attribute('service.name', SERVICE_NAME),
+                                        _attribute('process.pid', os.getpid())]},
+            'scopeSpans': [{'scope': {'name': SERVICE_NAME}, 'spans': [span.to_otlp() for span in spans]}],
+        }]}, ensure_ascii=False)
+        with self._write_lock:
+            # fork 한 worker 는 부모가 연 파일을 이어 쓰지 않고 자기 pid 의 파일을 연다
+            if self._file is None or self._file.path != self.path:
+                if self._file is not None:
+                    self._file.close()
+                self._file = SpillFile(self.path, self.max_file_bytes, self.backups)
+            self._file.write(line)
+            if self._pruned_at is None or time.monotonic() - self._pruned_at >= PRUNE_INTERVAL:
+                self._pruned_at = time.monotonic()
+                self.prune()
+
+    def prune(self):
+        """TRACE_DIR 안의 span 파일과 프로파일이 max_dir_bytes 를 넘으면 오래된 것부터 지운다. 쓰고 있는 파일은 남긴다."""
+        entries = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                if path == self.path:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        try:
+            total += os.path.getsize(self.path)
+        except OSError:
+            pass
+        for _, size, path in sorted(entries):
+            if total <= self.max_dir_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def find(self, trace_id):
+        """이 디렉터리의 span 파일들에서 trace_id 의 span 을 시작 시각 순서로 찾는다."""
+        self.flush()
+        spans = []
+        if not os.path.isdir(self.directory):
+            return spans
+        for name in sorted(os.listdir(self.directory)):
+            # 돌려쓴 파일(spans-{pid}.jsonl.1 ...)도 읽는다
+            if '.jsonl' not in name:
+                continue
+            try:
+                f = open(os.path.join(self.directory, name), 'r', encoding='utf-8')
+            except FileNotFoundError:
+                # 읽는 사이에 돌려쓰거나 지운 파일
+                continue
+            with f:
+                for line in f:
+                    if trace_id not in line:
+                        continue
+                    for resource in json.loads(line)['resourceSpans']:
+                        for scope in resource['scopeSpans']:
+                            spans += [span for span in scope['spans'] if span['traceId'] == trace_id]
+        return sorted(spans, key=lambda span: int(span['startTimeUnixNano']))
+
+
+exporter = SpanExporter(TRACE_DIR)
+atexit.register(exporter.flush)
+
+
+class TraceProfile:
+    """trace 하나를 처리하는 모든 스레드의 cProfile 결과를 합친다.
+
+    cProfile 은 켠 스레드만 보므로 wrap() 으로 넘어간 스레드마다 따로 켜고, 끝날 때 합쳐서 파일로 다시 쓴다.
+    """
+
+    def __init__(self, trace_id):
+        self.path = os.path.join(TRACE_DIR, 'profiles', f'{trace_id}.prof')
+        self._stats = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # 이 스레드에서 이미 다른 프로파일러가 돌고 있음
+            return None
+        return profiler
+
+    def stop(self, profiler):
+        if profiler is None:
+            return
+        profiler.disable()
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profiler)
+            else:
+                self._stats.add(profiler)
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._stats.dump_stats(self.path)
+
+    @contextmanager
+    def thread(self):
+        profiler = self.start()
+        try:
+            yield
+        finally:
+            self.stop(profiler)
+
+
+def load_profile_summary(trace_id, limit=PROFILE_TOP):
+    """저장된 프로파일의 누적 시간 상위 함수 목록(텍스트). 없으면 None."""
+    path = os.path.join(TRACE_DIR, 'profiles', f'{trace_id}.prof')
+    if not os.path.exists(path):
+        return None
+    out = io.StringIO()
+    pstats.Stats(path, stream=out).sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
+
+
+def current_span():
+    return _current_span.get() or NOOP_SPAN
+
+
+def current_trace_id():
+    span = _current_span.get()
+    return span.trace_id if span is not None else None
+
+
+def start_span(name, parent=None, **attributes):
+    """현재 span(또는 parent)의 자식 span 을 만든다. 현재 span 으로 바꾸지는 않으므로 generator 안에서도 쓸 수 있다.
+
+    끝날 때 finish() 를 불러야 기록된다.
+    """
+    parent = parent or _current_span.get()
+    if parent is None or parent is NOOP_SPAN:
+        return NOOP_SPAN
+    return Span(name, parent.trace_id, parent.span_id, attributes=attributes)
+
+
+@contextmanager
+def activate(span):
+    """span 을 현재 span 으로 둔다. 이 안에서 만든 span 과 wrap() 한 함수는 span 의 자식이 된다."""
+    if span is NOOP_SPAN:
+        yield span
+        return
+    token = _current_span.set(span)
+    try:
+        yield span
+    finally:
+        _current_span.reset(token)
+
+
+@contextmanager
+def span(name, parent=None, **attributes):
+    """with span('plan'): ... 블록을 현재 span 의 자식 span 으로 기록한다. 예외가 나면 error 로 남긴다."""
+    child = start_span(name, parent, **attributes)
+    try:
+        with activate(child):
+            yield child
+    except BaseException as e:
+        child.record_error(e)
+        raise
+    finally:
+        child.finish()
+
+
+def iterate(span, iterator):
+    """iterator 에서 항목을 꺼내는 동안만 span 을 현재 span 으로 둔다.
+
+    generator 는 꺼내는 쪽의 context 에서 돌기 때문에, yield 사이에 현재 span 을 바꿔두면 호출한 쪽으로 새어 나간다.
+    """
+    iterator = iter(iterator)
+    while True:
+        with activate(span):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+async def aiterate(span, iterator):
+    """iterate 의 async iterator 버전."""
+    while True:
+        with activate(span):
+            try:
+                item = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+        yield item
+
+
+def add_event(name, **attributes):
+    current_span().add_event(name, **attributes)
+
+
+def parse_traceparent(value):
+    """W3C traceparent 헤더 (00-<trace_id>-<parent_id>-<flags>). 형식이 틀리면 None."""
+    parts = (value or '').strip().split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16), int(parts[3], 16)
+    except ValueError:
+        return None
+    return parts[1], parts[2], int(parts[3], 16) & 1 == 1
+
+
+def format_traceparent(span):
+    return f'00-{span.trace_id}-{span.span_id}-01'
+
+
+def start_trace(name, traceparent=None, profile=False, **attributes):
+    """요청의 root span 을 만든다. 추적하지 않는 요청이면 NOOP_SPAN.
+
+    traceparent 헤더가 있으면 그 trace 를 이어간다. profile 이면 이 trace 의 모든 스레드를 cProfile 로 잰다.
+    """
+    parent = parse_traceparent(traceparent)
+    sampled = profile or (parent is not None and parent[2]) or random.random() < TRACE_SAMPLE_RATE
+    if not TRACE_ENABLED or not sampled:
+        return NOOP_SPAN
+    trace_id, parent_id = (parent[0], parent[1]) if parent else (_new_id(16), '')
+    root = Span(name, trace_id, parent_id, kind=SPAN_KIND_SERVER, attributes=attributes)
+    if profile:
+        root.set(**{'profile.path': TraceProfile(trace_id).path})
+    return root
+
+
+@contextmanager
+def trace(root, profile=False):
+    """root span 을 현재 span 으로 두고, profile 이면 이 스레드와 wrap() 으로 넘긴 스레드를 프로파일한다."""
+    if root is NOOP_SPAN:
+        yield root
+        return
+    profile = TraceProfile(root.trace_id) if profile else None
+    token = _current_profile.set(profile)
+    try:
+        with activate(root):
+            if profile is None:
+                yield root
+            else:
+                with profile.thread():
+                    yield root
+    finally:
+        _current_profile.reset(token)
+
+
+def _run_in_thread(fn, args, kwargs):
+    profile = _current_profile.get()
+    if profile is None:
+        return fn(*args, **kwargs)
+    with profile.thread():
+        return fn(*args, **kwargs)
+
+
+def capture():
+    """지금의 trace 상태. 콜백처럼 나중에 다른 스레드에서 불리는 곳에서 restore() 로 되살린다."""
+    return _current_span.get(), _current_profile.get()
+
+
+@contextmanager
+def restore(state):
+    span_token = _current_span.set(state[0])
+    profile_token = _current_profile.set(state[1])
+    try:
+        yield
+    finally:
+        _current_profile.reset(profile_token)
+        _current_span.reset(span_token)
+
+
+def wrap(fn):
+    """지금의 context 를 다른 스레드에서 이어가도록 fn 을 감싼다. 감싼 함수는 한 번만 부른다.
+
+    trace(현재 span, 프로파일 설정) 뿐 아니라 storage transaction 같은 다른 contextvars 도 함께 넘어간다.
+    """
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.run(_run_in_thread, fn, args, kwargs)
+    return run
@@ -0,0 +1,46 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from metrics import metrics
+import tracing
+
+# 동시에 진행하는 파일 생성 작업 수. provider 별 동시 호출 수는 ai_models 의 LLM_CONCURRENCY_* 가 제한한다
+WORKERS = int(os.environ.get('LLM_WORKERS') or 16)
+
+
+worker_pool_in_flight = metrics.gauge(
+    'llm_worker_pool_tasks', 'worker pool 에 제출되어 대기 중이거나 실행 중인 작업 수')
+
+
+class WorkerPool:
+    """프로세스 전체에서 공유하는 LLM 작업 실행기.
+
+    요청이 몇 개가 들어오든 작업 스레드 수는 max_workers 를 넘지 않는다.
+    어느 provider 를 부를지는 작업 안에서 정해지므로(failover, hedge) provider 별 제한은 호출하는 곳에서 한다.
+    """
+
+    def __init__(self, max_workers=WORKERS):
+        self._max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix='llm-worker')
+            return self._executor
+
+    def submit(self, fn, *args, **kwargs):
+        worker_pool_in_flight.inc()
+        future = self._get_executor().submit(tracing.wrap(fn), *args, **kwargs)
+        future.add_done_callback(lambda _: worker_pool_in_flight.dec())
+        return future
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+worker_pool = WorkerPool()